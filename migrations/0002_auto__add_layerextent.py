@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'LayerExtent'
+        db.create_table(u'ga_ows_layerextent', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('source', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('layer', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('checksum', self.gf('django.db.models.fields.CharField')(default='', max_length=32, blank=True)),
+            ('minx', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('miny', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('maxx', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('maxy', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('stale', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal(u'ga_ows', ['LayerExtent'])
+
+        # Adding unique constraint on 'LayerExtent', fields ['source', 'layer']
+        db.create_unique(u'ga_ows_layerextent', ['source', 'layer'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'LayerExtent', fields ['source', 'layer']
+        db.delete_unique(u'ga_ows_layerextent', ['source', 'layer'])
+
+        # Deleting model 'LayerExtent'
+        db.delete_table(u'ga_ows_layerextent')
+
+    models = {
+        u'ga_ows.layerextent': {
+            'Meta': {'unique_together': "((u'source', u'layer'),)", 'object_name': 'LayerExtent'},
+            'checksum': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'layer': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'maxx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'maxy': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'minx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'miny': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'stale': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['ga_ows']
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import connection, models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        if u'ga_ows_ogrdataset' in connection.introspection.table_names():
+            # Adding field 'OGRDataset.spatial_index'
+            db.add_column(u'ga_ows_ogrdataset', 'spatial_index',
+                          self.gf('django.db.models.fields.CharField')(default='unknown', max_length=16),
+                          keep_default=False)
+            return
+
+        # The OGR dataset tables predate the initial migration, so databases set up by it don't have them yet.
+        # Adding model 'OGRDatasetCollection'
+        db.create_table(u'ga_ows_ogrdatasetcollection', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255)),
+        ))
+        db.send_create_signal(u'ga_ows', ['OGRDatasetCollection'])
+
+        # Adding model 'OGRDataset'
+        db.create_table(u'ga_ows_ogrdataset', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('collection', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['ga_ows.OGRDatasetCollection'])),
+            ('location', self.gf('django.db.models.fields.TextField')()),
+            ('checksum', self.gf('django.db.models.fields.CharField')(max_length=32)),
+            ('spatial_index', self.gf('django.db.models.fields.CharField')(default='unknown', max_length=16)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255, db_index=True)),
+            ('human_name', self.gf('django.db.models.fields.TextField')(null=True, db_index=True, blank=True)),
+            ('extent', self.gf('django.contrib.gis.db.models.fields.PolygonField')()),
+        ))
+        db.send_create_signal(u'ga_ows', ['OGRDataset'])
+
+        # Adding model 'OGRLayer'
+        db.create_table(u'ga_ows_ogrlayer', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('dataset', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['ga_ows.OGRDataset'])),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255, db_index=True)),
+            ('human_name', self.gf('django.db.models.fields.TextField')(null=True, db_index=True, blank=True)),
+            ('extent', self.gf('django.contrib.gis.db.models.fields.PolygonField')()),
+        ))
+        db.send_create_signal(u'ga_ows', ['OGRLayer'])
+
+    def backwards(self, orm):
+        # forwards created the tables unless they predate it.  Empty tables are dropped, which undoes the first case
+        # and loses nothing in the second; tables with datasets in them keep their data and lose the column, which is
+        # the state forwards adopts them from.
+        if not db.execute(u'SELECT 1 FROM ga_ows_ogrdataset LIMIT 1') and not db.execute(u'SELECT 1 FROM ga_ows_ogrdatasetcollection LIMIT 1'):
+            # Deleting model 'OGRLayer'
+            db.delete_table(u'ga_ows_ogrlayer')
+
+            # Deleting model 'OGRDataset'
+            db.delete_table(u'ga_ows_ogrdataset')
+
+            # Deleting model 'OGRDatasetCollection'
+            db.delete_table(u'ga_ows_ogrdatasetcollection')
+            return
+
+        # Deleting field 'OGRDataset.spatial_index'
+        db.delete_column(u'ga_ows_ogrdataset', 'spatial_index')
+
+    models = {
+        u'ga_ows.layerextent': {
+            'Meta': {'unique_together': "((u'source', u'layer'),)", 'object_name': 'LayerExtent'},
+            'checksum': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'layer': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'maxx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'maxy': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'minx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'miny': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'stale': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'ga_ows.ogrdataset': {
+            'Meta': {'object_name': 'OGRDataset'},
+            'checksum': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['ga_ows.OGRDatasetCollection']"}),
+            'extent': ('django.contrib.gis.db.models.fields.PolygonField', [], {}),
+            'human_name': ('django.db.models.fields.TextField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.TextField', [], {}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'spatial_index': ('django.db.models.fields.CharField', [], {'default': "'unknown'", 'max_length': '16'})
+        },
+        u'ga_ows.ogrdatasetcollection': {
+            'Meta': {'object_name': 'OGRDatasetCollection'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        u'ga_ows.ogrlayer': {
+            'Meta': {'object_name': 'OGRLayer'},
+            'dataset': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['ga_ows.OGRDataset']"}),
+            'extent': ('django.contrib.gis.db.models.fields.PolygonField', [], {}),
+            'human_name': ('django.db.models.fields.TextField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['ga_ows']
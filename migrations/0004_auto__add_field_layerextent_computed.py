@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'LayerExtent.computed'
+        db.add_column(u'ga_ows_layerextent', 'computed',
+                      self.gf('django.db.models.fields.DateTimeField')(null=True),
+                      keep_default=False)
+
+    def backwards(self, orm):
+        # Deleting field 'LayerExtent.computed'
+        db.delete_column(u'ga_ows_layerextent', 'computed')
+
+    models = {
+        u'ga_ows.layerextent': {
+            'Meta': {'unique_together': "((u'source', u'layer'),)", 'object_name': 'LayerExtent'},
+            'checksum': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'blank': 'True'}),
+            'computed': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'layer': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'maxx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'maxy': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'minx': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'miny': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'stale': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'ga_ows.ogrdataset': {
+            'Meta': {'object_name': 'OGRDataset'},
+            'checksum': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'collection': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['ga_ows.OGRDatasetCollection']"}),
+            'extent': ('django.contrib.gis.db.models.fields.PolygonField', [], {}),
+            'human_name': ('django.db.models.fields.TextField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.TextField', [], {}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'spatial_index': ('django.db.models.fields.CharField', [], {'default': "'unknown'", 'max_length': '16'})
+        },
+        u'ga_ows.ogrdatasetcollection': {
+            'Meta': {'object_name': 'OGRDatasetCollection'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        u'ga_ows.ogrlayer': {
+            'Meta': {'object_name': 'OGRLayer'},
+            'dataset': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['ga_ows.OGRDataset']"}),
+            'extent': ('django.contrib.gis.db.models.fields.PolygonField', [], {}),
+            'human_name': ('django.db.models.fields.TextField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['ga_ows']
@@ -1,19 +1,369 @@
+from django.conf import settings
 from django.contrib.gis.db import models
+from django.db import IntegrityError
+from django.db.models import Q, get_model
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
+from django.contrib.gis.geos import GEOSGeometry
+from django.utils import timezone
+from datetime import timedelta
+from osgeo import ogr
+import logging
+
+log = logging.getLogger(__name__)
 
 class OGRDatasetCollection(models.Model):
     name = models.CharField(max_length=255, blank=False)
 
+#: OGR SQL that builds a spatial index on a layer, by driver.  Formats that aren't listed can't be given one.
+SPATIAL_INDEX_SQL = {
+    'ESRI Shapefile' : 'CREATE SPATIAL INDEX ON "{layer}"',
+    'GPKG' : "SELECT CreateSpatialIndex('{layer}', '{geometry}')",
+    'SQLite' : "SELECT CreateSpatialIndex('{layer}', '{geometry}')",
+}
+
 class OGRDataset(models.Model):
+    """A file or connection string OGR can open.  Registering a dataset, or saving it with a new checksum, checks that
+    its layers have spatial indexes, so that bbox queries against it don't scan every feature, and builds any that are
+    missing (see :meth:`create_spatial_index`).  The outcome is kept in spatial_index and holds for the dataset as it
+    was at checksum.
+    """
+    SPATIAL_INDEX_STATES = (
+        ('unknown', 'Not checked yet'),
+        ('present', 'Every layer has a spatial index'),
+        ('missing', 'Some layer has no spatial index'),
+        ('created', 'Spatial indexes were built on registration'),
+        ('unsupported', 'The format has no spatial indexes'),
+        ('failed', 'Building a spatial index failed'),
+    )
+
     collection = models.ForeignKey(OGRDatasetCollection, null=False)
     location = models.TextField(blank=False, null=False)
     checksum = models.CharField(max_length=32, blank=False, null=False)
+    spatial_index = models.CharField(max_length=16, choices=SPATIAL_INDEX_STATES, default='unknown')
     name = models.CharField(max_length=255, blank=False, null=False, db_index=True)
     human_name = models.TextField(blank=True, null=True, db_index=True)
     extent = models.PolygonField(srid=4326)
 
+    objects = models.GeoManager()
+
+    def spatial_index_state(self):
+        """Check the dataset's layers for spatial indexes without changing anything.  Returns 'present', 'missing',
+        'unsupported', or 'failed' if the dataset can't be opened."""
+        ds = ogr.Open(self.location.encode('utf-8'))
+        if ds is None:
+            return 'failed'
+        if all(ds.GetLayer(k).TestCapability(ogr.OLCFastSpatialFilter) for k in range(ds.GetLayerCount())):
+            return 'present'
+        elif ds.GetDriver().GetName() in SPATIAL_INDEX_SQL:
+            return 'missing'
+        else:
+            return 'unsupported'
+
+    def create_spatial_index(self):
+        """Build a spatial index on every layer that lacks one.  Shapefiles get a .qix file next to them; GeoPackage
+        and Spatialite layers get an R*Tree table.  Returns the new state, 'created', 'present', 'unsupported', or
+        'failed'.  The state is not saved."""
+        ds = ogr.Open(self.location.encode('utf-8'), 1)
+        if ds is None:
+            return 'failed'
+        sql = SPATIAL_INDEX_SQL.get(ds.GetDriver().GetName())
+        created = False
+        for k in range(ds.GetLayerCount()):
+            layer = ds.GetLayer(k)
+            if layer.TestCapability(ogr.OLCFastSpatialFilter):
+                continue
+            if sql is None:
+                return 'unsupported'
+            result = ds.ExecuteSQL(sql.format(layer=layer.GetName(), geometry=layer.GetGeometryColumn()))
+            if result is not None:
+                ds.ReleaseResultSet(result)
+            created = True
+        ds.SyncToDisk()
+        if not all(ds.GetLayer(k).TestCapability(ogr.OLCFastSpatialFilter) for k in range(ds.GetLayerCount())):
+            return 'failed'
+        return 'created' if created else 'present'
+
+    @classmethod
+    def index(cls, pk):
+        """Build the missing spatial indexes of a registered dataset and record the outcome"""
+        dataset = cls.objects.get(pk=pk)
+        cls.objects.filter(pk=pk, checksum=dataset.checksum).update(spatial_index=dataset.create_spatial_index())
+
 class OGRLayer(models.Model):
     dataset = models.ForeignKey(OGRDataset)
     name = models.CharField(max_length=255, db_index=True)
     human_name = models.TextField(blank=True, null=True, db_index=True)
     extent = models.PolygonField(srid=4326)
 
+    objects = models.GeoManager()
+
+
+#: Whether extents and spatial indexes are brought up to date by the Celery tasks in :mod:`ga_ows.tasks`.  Set
+#: GA_OWS_CELERY = True in the Django settings to use them; otherwise the work is done in the request that needs it.
+try:
+    import celery
+    HAVE_CELERY = getattr(settings, 'GA_OWS_CELERY', False)
+except ImportError:
+    HAVE_CELERY = False
+
+def _delay(task, *args):
+    """Queue one of the tasks in :mod:`ga_ows.tasks`.  Returns False if it wasn't queued, because Celery is off or the
+    broker can't be reached, so that the caller can fall back to doing the work some other way.  Saves never fail
+    because of the broker."""
+    if not HAVE_CELERY:
+        return False
+    try:
+        from ga_ows import tasks
+        getattr(tasks, task).delay(*args)
+    except Exception:
+        log.exception('could not queue %s%r', task, args)
+        return False
+    return True
+
+#: Seconds before an extent of a GeoDjango model is recomputed even though no signal has marked it stale, to catch up
+#: with writes that don't send signals.  Set GA_OWS_EXTENT_TTL in the Django settings; None never expires extents.
+EXTENT_TTL = getattr(settings, 'GA_OWS_EXTENT_TTL', 86400)
+
+def _model_source(model):
+    return model._meta.app_label + '.' + model._meta.object_name
+
+def _geometry_fields(model):
+    return [field for field in model._meta.fields if isinstance(field, models.GeometryField)]
+
+def _envelope(geometry, field):
+    if geometry.srid and field.srid and geometry.srid != field.srid:
+        geometry = geometry.transform(field.srid, clone=True)
+    return geometry.extent
+
+
+class LayerExtent(models.Model):
+    """The bounding box of a layer, in the layer's native SRS, kept so that capabilities documents and nativebbox don't
+    need a full-table extent() or a full scan of an OGR layer.
+
+    Extents of GeoDjango models are kept up to date by signal handlers (see :meth:`watch`).  Saving a feature grows
+    the extent in place.  Deleting or moving a feature that touches the extent's edges can shrink it, which takes a
+    scan, so the extent is marked stale and recomputed by a Celery task if Celery is enabled (see
+    :const:`HAVE_CELERY`).  A stale extent only ever errs on the large side.  One that is still stale when it's read,
+    because Celery is off, the broker was down, or the task hasn't run yet, is recomputed then.  Extents of OGR
+    layers are recomputed whenever their source's checksum changes.
+
+    Writes that don't send signals aren't seen: ``QuerySet.update()``, ``bulk_create()``, raw SQL, and loads that
+    bypass Django such as ogr2ogr or COPY.  An extent that has missed them may be too small or too large until it's
+    recomputed, which happens when it's read :const:`EXTENT_TTL` seconds after it was last computed.  Call
+    :meth:`recompute` after a bulk load to see it right away.
+    """
+    source = models.CharField(max_length=255)
+    layer = models.CharField(max_length=255)
+    checksum = models.CharField(max_length=32, blank=True, default='')
+    minx = models.FloatField(null=True)
+    miny = models.FloatField(null=True)
+    maxx = models.FloatField(null=True)
+    maxy = models.FloatField(null=True)
+    stale = models.BooleanField(default=False)
+    computed = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('source', 'layer'),)
+
+    @property
+    def bbox(self):
+        """(minx, miny, maxx, maxy), or None if the layer is empty"""
+        if self.minx is None:
+            return None
+        return self.minx, self.miny, self.maxx, self.maxy
+
+    @property
+    def expired(self):
+        """True if the extent was computed more than :const:`EXTENT_TTL` seconds ago"""
+        if EXTENT_TTL is None:
+            return False
+        return self.computed is None or self.computed < timezone.now() - timedelta(seconds=EXTENT_TTL)
+
+    def contains(self, envelope):
+        """True if an envelope lies strictly inside this extent, so that removing it can't shrink the extent"""
+        minx, miny, maxx, maxy = envelope
+        return self.minx is not None and self.minx < minx and self.miny < miny and self.maxx > maxx and self.maxy > maxy
+
+    @classmethod
+    def _store(cls, source, layer, bbox, checksum=''):
+        minx, miny, maxx, maxy = bbox or (None, None, None, None)
+        values = dict(checksum=checksum, minx=minx, miny=miny, maxx=maxx, maxy=maxy, stale=False, computed=timezone.now())
+        if not cls.objects.filter(source=source, layer=layer).update(**values):
+            try:
+                cls.objects.create(source=source, layer=layer, **values)
+            except IntegrityError:
+                # another process stored it first
+                cls.objects.filter(source=source, layer=layer).update(**values)
+        return bbox
+
+    @classmethod
+    def of_model(cls, model, field_name):
+        """The extent of a geometry field of a GeoDjango model as (minx, miny, maxx, maxy), or None if it's empty"""
+        source = _model_source(model)
+        rows = list(cls.objects.filter(source=source, layer=field_name)[:1])
+        if not rows:
+            return cls._store(source, field_name, model.objects.extent(field_name=field_name))
+        if rows[0].stale:
+            return cls.recompute(source, field_name)
+        if rows[0].expired:
+            # served as it is while the task runs; recomputed here if it can't be queued
+            cls.objects.filter(pk=rows[0].pk).update(computed=timezone.now())
+            if not _delay('recompute_extent', source, field_name):
+                return cls.recompute(source, field_name)
+        return rows[0].bbox
+
+    @classmethod
+    def of_ogr_layer(cls, source, layer, checksum):
+        """The extent of an OGR layer as (minx, maxx, miny, maxy), the order ogr.Layer.GetExtent uses.
+
+        :param source: The name of the layer's datasource.
+        :param layer: An ogr.Layer
+        :param checksum: A short string that changes whenever the datasource does, such as its size and mtime.
+        """
+        rows = list(cls.objects.filter(source=source, layer=layer.GetName(), checksum=checksum)[:1])
+        if rows and rows[0].bbox:
+            minx, miny, maxx, maxy = rows[0].bbox
+        else:
+            minx, maxx, miny, maxy = layer.GetExtent()
+            cls._store(source, layer.GetName(), (minx, miny, maxx, maxy), checksum)
+        return minx, maxx, miny, maxy
+
+    @classmethod
+    def grow(cls, source, layer, envelope):
+        """Grow an extent to include an envelope.  Each side is moved with a conditional update of its own, so
+        concurrent saves can't undo each other's growth."""
+        rows = list(cls.objects.filter(source=source, layer=layer)[:1])
+        if not rows or rows[0].contains(envelope):
+            return
+        minx, miny, maxx, maxy = envelope
+        row = cls.objects.filter(pk=rows[0].pk)
+        row.filter(Q(minx__isnull=True) | Q(minx__gt=minx)).update(minx=minx)
+        row.filter(Q(miny__isnull=True) | Q(miny__gt=miny)).update(miny=miny)
+        row.filter(Q(maxx__isnull=True) | Q(maxx__lt=maxx)).update(maxx=maxx)
+        row.filter(Q(maxy__isnull=True) | Q(maxy__lt=maxy)).update(maxy=maxy)
+
+    @classmethod
+    def shrink(cls, source, layer, envelope):
+        """Account for an envelope that has been removed from a layer.  If it touched the edges of the extent, the
+        extent is marked stale and recomputed in the background.  An envelope of None, for a geometry whose old value
+        isn't known, always marks it stale."""
+        rows = list(cls.objects.filter(source=source, layer=layer)[:1])
+        if not rows or rows[0].stale or (envelope is not None and rows[0].contains(envelope)):
+            return
+        cls.objects.filter(pk=rows[0].pk).update(stale=True)
+        # if the task can't be queued the extent stays stale, and is recomputed when it's next read
+        _delay('recompute_extent', source, layer)
+
+    @classmethod
+    def recompute(cls, source, layer):
+        """Recompute the extent of a GeoDjango model's geometry field from scratch.  Saves may grow the extent while
+        the table is scanned, so each side is only replaced if it hasn't moved since the scan began; a side that has
+        moved keeps whichever of the two values lies further out."""
+        app_label, object_name = source.split('.', 1)
+        model = get_model(app_label, object_name)
+        rows = list(cls.objects.filter(source=source, layer=layer)[:1])
+        if not rows:
+            return cls._store(source, layer, model.objects.extent(field_name=layer))
+
+        # cleared before the scan, so that a shrink during the scan marks the extent stale again
+        row = cls.objects.filter(pk=rows[0].pk)
+        row.update(stale=False, computed=timezone.now())
+        bbox = model.objects.extent(field_name=layer) or (None, None, None, None)
+        for name, value, outside in zip(('minx', 'miny', 'maxx', 'maxy'), bbox, ('gt', 'gt', 'lt', 'lt')):
+            before = getattr(rows[0], name)
+            unmoved = {name + '__isnull' : True} if before is None else {name : before}
+            if not row.filter(**unmoved).update(**{name : value}) and value is not None:
+                row.filter(Q(**{name + '__isnull' : True}) | Q(**{name + '__' + outside : value})).update(**{name : value})
+        return cls.objects.get(pk=rows[0].pk).bbox
+
+    @classmethod
+    def watch(cls, model):
+        """Keep the extents of a model's geometry fields up to date as instances are saved and deleted"""
+        uid = 'ga_ows_extent_' + model._meta.db_table
+        post_init.connect(_loaded_geometries, sender=model, dispatch_uid=uid)
+        pre_save.connect(_remember_extents, sender=model, dispatch_uid=uid)
+        post_save.connect(_update_extents, sender=model, dispatch_uid=uid)
+        post_delete.connect(_remove_extents, sender=model, dispatch_uid=uid)
+
+
+def _loaded_geometries(sender, instance, **kwargs):
+    """post_init: keep the geometries an instance was loaded with.  GeoDjango only parses a geometry when it's first
+    accessed, so until then this is the database's value and keeping it costs nothing."""
+    if instance.pk is None:
+        return
+    loaded = {}
+    for field in _geometry_fields(sender):
+        value = instance.__dict__.get(field.attname)
+        # a geometry object was passed to the constructor rather than read from the database
+        if not isinstance(value, GEOSGeometry):
+            loaded[field.attname] = value
+    instance._ga_ows_loaded = loaded
+
+def _remember_extents(sender, instance, raw=False, **kwargs):
+    """pre_save: note where an instance's changed geometries were, since moving them may shrink the extent.  The old
+    geometries are the ones the instance was loaded with; the extent of one that wasn't loaded is marked stale."""
+    instance._ga_ows_old_extents = {}
+    instance._ga_ows_unchanged = set()
+    if raw or instance.pk is None or instance._state.adding:
+        return
+    loaded = getattr(instance, '_ga_ows_loaded', {})
+    for field in _geometry_fields(sender):
+        current = instance.__dict__.get(field.attname)
+        if field.attname not in loaded:
+            instance._ga_ows_old_extents[field.name] = None
+            continue
+        value = loaded[field.attname]
+        if current is value:
+            # never accessed, so never changed
+            instance._ga_ows_unchanged.add(field.name)
+            continue
+        if not value:
+            continue
+        old = GEOSGeometry(value)
+        if isinstance(current, GEOSGeometry) and current.equals_exact(old):
+            instance._ga_ows_unchanged.add(field.name)
+        else:
+            instance._ga_ows_old_extents[field.name] = _envelope(old, field)
+
+def _update_extents(sender, instance, raw=False, **kwargs):
+    source = _model_source(sender)
+    unchanged = getattr(instance, '_ga_ows_unchanged', ())
+    loaded = {}
+    for field in _geometry_fields(sender):
+        geometry = getattr(instance, field.name)
+        loaded[field.attname] = geometry.hexewkb if geometry else None
+        if geometry and field.name not in unchanged:
+            LayerExtent.grow(source, field.name, _envelope(geometry, field))
+    for name, envelope in getattr(instance, '_ga_ows_old_extents', {}).items():
+        LayerExtent.shrink(source, name, envelope)
+    instance._ga_ows_old_extents = {}
+    # the saved geometries are the old ones of the next save
+    instance._ga_ows_loaded = loaded
+
+def _remove_extents(sender, instance, **kwargs):
+    source = _model_source(sender)
+    for field in _geometry_fields(sender):
+        geometry = getattr(instance, field.name)
+        if geometry:
+            LayerExtent.shrink(source, field.name, _envelope(geometry, field))
+
+
+def _check_spatial_index(sender, instance, raw=False, **kwargs):
+    """pre_save: find out whether a new or changed dataset has spatial indexes"""
+    if raw:
+        return
+    if instance.pk is not None and not sender.objects.filter(pk=instance.pk, checksum=instance.checksum).exists():
+        instance.spatial_index = 'unknown'
+    if instance.spatial_index == 'unknown':
+        instance.spatial_index = instance.spatial_index_state()
+
+def _build_spatial_index(sender, instance, raw=False, **kwargs):
+    """post_save: build missing spatial indexes, in the background if Celery is enabled"""
+    if raw or instance.spatial_index != 'missing':
+        return
+    if not _delay('create_spatial_index', instance.pk):
+        OGRDataset.index(instance.pk)
+        instance.spatial_index = OGRDataset.objects.filter(pk=instance.pk).values_list('spatial_index', flat=True)[0]
+
+pre_save.connect(_check_spatial_index, sender=OGRDataset, dispatch_uid='ga_ows_spatial_index')
+post_save.connect(_build_spatial_index, sender=OGRDataset, dispatch_uid='ga_ows_spatial_index')
@@ -0,0 +1,112 @@
+"""
+Encoding of features as Mapbox Vector Tiles.  A tile is a bbox in some map projection divided into a grid of
+``extent`` x ``extent`` units.  Geometries are moved onto that grid, clipped to the tile plus a small buffer so that
+lines and polygon outlines don't show seams at tile edges, and snapped to whole grid units::
+
+    tile = TileEncoder((minx, miny, maxx, maxy), extent=4096, buffer=64)
+    tile.add_layer('roads', [(geometry, {'name' : name}, pk) for pk, name, geometry in rows])
+    data = tile.encode()
+
+Geometries may be Shapely or GeoDjango (GEOS) geometries, and must already be in the tile's projection.  Encoding
+requires the mapbox-vector-tile package.
+"""
+from datetime import date, datetime, time
+from decimal import Decimal
+
+try:
+    import mapbox_vector_tile
+    HAVE_MVT = True
+except ImportError:
+    HAVE_MVT = False
+
+from shapely import wkb
+from shapely.affinity import affine_transform
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+
+
+def _value(value):
+    """Coerce a property value to one of the types MVT can store, or None to leave the property out"""
+    if isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    elif value is None:
+        return None
+    else:
+        return unicode(value)
+
+
+class TileEncoder(object):
+    """Collects layers of features for one tile and encodes them as a Mapbox Vector Tile."""
+
+    def __init__(self, bbox, extent=4096, buffer=64):
+        """
+        :param bbox: The tile's bounds in its projection as (minx, miny, maxx, maxy)
+        :param extent: The number of grid units along each side of the tile.
+        :param buffer: How many grid units beyond the tile's edges geometries are kept.
+        """
+        minx, miny, maxx, maxy = bbox
+        self.extent = extent
+        sx = extent / float(maxx - minx)
+        sy = extent / float(maxy - miny)
+        # map coordinates to grid units with y pointing down, the way MVT lays out its grid
+        self.matrix = [sx, 0, 0, -sy, -minx * sx, maxy * sy]
+        self.clip = box(-buffer, -buffer, extent + buffer, extent + buffer)
+        self._prepared_clip = prep(self.clip)
+        self.layers = []
+
+    def geometry(self, geometry):
+        """Move a geometry onto the tile grid and clip it.  Returns None if nothing of it is left on the tile."""
+        if not isinstance(geometry, BaseGeometry):
+            geometry = wkb.loads(bytes(geometry.wkb))
+        geometry = affine_transform(geometry, self.matrix)
+        if not self._prepared_clip.intersects(geometry):
+            return None
+        if not self._prepared_clip.contains(geometry):
+            geometry = geometry.intersection(self.clip)
+        # vertices closer together than half a grid unit collapse onto the same point once quantized anyway
+        geometry = geometry.simplify(0.5)
+        if geometry.is_empty:
+            return None
+        return geometry
+
+    def add_layer(self, name, features):
+        """Add a layer to the tile.
+
+        :param name: The layer name clients style by.
+        :param features: An iterable of (geometry, properties) or (geometry, properties, id) tuples.
+        """
+        encoded = []
+        for feature in features:
+            geometry = feature[0]
+            if geometry is None:
+                continue
+            geometry = self.geometry(geometry)
+            if geometry is None:
+                continue
+            properties = {}
+            for key, value in feature[1].items():
+                value = _value(value)
+                if value is not None:
+                    properties[key] = value
+            record = { 'geometry' : geometry.wkb, 'properties' : properties }
+            if len(feature) > 2 and isinstance(feature[2], (int, long)):
+                record['id'] = feature[2]
+            encoded.append(record)
+        self.layers.append({ 'name' : name, 'features' : encoded })
+
+    def encode(self):
+        """Encode the tile.
+
+        :return: The tile as a protobuf byte string.
+        """
+        if not HAVE_MVT:
+            raise ImportError('Vector tiles require the mapbox-vector-tile package')
+        if 'default_options' in mapbox_vector_tile.encode.__code__.co_varnames:
+            # mapbox-vector-tile 2 takes its options as a dict
+            return mapbox_vector_tile.encode(self.layers, default_options={ 'y_coord_down' : True, 'extents' : self.extent })
+        return mapbox_vector_tile.encode(self.layers, y_coord_down=True, extents=self.extent)
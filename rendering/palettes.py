@@ -48,6 +48,12 @@ def rgbahex(color):
     return np.array((color,), dtype=np.uint32).view(dtype=np.uint8)
 
 
+def _bounded(values, l, r, include_left, include_right):
+    """Vectorized bounds test shared by ColorBin and LinearGradient"""
+    left = (values >= l) if include_left else (values > l)
+    right = (values <= r) if include_right else (values < r)
+    return left & right
+
 class NullColorEntry(object):
     """
     A palette entry that matches the null value.  Supports "in" syntax. All palette entries are callables and are generally used thusly::
@@ -69,6 +75,15 @@ class NullColorEntry(object):
     def __call__(self, v):
         return self.color
 
+    def mask(self, values):
+        if values.dtype == object:
+            return np.equal(values, None)
+        else:
+            return np.zeros(values.shape, dtype=bool)
+
+    def lookup(self, values):
+        return self.color.view(np.uint32)[0]
+
 class CatchAll(object):
     """A palette entry that matches any value"""
      
@@ -81,6 +96,12 @@ class CatchAll(object):
     def __call__(self, v):
         return self.color.view(np.uint32)[0]
 
+    def mask(self, values):
+        return np.ones(values.shape, dtype=bool)
+
+    def lookup(self, values):
+        return self.color.view(np.uint32)[0]
+
 class ColorBin(object):
     """
     A palette entry that presents a uniform color entry for any value between
@@ -105,6 +126,12 @@ class ColorBin(object):
     def __call__(self, v):
         return self.color
 
+    def mask(self, values):
+        return _bounded(values, self.l, self.r, self.include_left, self.include_right)
+
+    def lookup(self, values):
+        return self.color
+
 class LinearGradient(object):
     """
     A gradient palette entry between two floating point numbers.  This works
@@ -141,6 +168,14 @@ class LinearGradient(object):
         iv = int((va-self.l) * self.delta)
         return self.colors[iv,0]
 
+    def mask(self, values):
+        return _bounded(values, self.l, self.r, self.include_left, self.include_right)
+
+    def lookup(self, values):
+        iv = ((values-self.l) * self.delta).astype(np.intp)
+        np.clip(iv, 0, self.stops-1, out=iv)
+        return self.colors[iv,0]
+
 class Choices(object):
     """
     A stepped palette among logical choices, with the possibility of an "out of band" choice for None values.  
@@ -156,6 +191,15 @@ class Choices(object):
     def __call__(self, value):
         return self.choices(value)
 
+    def mask(self, values):
+        return np.in1d(values.ravel(), self.choices.keys()).reshape(values.shape)
+
+    def lookup(self, values):
+        ret = np.zeros(values.shape, dtype=np.uint32)
+        for choice, color in self.choices.items():
+            ret[values == choice] = color.view(np.uint32)[0]
+        return ret
+
 class Lambda(object):
     """An imputed gradient that maps from a function of keyword args to a null, 0.0 - 1.0 value"""
 
@@ -221,14 +265,36 @@ class Palette(object):
     Choices, and NullColorEntry.  Palettes can also take Lambda objects so long
     as the functions only expect one parameter.  A CatchAll, if provided,
     should always be the last object.
+
+    If every entry supports it (everything but Lambda does), the palette is
+    applied with whole-array operations, one entry at a time, instead of
+    calling the entries once per cell.  The result is an NxMx4 uint8 view of
+    a single buffer, which GetMap can encode without copying.
     """
 
     def __init__(self, *palette):
         """A behaviour that takes a single array and a palette and transfers to a colored array"""
+        self.bands = palette
+        self.vectorized = all(hasattr(band, 'mask') and hasattr(band, 'lookup') for band in palette)
         self.palette = np.vectorize(_Palette(*palette), otypes=[np.uint32])
 
+    def _apply(self, value):
+        ret = np.zeros(value.shape, dtype=np.uint32)
+        unassigned = np.ones(value.shape, dtype=bool)
+        for band in self.bands:
+            m = band.mask(value)
+            m &= unassigned
+            if m.any():
+                ret[m] = band.lookup(value[m])
+                unassigned &= ~m
+        return ret
+
     def __call__(self, value):
-        p = self.palette(value)
+        value = np.asarray(value)
+        if self.vectorized:
+            p = self._apply(value)
+        else:
+            p = self.palette(value)
         shape = value.shape + (4,)
         return p.view(dtype=np.uint8).reshape(*shape)
 
@@ -1,10 +1,23 @@
 """Parse SLD and make stylesheets from it"""
 import re
+import os
 import math
+import time
+import bisect
+import hashlib
+import threading
+import urllib2
+import urlparse
+from collections import OrderedDict
 from datetime import datetime
 import numpy as np
 import colorsys
 
+try:
+    from django.db.models import Q, F
+except ImportError:
+    Q = F = None
+
 SLD_NS = '{http://www.opengis.net/sld}'
 
 def _parseHexColor(value):
@@ -24,11 +37,48 @@ def _parseHexColor(value):
     return np.array((red,green,blue,alpha), dtype=np.float32)
 
 def _isHexColor(value):
-    return (len(value) == 7 or len(value) == 9) and value.startswith('#')
+    return isinstance(value, basestring) and (len(value) == 7 or len(value) == 9) and value.startswith('#')
+
+def _coerce(k):
+    """Coerce a property value the way property accessors do: ints become floats and hex strings become colors"""
+    k = float(k) if isinstance(k, int) else k
+    k = _parseHexColor(k) if _isHexColor(k) else k
+    return k
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+#: The size of a "standardized rendering pixel" in meters.  SLD scale denominators are defined in terms of it.
+STANDARD_PIXEL_SIZE = 0.00028
+
+def scale_denominator(pxsize, meters_per_unit=1.0):
+    """The SLD scale denominator of a pixel size in map units"""
+    return pxsize * meters_per_unit / STANDARD_PIXEL_SIZE
+
+def pixel_size(scale_denominator, meters_per_unit=1.0):
+    """The pixel size in map units of an SLD scale denominator"""
+    return scale_denominator * STANDARD_PIXEL_SIZE / meters_per_unit
+
+def fields(expr):
+    """The set of property names an expression reads"""
+    if isinstance(expr, PA):
+        return set([expr.field])
+    ret = set()
+    for value in vars(expr).values():
+        if isinstance(value, (list, tuple)):
+            for e in value:
+                if type(e).__module__ == __name__:
+                    ret |= fields(e)
+        elif type(value).__module__ == __name__:
+            ret |= fields(value)
+    return ret
 
 
 class Rule(object):
-    """Represents an SLD rule"""
+    """Represents an SLD rule.  min_scale and max_scale bound the pixel size, in meters, at which the rule applies.  The
+    parser derives them from Min- and MaxScaleDenominator.
+    """
     def __init__(self):
         self.min_scale = None
         self.max_scale = None
@@ -40,12 +90,80 @@ class Rule(object):
         self.text_symbolizer = None
 
     def __call__(self, data, pxsize):
-        if (not self.min_scale or pxsize > self.min_scale) and (not self.max_scale or pxsize < self.max_scale):
+        if self.active(pxsize):
             return self.test(data)
 
+    def active(self, pxsize):
+        return (not self.min_scale or pxsize >= self.min_scale) and (not self.max_scale or pxsize < self.max_scale)
+
+    @property
+    def required_fields(self):
+        ret = set()
+        for clause in self.clauses:
+            ret |= fields(clause)
+        return ret
+
     def test(self, data):
         return all(clause(data) for clause in self.clauses)
 
+    def compiled(self, vectorized=False):
+        """The rule compiled into a single function.  See :func:`compile_rule`.  Compiled rules are kept on the rule."""
+        if not hasattr(self, '_compiled'):
+            self._compiled = {}
+        if vectorized not in self._compiled:
+            self._compiled[vectorized] = compile_rule(self, vectorized=vectorized)
+        return self._compiled[vectorized]
+
+
+class RuleSet(list):
+    """A list of rules indexed by the range of pixel sizes, in meters, each one is active in.  The boundaries of all the rules'
+    scale ranges split the pixel sizes into intervals, and the rules active in each interval are worked out once, so
+    finding the rules for a render is a binary search::
+
+        rules = SLDParser()(sld)
+        for rule in rules.active(pxsize):
+            ...
+    """
+    def __init__(self, rules=()):
+        super(RuleSet, self).__init__(rules)
+        self._index = None
+
+    def _build_index(self):
+        boundaries = sorted(set(
+            [rule.min_scale for rule in self if rule.min_scale] +
+            [rule.max_scale for rule in self if rule.max_scale]
+        ))
+        # intervals[0] is below the first boundary; intervals[k] runs from boundaries[k-1] up to boundaries[k]
+        representatives = [boundaries[0] / 2.0] + boundaries if boundaries else [1.0]
+        intervals = [tuple(rule for rule in self if rule.active(px)) for px in representatives]
+        self._index = (boundaries, intervals)
+        return self._index
+
+    def active(self, pxsize):
+        """The rules active at a pixel size, in document order"""
+        boundaries, intervals = self._index or self._build_index()
+        return intervals[bisect.bisect_right(boundaries, pxsize)]
+
+    def required_fields(self, pxsize):
+        """The fields read by the rules active at a pixel size"""
+        ret = set()
+        for rule in self.active(pxsize):
+            ret |= rule.required_fields
+        return ret
+
+    def append(self, rule):
+        super(RuleSet, self).append(rule)
+        self._index = None
+
+    def extend(self, rules):
+        super(RuleSet, self).extend(rules)
+        self._index = None
+
+    def reindex(self):
+        """Rebuild the index.  Only needed after changing the list other than by append or extend, or after changing
+        the scale range of a rule in it."""
+        self._index = None
+
 ######### data accessors and literals ####################
 
 class PA(object):
@@ -61,11 +179,8 @@ class PA(object):
     def __init__(self, field):
         self.field = field
 
-    def call(self, data):
-        k = data[self.field]
-        k = float(k) if isinstance(k, int) else k
-        k = _parseHexColor(k) if _isHexColor(k) else k
-        return k
+    def __call__(self, data):
+        return _coerce(data[self.field])
 
 class L(object):
     """Represents a literal"""
@@ -83,7 +198,7 @@ class L(object):
             self.value = float(value)
         except:
             self.value = value
-        self.value = _parseHexColor(value) if _isHexColor(value) else value
+        self.value = _parseHexColor(value) if _isHexColor(value) else self.value
 
     def __call__(self, data):
         return self.value
@@ -160,23 +275,34 @@ class Btw(object):
 
     def __call__(self, data):
         v = self.e(data)
-        return v <= self.r(data) and v >= self.e(data)
+        return v <= self.r(data) and v >= self.l(data)
 
 class Like(object):
-    def __init__(self, e, value):
+    def __init__(self, e, value, wild_card='%', single_char='_', escape='\\'):
         self.e = e
         self.value = value
+        self.wild_card = wild_card
+        self.single_char = single_char
+        self.escape = escape
+
+        pattern = []
+        escaped = False
+        for c in value:
+            if escaped:
+                pattern.append(re.escape(c))
+                escaped = False
+            elif c == escape:
+                escaped = True
+            elif c == wild_card:
+                pattern.append('.*')
+            elif c == single_char:
+                pattern.append('.')
+            else:
+                pattern.append(re.escape(c))
+        self.regex = re.compile(''.join(pattern) + '$', re.DOTALL)
 
     def __call__(self, data):
-        v = self.e(data)
-        if self.value.startswith('%') and self.value.endswith('%'):
-            return self.value in v
-        elif self.value.startswith('%'):
-            return v.endswith(self.value)
-        elif self.value.endswith('%'):
-            return v.startswith(self.value)
-        else:
-            return re.match(self.value, v)
+        return self.regex.match(self.e(data)) is not None
 
 class In(object):
     def __init__(self, e, *args):
@@ -261,7 +387,7 @@ class Add(object):
         self.rest = args
 
     def __call__(self, data):
-        reduce(float.__add__, (exp(data) for exp in self.rest), self.exp1(data) + self.exp2(data))
+        return reduce(float.__add__, (exp(data) for exp in self.rest), self.exp1(data) + self.exp2(data))
 
 class Subtract(object):
     def __init__(self, exp1, exp2, *args):
@@ -270,7 +396,7 @@ class Subtract(object):
         self.rest = args
 
     def __call__(self, data):
-        reduce(float.__sub__, (exp(data) for exp in self.rest), self.exp1(data) - self.exp2(data))
+        return reduce(float.__sub__, (exp(data) for exp in self.rest), self.exp1(data) - self.exp2(data))
 
 class Multiply(object):
     def __init__(self, exp1, exp2, *args):
@@ -279,7 +405,7 @@ class Multiply(object):
         self.rest = args
 
     def __call__(self, data):
-        reduce(float.__mul__, (exp(data) for exp in self.rest), self.exp1(data) * self.exp2(data))
+        return reduce(float.__mul__, (exp(data) for exp in self.rest), self.exp1(data) * self.exp2(data))
 
 class Divide(object):
     def __init__(self, exp1, exp2, *args):
@@ -288,7 +414,7 @@ class Divide(object):
         self.rest = args
 
     def __call__(self, data):
-        reduce(float.__div__, (exp(data) for exp in self.rest), self.exp1(data) / self.exp2(data))
+        return reduce(float.__div__, (exp(data) for exp in self.rest), self.exp1(data) / self.exp2(data))
 
 class Abs(object):
     def __init__(self, e):
@@ -324,7 +450,7 @@ class Tan(object):
         self.e = e
 
     def __call__(self, data):
-        return math.sin(self.e(data))
+        return math.tan(self.e(data))
 
 class Asin(object):
     def __init__(self, e):
@@ -426,6 +552,13 @@ class Atan2(object):
     def __call__(self, data):
         return math.atan2(self.e1(data), self.e2(data))
 
+ARITHMETIC_OPERATORS = {
+    SLD_NS + "Add" : Add,
+    SLD_NS + "Sub" : Subtract,
+    SLD_NS + "Mul" : Multiply,
+    SLD_NS + "Div" : Divide,
+}
+
 MATH_FUNCTIONS = {
     SLD_NS + "abs" : Abs,
     SLD_NS + "acos" : Acos,
@@ -732,6 +865,410 @@ FUNCTIONS = {
     SLD_NS + "recode" : Recode,
 }
 
+
+############# Compilation ##############################################################################################
+#
+# Evaluating a rule by walking its tree costs a method call per node per feature.  compile_rule() and
+# compile_expression() generate the source of a single function for a tree instead, so a rule is one call per feature.
+# The vectorized variants generate numpy code that evaluates a rule over a whole batch of features at once, given a
+# dict of column arrays ({ 'pop' : array([...]), 'name' : array([...]) }), and return a boolean mask.  Nodes that have
+# no template are bound into the generated function and called as they are, so anything that parses also compiles.
+
+def _isnull(column):
+    if column.dtype == object:
+        return np.equal(column, None)
+    elif column.dtype.kind == 'f':
+        return np.isnan(column)
+    else:
+        return np.zeros(column.shape, dtype=bool)
+
+def _isin(column, values):
+    return np.in1d(column, values).reshape(column.shape)
+
+def _length(data):
+    for column in data.values():
+        return len(column)
+    return 0
+
+def _rows(data):
+    keys = data.keys()
+    for values in zip(*[data[k] for k in keys]):
+        yield dict(zip(keys, values))
+
+def _rowwise(node, data):
+    return np.array([node(row) for row in _rows(data)])
+
+def _unary(fn):
+    return lambda c, n: '%s(%s)' % (fn, c(n.e))
+
+def _binary(fn):
+    return lambda c, n: '%s(%s, %s)' % (fn, c(n.e1), c(n.e2))
+
+def _infix(op):
+    return lambda c, n: '(%s %s %s)' % (c(n.e1), op, c(n.e2))
+
+def _chain(op):
+    return lambda c, n: '(%s)' % (' %s ' % op).join(c(e) for e in (n.exp1, n.exp2) + tuple(n.rest))
+
+def _conjunction(op):
+    return lambda c, n: '(%s)' % (' %s ' % op).join(c(e) for e in n.es) if n.es else None
+
+_COMMON_TEMPLATES = {
+    L : lambda c, n: c.const(n.value),
+    Gt : _infix('>'),
+    Ge : _infix('>='),
+    Lt : _infix('<'),
+    Le : _infix('<='),
+    Eq : _infix('=='),
+    Ne : _infix('!='),
+    Add : _chain('+'),
+    Subtract : _chain('-'),
+    Multiply : _chain('*'),
+}
+
+_PYTHON_TEMPLATES = dict(_COMMON_TEMPLATES)
+_PYTHON_TEMPLATES.update({
+    # the interpreted Divide divides floats, so integer literals mustn't floor-divide here either
+    Divide : lambda c, n: '(float(%s) / %s)' % (c(n.exp1), ' / '.join(c(e) for e in (n.exp2,) + tuple(n.rest))),
+    PA : lambda c, n: '_coerce(data[%r])' % n.field,
+    Null : lambda c, n: '(%s is None)' % c(n.e1),
+    Btw : lambda c, n: '(%s <= %s <= %s)' % (c(n.l), c(n.e), c(n.r)),
+    Like : lambda c, n: '(%s.match(%s) is not None)' % (c.const(n.regex), c(n.e)),
+    In : lambda c, n: '(%s in (%s,))' % (c(n.e), ', '.join(c(v) for v in n.values)),
+    NotIn : lambda c, n: '(%s not in (%s,))' % (c(n.e), ', '.join(c(v) for v in n.values)),
+    IfThenElse : lambda c, n: '(%s if %s else %s)' % (c(n.t), c(n.c), c(n.f)),
+    And : _conjunction('and'),
+    Or : _conjunction('or'),
+    Not : lambda c, n: '(not %s)' % c(n.e),
+    Abs : _unary('abs'),
+    Sin : _unary('math.sin'),
+    Cos : _unary('math.cos'),
+    Tan : _unary('math.tan'),
+    Asin : _unary('math.asin'),
+    Acos : _unary('math.acos'),
+    Atan : _unary('math.atan'),
+    Ceil : _unary('math.ceil'),
+    Floor : _unary('math.floor'),
+    Round : _unary('round'),
+    Log10 : _unary('math.log10'),
+    Ln : _unary('math.log'),
+    Exp : _unary('math.exp'),
+    Deg : _unary('math.degrees'),
+    Rad : _unary('math.radians'),
+    Sqrt : _unary('math.sqrt'),
+    Pow : _binary('math.pow'),
+    Atan2 : _binary('math.atan2'),
+})
+
+_NUMPY_TEMPLATES = dict(_COMMON_TEMPLATES)
+_NUMPY_TEMPLATES.update({
+    Divide : lambda c, n: reduce(lambda a, e: 'np.true_divide(%s, %s)' % (a, c(e)), (n.exp2,) + tuple(n.rest), c(n.exp1)),
+    PA : lambda c, n: 'data[%r]' % n.field,
+    Null : lambda c, n: '_isnull(%s)' % c(n.e1),
+    Btw : lambda c, n: '((%s >= %s) & (%s <= %s))' % (c(n.e), c(n.l), c(n.e), c(n.r)),
+    In : lambda c, n: '_isin(%s, [%s])' % (c(n.e), ', '.join(c(v) for v in n.values)),
+    NotIn : lambda c, n: '(~_isin(%s, [%s]))' % (c(n.e), ', '.join(c(v) for v in n.values)),
+    IfThenElse : lambda c, n: 'np.where(%s, %s, %s)' % (c(n.c), c(n.t), c(n.f)),
+    And : _conjunction('&'),
+    Or : _conjunction('|'),
+    Not : lambda c, n: 'np.logical_not(%s)' % c(n.e),
+    Abs : _unary('np.abs'),
+    Sin : _unary('np.sin'),
+    Cos : _unary('np.cos'),
+    Tan : _unary('np.tan'),
+    Asin : _unary('np.arcsin'),
+    Acos : _unary('np.arccos'),
+    Atan : _unary('np.arctan'),
+    Ceil : _unary('np.ceil'),
+    Floor : _unary('np.floor'),
+    Round : _unary('np.round'),
+    Log10 : _unary('np.log10'),
+    Ln : _unary('np.log'),
+    Exp : _unary('np.exp'),
+    Deg : _unary('np.degrees'),
+    Rad : _unary('np.radians'),
+    Sqrt : _unary('np.sqrt'),
+    Pow : _binary('np.power'),
+    Atan2 : _binary('np.arctan2'),
+})
+
+class _Compiler(object):
+    """Generates the source of an expression tree and collects the constants it refers to"""
+
+    def __init__(self, vectorized=False):
+        self.vectorized = vectorized
+        self.templates = _NUMPY_TEMPLATES if vectorized else _PYTHON_TEMPLATES
+        self.env = {
+            'math' : math,
+            'np' : np,
+            '_coerce' : _coerce,
+            '_isnull' : _isnull,
+            '_isin' : _isin,
+            '_length' : _length,
+            '_rowwise' : _rowwise,
+        }
+
+    def const(self, value):
+        name = '_c%d' % len(self.env)
+        self.env[name] = value
+        return name
+
+    def __call__(self, node):
+        template = self.templates.get(type(node))
+        source = template(self, node) if template else None
+        if source is not None:
+            return source
+        elif self.vectorized:
+            return '_rowwise(%s, data)' % self.const(node)
+        else:
+            return '%s(data)' % self.const(node)
+
+    def function(self, name, source, filename='<sld>'):
+        exec compile(source, filename, 'exec') in self.env
+        return self.env[name]
+
+
+def compile_expression(expression, vectorized=False):
+    """Compile an expression tree into a single function of a data record (or, if vectorized, of a dict of columns).
+
+    :param expression: Any expression node in this module, such as a Gt, And, PA, or Interpolate.
+    :param vectorized: If true, generate numpy code that evaluates the expression over column arrays.
+    :return: A function of one argument, data.
+    """
+    c = _Compiler(vectorized)
+    body = c(expression)
+    return c.function('_expression', 'def _expression(data):\n    return %s\n' % body)
+
+
+def compile_rule(rule, vectorized=False):
+    """Compile a rule's scale test and all its clauses into a single function of (data, pxsize).  The function returns
+    the same thing as calling the rule itself: None if the rule is out of scale and otherwise whether every clause
+    holds.  Vectorized rules return a boolean mask instead, which is all False if the rule is out of scale.
+
+    :param rule: A :class:`Rule`
+    :param vectorized: If true, generate numpy code that evaluates the rule over a dict of column arrays.
+    :return: A function of two arguments, data and pxsize.
+    """
+    c = _Compiler(vectorized)
+    clauses = [c(clause) for clause in rule.clauses]
+    if vectorized:
+        body = ' & '.join(clauses) if clauses else 'np.ones(_length(data), dtype=bool)'
+        out_of_scale = 'np.zeros(_length(data), dtype=bool)'
+        if len(clauses) == 1:
+            body = 'np.asarray(%s, dtype=bool)' % body
+    else:
+        body = ' and '.join(clauses) if clauses else 'True'
+        out_of_scale = 'None'
+
+    scale_tests = []
+    if rule.min_scale:
+        scale_tests.append('pxsize < %s' % c.const(rule.min_scale))
+    if rule.max_scale:
+        scale_tests.append('pxsize >= %s' % c.const(rule.max_scale))
+
+    source = ['def _rule(data, pxsize):']
+    if scale_tests:
+        source.append('    if %s:' % ' or '.join(scale_tests))
+        source.append('        return %s' % out_of_scale)
+    source.append('    return bool(%s)' % body if not vectorized else '    return %s' % body)
+    return c.function('_rule', '\n'.join(source) + '\n')
+
+
+######### Filter push-down ####################################
+#
+# Rules are evaluated in Python after a feature has been fetched.  When a style's rules can only ever draw a subset of
+# features, that subset can be selected by the data source instead.  These translators turn filter trees into Django
+# Q objects and OGR SQL WHERE clauses.  Anything they don't understand raises NotTranslatable, and the caller falls back
+# to fetching everything and letting the rules sort it out.
+
+class NotTranslatable(Exception):
+    """Raised when a filter expression has no equivalent in the target query language"""
+
+
+_FLIPPED = { Gt : Lt, Ge : Le, Lt : Gt, Le : Ge, Eq : Eq, Ne : Ne }
+_LOOKUPS = { Gt : 'gt', Ge : 'gte', Lt : 'lt', Le : 'lte', Eq : 'exact', Ne : 'exact' }
+_SQL_OPERATORS = { Gt : '>', Ge : '>=', Lt : '<', Le : '<=', Eq : '=', Ne : '<>' }
+_SQL_ARITHMETIC = { Add : '+', Subtract : '-', Multiply : '*', Divide : '/' }
+
+
+def _literal(e):
+    if not isinstance(e, L) or isinstance(e.value, np.ndarray):
+        raise NotTranslatable(e)
+    return e.value
+
+def _property_and_literal(expr):
+    """Normalize a binary comparison to (operator class, property name, literal), flipping it if the literal is first"""
+    op = type(expr)
+    if isinstance(expr.e1, PA):
+        return op, expr.e1.field, expr.e2
+    elif isinstance(expr.e2, PA):
+        return _FLIPPED[op], expr.e2.field, expr.e1
+    raise NotTranslatable(expr)
+
+def _like_parts(like):
+    """Split a Like pattern into a list of ('wild', None), ('single', None) and ('text', str) tokens"""
+    parts = []
+    escaped = False
+    for c in like.value:
+        if escaped:
+            parts.append(('text', c))
+            escaped = False
+        elif c == like.escape:
+            escaped = True
+        elif c == like.wild_card:
+            parts.append(('wild', None))
+        elif c == like.single_char:
+            parts.append(('single', None))
+        else:
+            parts.append(('text', c))
+    return parts
+
+def to_q(expr):
+    """Translate a filter expression into a Django Q object::
+
+        qs = Model.objects.filter(to_q(rule.clauses[0]))
+
+    :param expr: A filter expression built by :class:`SLDParser`
+    :return: A django.db.models.Q
+    :raises NotTranslatable: if any part of the expression has no ORM equivalent
+    """
+    if Q is None:
+        raise NotTranslatable(expr)
+
+    op = type(expr)
+    if op is And or op is Or:
+        qs = [to_q(e) for e in expr.es]
+        return reduce(lambda a, b: (a & b) if op is And else (a | b), qs)
+    elif op is Not:
+        return ~to_q(expr.e)
+    elif op in _LOOKUPS:
+        op, field, other = _property_and_literal(expr)
+        value = F(other.field) if isinstance(other, PA) else _literal(other)
+        q = Q(**{ field + '__' + _LOOKUPS[op] : value })
+        return ~q if op is Ne else q
+    elif op is Null and isinstance(expr.e1, PA):
+        return Q(**{ expr.e1.field + '__isnull' : True })
+    elif op is Btw and isinstance(expr.e, PA):
+        return Q(**{ expr.e.field + '__range' : (_literal(expr.l), _literal(expr.r)) })
+    elif (op is In or op is NotIn) and isinstance(expr.e, PA):
+        q = Q(**{ expr.e.field + '__in' : [_literal(v) for v in expr.values] })
+        return ~q if op is NotIn else q
+    elif op is Like and isinstance(expr.e, PA):
+        parts = _like_parts(expr)
+        kinds = [kind for kind, _ in parts]
+        text = ''.join(c for kind, c in parts if kind == 'text')
+        if 'single' not in kinds and 'wild' not in kinds[1:-1]:
+            starts, ends = kinds[:1] == ['wild'], kinds[-1:] == ['wild']
+            lookup = 'contains' if starts and ends else 'endswith' if starts else 'startswith' if ends else 'exact'
+        else:
+            lookup = 'regex'
+            text = '^' + ''.join('.*' if kind == 'wild' else '.' if kind == 'single' else re.escape(c) for kind, c in parts) + '$'
+        return Q(**{ expr.e.field + '__' + lookup : text })
+    raise NotTranslatable(expr)
+
+def _sql_literal(value):
+    if isinstance(value, basestring):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+def _sql_expression(e):
+    if isinstance(e, PA):
+        return '"' + e.field.replace('"', '""') + '"'
+    elif isinstance(e, L):
+        return _sql_literal(_literal(e))
+    elif type(e) in _SQL_ARITHMETIC:
+        operands = [e.exp1, e.exp2] + list(e.rest)
+        return '(' + (' ' + _SQL_ARITHMETIC[type(e)] + ' ').join(_sql_expression(x) for x in operands) + ')'
+    raise NotTranslatable(e)
+
+def _sql_properties(e):
+    """The quoted names of the properties an expression reads, in the order they first appear"""
+    if isinstance(e, PA):
+        return [_sql_expression(e)]
+    children = []
+    for name in ('e', 'e1', 'e2', 'l', 'r', 'exp1', 'exp2'):
+        if hasattr(e, name):
+            children.append(getattr(e, name))
+    for name in ('es', 'values', 'rest'):
+        children.extend(getattr(e, name, ()))
+    names = []
+    for child in children:
+        names.extend(n for n in _sql_properties(child) if n not in names)
+    return names
+
+def _or_null(clause, expr):
+    """A clause that is also true where a property of expr is NULL.  SQL's three-valued logic drops those rows from
+    negations, but the rules evaluated in Python keep them, since None != 1 and None not in (1, 2)."""
+    names = _sql_properties(expr)
+    if not names:
+        return clause
+    return '(' + clause + ''.join(' OR ' + name + ' IS NULL' for name in names) + ')'
+
+def to_ogr_sql(expr):
+    """Translate a filter expression into an OGR SQL WHERE clause for ogr.Layer.SetAttributeFilter::
+
+        layer.SetAttributeFilter(to_ogr_sql(rule.clauses[0]))
+
+    :param expr: A filter expression built by :class:`SLDParser`
+    :return: A string
+    :raises NotTranslatable: if any part of the expression has no OGR SQL equivalent
+    """
+    op = type(expr)
+    if op is And or op is Or:
+        return '(' + (' AND ' if op is And else ' OR ').join(to_ogr_sql(e) for e in expr.es) + ')'
+    elif op is Not and type(expr.e) is Null:
+        return '(' + _sql_expression(expr.e.e1) + ' IS NOT NULL)'
+    elif op is Not:
+        return _or_null('(NOT ' + to_ogr_sql(expr.e) + ')', expr.e)
+    elif op in _SQL_OPERATORS:
+        clause = '(' + _sql_expression(expr.e1) + ' ' + _SQL_OPERATORS[op] + ' ' + _sql_expression(expr.e2) + ')'
+        return _or_null(clause, expr) if op is Ne else clause
+    elif op is Null:
+        return '(' + _sql_expression(expr.e1) + ' IS NULL)'
+    elif op is Btw:
+        return '(' + _sql_expression(expr.e) + ' BETWEEN ' + _sql_expression(expr.l) + ' AND ' + _sql_expression(expr.r) + ')'
+    elif op is In or op is NotIn:
+        clause = '(' + _sql_expression(expr.e) + (' NOT IN (' if op is NotIn else ' IN (') + ', '.join(_sql_expression(v) for v in expr.values) + '))'
+        return _or_null(clause, expr) if op is NotIn else clause
+    elif op is Like:
+        pattern = []
+        for kind, c in _like_parts(expr):
+            if kind == 'wild':
+                pattern.append('%')
+            elif kind == 'single':
+                pattern.append('_')
+            elif c in '%_\\':
+                pattern.append('\\' + c)
+            else:
+                pattern.append(c)
+        pattern = ''.join(pattern)
+        return '(' + _sql_expression(expr.e) + ' LIKE ' + _sql_literal(pattern) + (" ESCAPE '\\')" if '\\' in pattern else ')')
+    raise NotTranslatable(expr)
+
+def rules_filter(rules, translate=to_q):
+    """Build a single filter that selects every feature that at least one of the rules could draw.
+
+    :param rules: A list of :class:`Rule`
+    :param translate: :func:`to_q` or :func:`to_ogr_sql`
+    :return: A Q object or SQL string, or None if the rules can't be pushed down and every feature must be fetched.
+    """
+    alternatives = []
+    for rule in rules:
+        if not rule.clauses:
+            return None
+        try:
+            alternatives.append([translate(clause) for clause in rule.clauses])
+        except NotTranslatable:
+            return None
+    if not alternatives:
+        return None
+
+    if translate is to_ogr_sql:
+        return ' OR '.join('(' + ' AND '.join(clauses) + ')' for clauses in alternatives)
+    else:
+        return reduce(lambda a, b: a | b, (reduce(lambda a, b: a & b, clauses) for clauses in alternatives))
+
+
 from lxml import etree
 from cStringIO import StringIO
 
@@ -837,38 +1374,50 @@ TEST_SLD="""<?xml version="1.0" encoding="ISO-8859-1"?>
 """
 
 class SLDParser(object):
+    """Parses an SLD document into a :class:`RuleSet`, with one :class:`Rule` per Rule element, in document order.  Filters
+    are parsed into trees of the expression classes in this module::
+
+        rules = SLDParser()(sld_text)
+        visible = [rule for rule in rules if rule(record, pxsize)]
+    """
 
     def __init__(self, stylesheet=None):
         self.stylesheet=stylesheet
+        self.rules = RuleSet()
 
     def __call__(self, sld):
         parser = etree.XMLParser(ns_clean=True)
-        xml = etree.fromstring(StringIO(sld), parser)
-        self.parse_FeatureTypeStyle(xml)
+        xml = etree.parse(StringIO(sld), parser).getroot()
+        self.rules = RuleSet()
+        if xml.tag.endswith('}FeatureTypeStyle'):
+            self.parse_FeatureTypeStyle(xml)
+        else:
+            self.parse_StyledLayerDescriptor(xml)
+        return self.rules
 
     def parse_StyledLayerDescriptor(self, styled_layer_descriptor):
-        for child in styled_layer_descriptor.iterchildren():
+        for child in styled_layer_descriptor.iterchildren(tag=etree.Element):
             if child.tag.endswith('}NamedLayer'):
                 self.parse_NamedLayer(child)
 
     def parse_NamedLayer(self, named_layer):
-        for child in named_layer.iterchildren():
+        for child in named_layer.iterchildren(tag=etree.Element):
             if child.tag.endswith('}UserStyle'):
                 self.parse_UserStyle(child)
 
     def parse_UserStyle(self, user_style):
-        for child in user_style.iterchildren():
+        for child in user_style.iterchildren(tag=etree.Element):
             if child.tag.endswith('}FeatureTypeStyle'):
                 self.parse_FeatureTypeStyle(child)
 
     def parse_FeatureTypeStyle(self, feature_type_style):
-        for child in feature_type_style.iterchildren():
+        for child in feature_type_style.iterchildren(tag=etree.Element):
             if child.tag.endswith('}Rule'):
                 self.parse_Rule(child)
 
     def parse_Rule(self, rule):
         working_rule = Rule()
-        for child in rule.iterchildren():
+        for child in rule.iterchildren(tag=etree.Element):
             if child.tag.endswith('}PointSymbolizer'):
                 self.parse_PointSymbolizer(working_rule, child)
             elif child.tag.endswith('}PolygonSymbolizer'):
@@ -880,14 +1429,57 @@ class SLDParser(object):
             elif child.tag.endswith('}TextSymbolizer'):
                 self.parse_TextSymbolizer(working_rule, child)
             elif child.tag.endswith('}MaxScaleDenominator'):
-                pass
+                working_rule.max_scale = pixel_size(float(child.text))
             elif child.tag.endswith('}MinScaleDenominator'):
-                pass
+                working_rule.min_scale = pixel_size(float(child.text))
             elif child.tag.endswith('}Filter'):
                 self.parse_Filter(working_rule, child)
+        self.rules.append(working_rule)
+        return working_rule
 
     def parse_Filter(self, working_rule, filter):
-        pass
+        for child in filter.iterchildren(tag=etree.Element):
+            working_rule.clauses.append(self.parse_Predicate(working_rule, child))
+
+    def parse_Predicate(self, working_rule, predicate):
+        """Parse a comparison or logical operator into an expression tree"""
+        tag = SLD_NS + _localname(predicate.tag)
+        children = list(predicate.iterchildren(tag=etree.Element))
+
+        if tag in CONJUNCTION_OPERATORS:
+            return CONJUNCTION_OPERATORS[tag](*[self.parse_Predicate(working_rule, child) for child in children])
+        elif tag == SLD_NS + 'PropertyIsBetween':
+            e = self.parse_Expression(working_rule, children[0])
+            bounds = {}
+            for child in children[1:]:
+                bounds[_localname(child.tag)] = self.parse_Expression(working_rule, list(child.iterchildren(tag=etree.Element))[0])
+            return Btw(e, bounds['LowerBoundary'], bounds['UpperBoundary'])
+        elif tag == SLD_NS + 'PropertyIsLike':
+            return Like(
+                self.parse_Expression(working_rule, children[0]),
+                children[1].text or '',
+                wild_card=predicate.get('wildCard', '%'),
+                single_char=predicate.get('singleChar', '_'),
+                escape=predicate.get('escape', predicate.get('escapeChar', '\\'))
+            )
+        elif tag in COMPARISON_OPERATORS:
+            return COMPARISON_OPERATORS[tag](*[self.parse_Expression(working_rule, child) for child in children])
+        else:
+            return self.parse_Expression(working_rule, predicate)
+
+    def parse_Expression(self, working_rule, expression):
+        """Parse a property name, literal, arithmetic operator or function into an expression tree"""
+        tag = SLD_NS + _localname(expression.tag)
+        if tag in DATA_ACCESSORS:
+            return DATA_ACCESSORS[tag]((expression.text or '').strip())
+        elif tag in ARITHMETIC_OPERATORS:
+            return ARITHMETIC_OPERATORS[tag](*[self.parse_Expression(working_rule, child) for child in expression.iterchildren(tag=etree.Element)])
+        elif tag.endswith('}Function'):
+            return self.parse_Function(working_rule, expression)
+        elif tag in CONJUNCTION_OPERATORS or tag in COMPARISON_OPERATORS:
+            return self.parse_Predicate(working_rule, expression)
+        else:
+            raise NotImplementedError('SLD element {tag} is not supported'.format(tag=_localname(expression.tag)))
 
     def parse_PointSymbolizer(self, working_rule, point_symbolizer):
         pass
@@ -905,10 +1497,156 @@ class SLDParser(object):
         pass
 
     def parse_FilterFunction(self,working_rule,  filter_function):
-        pass
+        return self.parse_Function(working_rule, filter_function)
 
     def parse_Function(self, working_rule, function):
-        pass
-
-
+        name = function.get('name')
+        args = [self.parse_Expression(working_rule, child) for child in function.iterchildren(tag=etree.Element)]
+        for functions, key in ((FUNCTIONS, SLD_NS + name), (MATH_FUNCTIONS, SLD_NS + name), (STRING_FUNCTIONS, name), (PARSING_FUNCTIONS, name)):
+            if key in functions:
+                return functions[key](*args)
+        raise NotImplementedError('SLD function {name} is not supported'.format(name=name))
+
+
+def sld_digest(sld):
+    """The key of an SLD document in :class:`SLDCache`"""
+    if isinstance(sld, unicode):
+        sld = sld.encode('utf-8')
+    return hashlib.sha1(sld).hexdigest()
+
+
+class ForbiddenURL(ValueError):
+    """Raised when an SLD URL isn't http or https or points at a host that isn't in the allowed hosts"""
+
+
+def _check_url(url, allowed_hosts):
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme not in ('http', 'https'):
+        raise ForbiddenURL('SLDs can only be fetched over http or https')
+    if '*' not in allowed_hosts and (parsed.hostname or '').lower() not in allowed_hosts:
+        raise ForbiddenURL('SLDs cannot be fetched from ' + (parsed.hostname or url))
+
+
+class _CheckedRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Follows a redirect only if its target would have been allowed in the first place"""
+    def __init__(self, allowed_hosts):
+        self.allowed_hosts = allowed_hosts
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl, self.allowed_hosts)
+        return urllib2.HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+
+
+class SLDCache(object):
+    """A bounded LRU of parsed and compiled SLD documents, keyed by the SHA-1 of the document, so that requests that carry
+    the same SLD_BODY or point at the same SLD skip parsing and rule compilation::
+
+        rules = sld_cache.parse(request_sld_body)
+        rules = sld_cache.parse_file('/etc/styles/roads.sld')     # re-read only when the file changes
+        rules = sld_cache.parse_url('http://example.com/roads.sld')
+
+    URLs are fetched only over http or https and only from the hosts in ``settings.GA_OWS_SLD_ALLOWED_HOSTS``, a list
+    of host names in which ``'*'`` allows every host.  Without the setting, no URL is fetched.
+
+    The cached :class:`RuleSet` objects are shared between requests and threads and must not be modified.
+    """
+
+    def __init__(self, size=128, url_ttl=300, url_timeout=10, allowed_hosts=None):
+        """
+        :param size: The maximum number of parsed documents to keep, and of files and URLs to remember
+        :param url_ttl: The number of seconds a fetched URL is trusted before it is fetched again
+        :param url_timeout: The number of seconds to wait for a URL to respond
+        :param allowed_hosts: The hosts SLDs may be fetched from.  Defaults to settings.GA_OWS_SLD_ALLOWED_HOSTS.
+        """
+        self.size = size
+        self.url_ttl = url_ttl
+        self.url_timeout = url_timeout
+        self.allowed_hosts = allowed_hosts
+        self._lock = threading.Lock()
+        self._documents = OrderedDict()
+        self._files = OrderedDict()
+        self._urls = OrderedDict()
+
+    def _lookup(self, table, key):
+        with self._lock:
+            if key in table:
+                value = table.pop(key)
+                table[key] = value
+                return value
 
+    def _store(self, table, key, value):
+        with self._lock:
+            table.pop(key, None)
+            table[key] = value
+            while len(table) > self.size:
+                table.popitem(last=False)
+
+    def _get(self, digest):
+        return self._lookup(self._documents, digest)
+
+    def _put(self, digest, rules):
+        self._store(self._documents, digest, rules)
+
+    def _allowed_hosts(self):
+        if self.allowed_hosts is not None:
+            return self.allowed_hosts
+        from django.conf import settings
+        return [host.lower() for host in getattr(settings, 'GA_OWS_SLD_ALLOWED_HOSTS', ())]
+
+    def parse(self, sld):
+        """Get the rules of an SLD document, parsing and compiling them if the document isn't cached."""
+        if isinstance(sld, unicode):
+            sld = sld.encode('utf-8')
+        digest = sld_digest(sld)
+        rules = self._get(digest)
+        if rules is None:
+            rules = SLDParser()(sld)
+            for rule in rules:
+                rule.compiled()
+            rules.active(0) # build the scale index before the rules are shared
+            self._put(digest, rules)
+        return rules
+
+    def parse_file(self, path):
+        """Get the rules of an SLD file.  The file is only read again when its modification time or size changes."""
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        known = self._lookup(self._files, path)
+        if known and known[0] == stamp:
+            rules = self._get(known[1])
+            if rules is not None:
+                return rules
+
+        with open(path) as f:
+            sld = f.read()
+        self._store(self._files, path, (stamp, sld_digest(sld)))
+        return self.parse(sld)
+
+    def parse_url(self, url):
+        """Get the rules of an SLD at a URL.  The URL is only fetched again after url_ttl seconds.
+
+        :raises ForbiddenURL: if the URL, or a redirect it leads to, isn't allowed.
+        """
+        allowed_hosts = self._allowed_hosts()
+        _check_url(url, allowed_hosts)
+        known = self._lookup(self._urls, url)
+        if known and known[0] > time.time():
+            rules = self._get(known[1])
+            if rules is not None:
+                return rules
+
+        opener = urllib2.build_opener(_CheckedRedirectHandler(allowed_hosts))
+        sld = opener.open(url, timeout=self.url_timeout).read()
+        self._store(self._urls, url, (time.time() + self.url_ttl, sld_digest(sld)))
+        return self.parse(sld)
+
+    def clear(self):
+        """Drop every cached document."""
+        with self._lock:
+            self._documents.clear()
+            self._files.clear()
+            self._urls.clear()
+
+
+#: The process-wide SLD cache.
+sld_cache = SLDCache()
@@ -1,4 +1,5 @@
 import numpy as np
+from ga_ows.rendering.sld import RuleSet
 
 def _parseHexColor(self, value):
     red = 0.0
@@ -92,6 +93,10 @@ class Stylesheet(object):
 
         Also, stylesheets can inherit by passing a 'parent' or 'parents' parameter' to the constructor with other stylesheet instances
 
+    A list of :class:`ga_ows.rendering.sld.Rule` may be passed as ``rules``.  The WMS adapters push the rules' filters
+    down to the database or OGR layer, so features that none of the rules select are never fetched.  Only the rules
+    active at the current scale are considered, and the fields read by inactive rules aren't fetched either.
+
     """
 
     FeatureProperties = frozenset([
@@ -134,10 +139,11 @@ class Stylesheet(object):
         return ss
 
 
-    def __init__(self, name=None, required_fields=tuple(), **options):
+    def __init__(self, name=None, required_fields=tuple(), rules=None, **options):
         """"""
 
         self.required_fields = required_fields
+        self.rules = RuleSet(rules) if rules is not None and not isinstance(rules, RuleSet) else rules
         self.name = name
 
         self._props = {
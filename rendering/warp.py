@@ -0,0 +1,126 @@
+"""
+Reprojection of rasters through cached warp plans.  Building a warp plan -- the coordinate transformer, its
+approximation grid, and the output grid -- costs far more than reading a few hundred pixels through it, and a tiled
+client asks for the same source, target projection, and resolution over and over.  :class:`WarpPlanCache` keeps
+in-memory warped VRTs for each combination of source file, source SRS, target SRS, and zoom level, so that repeated
+requests at the same zoom read straight through an existing plan::
+
+    plans = WarpPlanCache(size=32)
+    vrt = plans.warped('elevation', ds, mercator.ExportToWkt(), pixel_size=152.87)
+    data = vrt.GetRasterBand(1).ReadRaster(xoff, yoff, xsize, ysize, 256, 256)
+
+Zoom levels are powers of two of the pixel size, so the warped VRT is always at least as fine as the request.  The
+VRTs open their source files themselves rather than holding on to the dataset of the request that created them, and
+a plan is built again once its source file's modification time or size changes.  Datasets that aren't backed by a
+file get a new plan every time.
+"""
+from collections import OrderedDict
+import math
+import os
+import threading
+
+from osgeo import gdal
+
+
+class WarpPlanCache(object):
+    """A bounded LRU of warped VRT datasets.  GDAL datasets may not be shared between threads, so each thread keeps its
+    own LRU.
+    """
+
+    def __init__(self, size=64, error_threshold=0.125, resampling=gdal.GRA_NearestNeighbour):
+        """
+        :param size: The maximum number of warp plans each thread keeps.
+        :param error_threshold: The maximum error in pixels allowed for the approximate transformer.  0 uses the exact
+            transformer for every pixel.
+        :param resampling: A GDAL resampling algorithm (gdal.GRA_*)
+        """
+        self.size = size
+        self.error_threshold = error_threshold
+        self.resampling = resampling
+        self._local = threading.local()
+
+    @property
+    def _plans(self):
+        if not hasattr(self._local, 'plans'):
+            self._local.plans = OrderedDict()
+        return self._local.plans
+
+    @staticmethod
+    def zoom(pixel_size):
+        """The zoom level of a pixel size.  Pixel sizes that fall into the same power of two share a warp plan."""
+        if not pixel_size:
+            return None
+        return int(math.floor(math.log(pixel_size, 2)))
+
+    @staticmethod
+    def version(path):
+        """The modification time and size of a source file, or None if the path isn't a file GDAL can stat"""
+        if not path:
+            return None
+        if hasattr(gdal, 'VSIStatL'):
+            st = gdal.VSIStatL(path)
+            return (st.mtime, st.size) if st is not None else None
+        if os.path.isfile(path):
+            st = os.stat(path)
+            return (st.st_mtime, st.st_size)
+        return None
+
+    def warped(self, source, ds, t_srs, pixel_size=None):
+        """Get a warped VRT of a dataset in the target SRS, creating it if it isn't cached.
+
+        :param source: A name for the source dataset that is stable between requests, such as a coverage name or path.
+        :param ds: The source gdal.Dataset
+        :param t_srs: The target SRS as WKT
+        :param pixel_size: The requested pixel size in target SRS units, or None to let GDAL suggest a resolution.
+        :return: A gdal.Dataset
+        """
+        path = ds.GetDescription()
+        version = self.version(path)
+        s_srs = ds.GetProjection()
+        zoom = self.zoom(pixel_size)
+        if version is None:
+            # the plan can't reopen this dataset, so it's only good for as long as the caller holds on to ds
+            return self._create(ds, s_srs, t_srs, zoom)[0]
+        key = (source, path, version, s_srs, t_srs, zoom)
+
+        plans = self._plans
+        if key in plans:
+            plan = plans.pop(key)
+            plans[key] = plan
+            return plan[0]
+
+        # plans for an older version of the file won't be asked for again
+        for old in [k for k in plans if k[:2] == (source, path)]:
+            del plans[old]
+        plan = plans[key] = self._create(path, s_srs, t_srs, zoom)
+        while len(plans) > self.size:
+            plans.popitem(last=False)
+        return plan[0]
+
+    def _create(self, src, s_srs, t_srs, zoom):
+        """A warp plan for a source path or dataset, as (vrt, the source dataset the vrt needs kept open or None)"""
+        if hasattr(gdal, 'Warp'):
+            options = {
+                'format' : 'VRT',
+                'srcSRS' : s_srs,
+                'dstSRS' : t_srs,
+                'errorThreshold' : self.error_threshold,
+                'resampleAlg' : self.resampling,
+            }
+            if zoom is not None:
+                options['xRes'] = options['yRes'] = 2.0 ** zoom
+            # given a path, the VRT opens the source itself
+            return gdal.Warp('', src, **options), None
+        else:
+            # GDAL < 2.1 can only suggest the output resolution itself, and warps an open dataset
+            if isinstance(src, basestring):
+                src = gdal.Open(src)
+            return gdal.AutoCreateWarpedVRT(src, s_srs, t_srs, self.resampling, self.error_threshold), src
+
+    def clear(self):
+        """Drop this thread's warp plans."""
+        self._plans.clear()
+
+
+#: The process-wide warp plan cache.
+warp_plans = WarpPlanCache()
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
+from ga_ows.models.wms import LayerExtent, OGRDataset
 from ga_ows.views import common
-from celery.task import Task
+from ga_ows.views.wms.base import encode_array, get_driver
+from celery.task import Task, task
 from celery.task.sets import subtask
 from osgeo import gdal
 
@@ -12,10 +14,10 @@ except ImportError:
     have_cairo = False
 
 try:
-    import scipy
-    have_scipy = True
+    import numpy as np
+    have_numpy = True
 except ImportError:
-    have_scipy = False
+    have_numpy = False
 
 import tempfile
 
@@ -94,7 +96,9 @@ class DeferredRenderer(Task):
             time=parms['time'],
             elevation=parms['elevation'],
             v=parms['v'],
-            filter = filter
+            filter = filter,
+            sld = parms.get('sld'),
+            sld_body = parms.get('sld_body')
         )
 
         tmp = None
@@ -109,24 +113,18 @@ class DeferredRenderer(Task):
                 ret = ds
             elif isinstance(ds, StringIO):
                 ret = ds
-            elif have_scipy:
-                tmp = tempfile.NamedTemporaryFile(suffix='.tif')
-                scipy.misc.imsave(tmp.name, ds)
-                ds = gdal.Open(tmp.name)
-                # TODO add all the appropriate metadata from the request into the dataset if this == being returned as a GeoTIFF
+            elif have_numpy and isinstance(ds, np.ndarray):
+                ret = encode_array(ds, format)
+                if callback:
+                    subtask(callback).delay(ret, parms)
+                    return None
+                self.adapter.cache_result(ret, **parms)
+                return None if cache_only else ret
         
         if ret:
             return ret
 
-        if format == 'tiff' or format == 'geotiff':
-            driver = gdal.GetDriverByName('GTiff')
-        elif format == 'jpg' or format == 'jpeg':
-            driver = gdal.GetDriverByName('jpeg')
-        elif format == 'jp2k' or format == 'jpeg2000':
-            tmp = tempfile.NamedTemporaryFile(suffix='.jp2')
-            driver = gdal.GetDriverByName('jpeg2000')
-        else:
-            driver = gdal.GetDriverByName(format.encode('ascii'))
+        driver = get_driver(format)
         try:
             tmp = tempfile.NamedTemporaryFile(suffix='.' + format)
             ds2 = driver.CreateCopy(tmp.name, ds)
@@ -147,4 +145,13 @@ class DeferredRenderer(Task):
             raise common.NoApplicableCode(str(ex))
 
 
+@task(ignore_result=True)
+def recompute_extent(source, layer):
+    """Recompute a :class:`ga_ows.models.wms.LayerExtent` that may have shrunk"""
+    LayerExtent.recompute(source, layer)
+
 
+@task(ignore_result=True)
+def create_spatial_index(pk):
+    """Build the missing spatial indexes of a newly registered :class:`ga_ows.models.wms.OGRDataset`"""
+    OGRDataset.index(pk)
@@ -6,11 +6,23 @@ Replace these with more appropriate tests for your application.
 """
 
 from ga_ows.views import common
+from ga_ows import utils
+from ga_ows.views import wcs
+from ga_ows.views import wfs
+from ga_ows.views.wms import tiles
+from ga_ows.rendering import warp
+from ga_ows.rendering import palettes
+from ga_ows.rendering import sld
+from ga_ows.rendering import mvt
+import numpy as np
 from django.test.client import Client
 from django.test import TestCase
+from django.http import HttpResponse
 from django.utils import unittest
 import tempfile
+import os
 import json
+import base64
 from lxml import etree
 
 class tdict(dict):
@@ -48,11 +60,1014 @@ class TestOWSCommon(TestCase):
         self.assertEqual(req.cleaned_data['accepted_formats'], ['text/xml'])
         self.assertEqual(req.cleaned_data['accepted_versions'], ['1.0.0', '0.8.3'])
 
+    def testCachedGetCapabilities(self):
+        from django.test.client import RequestFactory
+        from ga_ows.models.test_models import WFSPointTest
+
+        class Adapter(object):
+            cls = WFSPointTest
+
+        class View(common.GetCapabilitiesMixin):
+            adapter = Adapter()
+            rendered = 0
+
+            def get_capabilities_response(self, request, parameters):
+                View.rendered += 1
+                return HttpResponse('<Capabilities/>', mimetype='text/xml')
+
+        request = RequestFactory().get('/wms', { 'service' : 'WMS', 'request' : 'GetCapabilities' })
+        args = lambda: utils.CaseInsensitiveDict(request.GET.items())
+        first = View().GetCapabilities(request, args())
+        second = View().GetCapabilities(request, args())
+        self.assertEqual(View.rendered, 1)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(second.content, '<Capabilities/>')
+
+        request.META['HTTP_IF_NONE_MATCH'] = first['ETag']
+        self.assertEqual(View().GetCapabilities(request, args()).status_code, 304)
+
+        common.invalidate_model(WFSPointTest)
+        third = View().GetCapabilities(request, args())
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third['ETag'], first['ETag'])
+        self.assertEqual(View.rendered, 2)
+
+    def testViewsWatchTheirModels(self):
+        from django.contrib.gis.geos import Point
+        from django.db.models.signals import post_save, post_delete
+        from ga_ows.models.test_models import WFSPointTest
+
+        uid = 'ga_ows_generation_' + WFSPointTest._meta.db_table
+        post_save.disconnect(sender=WFSPointTest, dispatch_uid=uid)
+        post_delete.disconnect(sender=WFSPointTest, dispatch_uid=uid)
+        common._watched_models.discard(WFSPointTest)
+
+        class Adapter(object):
+            cls = WFSPointTest
+
+        common.OWSView(adapter=Adapter())
+        generation = common.model_generation(WFSPointTest)
+        WFSPointTest.objects.create(geom=Point(0, 0), name='a', state='b', in_cluster=0)
+        self.assertNotEqual(common.model_generation(WFSPointTest), generation)
+
+    def testValidValuesFollowSavesFromConstruction(self):
+        from django.contrib.gis.geos import Point
+        from django.test.client import RequestFactory
+        from django.db.models.signals import post_save, post_delete
+        from ga_ows.models.test_models import WFSPointTest
+
+        uid = 'ga_ows_generation_' + WFSPointTest._meta.db_table
+        post_save.disconnect(sender=WFSPointTest, dispatch_uid=uid)
+        post_delete.disconnect(sender=WFSPointTest, dispatch_uid=uid)
+        common._watched_models.discard(WFSPointTest)
+
+        class Adapter(object):
+            cls = WFSPointTest
+
+            def get_valid_times(self, **kwargs):
+                return sorted(WFSPointTest.objects.values_list('in_cluster', flat=True))
+
+        class View(common.OWSView, common.GetValidTimesMixin):
+            pass
+
+        request = RequestFactory().get('/wms', { 'service' : 'WMS', 'request' : 'GetValidTimes', 'version' : '1.1.1', 'layers' : 'points' })
+        args = lambda: utils.CaseInsensitiveDict(request.GET.items())
+        view = View(adapter=Adapter())
+        WFSPointTest.objects.create(geom=Point(0, 0), name='a', state='b', in_cluster=1)
+        view.valid_values_response(args(), view.adapter.get_valid_times)
+        WFSPointTest.objects.create(geom=Point(0, 0), name='a', state='b', in_cluster=2)
+        self.assertEqual(json.loads(view.valid_values_response(args(), view.adapter.get_valid_times).content), [1, 2])
+
     def textExceptionPrinting(self):
         e = common.OWSException()
         print e.xml(extend=True)
 
 
+class TestCompressRanges(unittest.TestCase):
+    def testRuns(self):
+        self.assertEqual(utils.compress_ranges([1, 2, 4, 6, 8, 20]), [1, { 'range' : [2, 8], 'step' : 2 }, 20])
+        self.assertEqual(utils.compress_ranges([1, 2]), [1, 2])
+
+    def testTimes(self):
+        from datetime import datetime, timedelta
+        hours = [datetime(2013, 1, 1, h) for h in range(24)]
+        self.assertEqual(utils.compress_ranges(hours), [{ 'range' : [hours[0], hours[-1]], 'step' : timedelta(hours=1) }])
+
+
+class TestWCSSubset(unittest.TestCase):
+    class FakeDataset(object):
+        RasterXSize = 1000
+        RasterYSize = 500
+
+        def GetGeoTransform(self):
+            return (-100.0, 0.1, 0.0, 50.0, 0.0, -0.1)
+
+    def testWindow(self):
+        s = wcs.Subset(self.FakeDataset(), (-90.0, 40.0, -80.0, 45.0))
+        self.assertEqual((s.xoff, s.yoff, s.xsize, s.ysize), (100, 50, 100, 50))
+        self.assertEqual((s.width, s.height), (100, 50))
+
+    def testClampedAndResampled(self):
+        s = wcs.Subset(self.FakeDataset(), (-110.0, 40.0, -95.0, 60.0), resx=0.5, resy=0.5)
+        self.assertEqual((s.xoff, s.yoff, s.xsize, s.ysize), (0, 0, 50, 100))
+        self.assertEqual((s.width, s.height), (10, 20))
+        self.assertEqual(s.geotransform, (-100.0, 0.5, 0, 50.0, 0, -0.5))
+
+    def testStripsCoverOutput(self):
+        s = wcs.Subset(self.FakeDataset(), (-100.0, 0.0, 0.0, 50.0), width=100, height=600)
+        rows = [(dst_y, dst_rows) for _0, _1, dst_y, dst_rows in s.strips()]
+        self.assertEqual(sum(r for _0, r in rows), 600)
+        self.assertEqual(rows[0][0], 0)
+
+    def testOutsideCoverage(self):
+        self.assertRaises(common.InvalidParameterValue, wcs.Subset, self.FakeDataset(), (10.0, 10.0, 20.0, 20.0))
+
+    def testUnknownCoverage(self):
+        adapter = wcs.GDALWCSAdapter({})
+        adapter.get_coverage_dataset = lambda coverage: None
+        self.assertRaises(common.InvalidParameterValue, adapter.get_coverage_description, 'nothing')
+
+    def testFailedWriteLeavesNoFile(self):
+        from osgeo import gdal
+        ds = gdal.GetDriverByName('MEM').Create('', 1000, 500, 1, gdal.GDT_Byte)
+        ds.SetGeoTransform(self.FakeDataset().GetGeoTransform())
+        adapter = wcs.GDALWCSAdapter({})
+        adapter.get_coverage_dataset = lambda coverage: ds
+        targets = []
+        def failing(src, subset, bands, target, driver):
+            targets.append(target)
+            gdal.FileFromMemBuffer(target, 'partial')
+            raise IOError('disk full')
+        write_subset = wcs.write_subset
+        wcs.write_subset = failing
+        try:
+            self.assertRaises(IOError, adapter.get_coverage, 'c', (-90.0, 40.0, -80.0, 45.0), None, None, None, None, None, [], 'geotiff')
+        finally:
+            wcs.write_subset = write_subset
+        self.assertEqual(gdal.VSIStatL(targets[0]), None)
+
+
+class TestTileGrid(unittest.TestCase):
+    def testBBox(self):
+        grid = tiles.WEB_MERCATOR
+        half = 20037508.342789244
+        self.assertEqual(grid.bbox(0, 0, 0), (-half, -half, half, half))
+        self.assertEqual(grid.bbox(1, 0, 0), (-half, 0, 0, half))
+        self.assertEqual(grid.bbox(1, 0, 0, tms=True), (-half, -half, 0, 0))
+        self.assertAlmostEqual(grid.resolution(0), 156543.03392804097)
+
+    def testTileAddress(self):
+        grid = tiles.WORLD_CRS84
+        self.assertEqual(grid.tile(0, -79, 36), (0, 0))
+        self.assertEqual(grid.tile(2, 179.9, -89.9), (7, 3))
+        self.assertTrue(grid.contains(2, 7, 3))
+        self.assertFalse(grid.contains(2, 8, 3))
+
+
+class TestConditionalGetMap(unittest.TestCase):
+    def setUp(self):
+        from datetime import datetime
+        from ga_ows.views.wms import base
+        self.base = base
+        self.metadata = { '_etag' : 'abc123', '_creation_time' : datetime(2013, 6, 1, 12, 0, 0) }
+
+    def testNotModified(self):
+        from django.test.client import RequestFactory
+        factory = RequestFactory()
+        self.assertTrue(self.base.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='"abc123"'), self.metadata))
+        self.assertFalse(self.base.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='"def456"'), self.metadata))
+        self.assertTrue(self.base.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='"def456", W/"abc123"'), self.metadata))
+        self.assertTrue(self.base.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='*'), self.metadata))
+        self.assertFalse(self.base.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='*'), None))
+        self.assertTrue(self.base.not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE='Sat, 01 Jun 2013 12:00:00 GMT'), self.metadata))
+        self.assertFalse(self.base.not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE='Sat, 01 Jun 2013 11:59:59 GMT'), self.metadata))
+        self.assertFalse(self.base.not_modified(factory.get('/'), None))
+
+    def testHeaders(self):
+        response = self.base.cache_headers(HttpResponse(), self.metadata, 600)
+        self.assertEqual(response['ETag'], '"abc123"')
+        self.assertEqual(response['Last-Modified'], 'Sat, 01 Jun 2013 12:00:00 GMT')
+        self.assertEqual(response['Cache-Control'], 'max-age=600')
+
+
+class TestGetMapCache(TestCase):
+    fixtures = ['wfs_test.json']
+
+    def setUp(self):
+        from ga_ows.models.test_models import WFSPointTest
+        from ga_ows.views.wms import WMS, GeoDjangoWMSAdapter
+        self.adapter = GeoDjangoWMSAdapter(WFSPointTest, styles={})
+        self.adapter.cache.flush()
+        self.view = WMS(adapter=self.adapter)
+        self.query = { 'service' : 'WMS', 'request' : 'GetMap', 'version' : '1.1.1', 'layers' : 'geom', 'styles' : '',
+            'srs' : '4326', 'bbox' : '-80,35,-78,37', 'width' : '256', 'height' : '256', 'format' : 'png' }
+
+    def tearDown(self):
+        self.adapter.cache.flush()
+
+    def args(self, request):
+        return utils.CaseInsensitiveDict(request.GET.items())
+
+    def testCachedMapIsRevalidated(self):
+        from django.test.client import RequestFactory
+        from ga_ows.views.wms.base import GetMapMixin
+        request = RequestFactory().get('/wms', self.query)
+        parms = GetMapMixin.Parameters.create(self.args(request)).cleaned_data
+
+        saved = self.adapter.cache_result('not really a png', **parms)
+        self.assertEqual(self.adapter.get_cache_metadata(**parms)['_etag'], saved['_etag'])
+        self.assertEqual(self.adapter.get_cache_record(**parms), 'not really a png')
+
+        response = self.view.GetMap(request, self.args(request))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'not really a png')
+        self.assertEqual(response['ETag'], '"' + saved['_etag'] + '"')
+
+        request = RequestFactory().get('/wms', self.query, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(self.view.GetMap(request, self.args(request)).status_code, 304)
+
+
+class TestTileCache(TestCase):
+    fixtures = ['wfs_test.json']
+
+    def setUp(self):
+        from ga_ows.models.test_models import WFSPointTest
+        from ga_ows.views.wms import GeoDjangoWMSAdapter
+        self.model = WFSPointTest
+        self.adapter = GeoDjangoWMSAdapter(WFSPointTest, styles={})
+        self.adapter.cache.flush()
+        self.view = tiles.TiledWMS(adapter=self.adapter)
+
+    def tearDown(self):
+        self.adapter.cache.flush()
+
+    def testSaveRetiresTiles(self):
+        from django.db.models.signals import post_save
+        from django.test.client import RequestFactory
+        from ga_ows.views.wms.cache import WMSCache
+        request = RequestFactory().get('/tiles/geom/0/0/0.png')
+        response = self.view.GetTile(request, layers='geom', z='0', x='0', y='0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.adapter.cache.collect(model='WFSPointTest').count(), 1)
+
+        request = RequestFactory().get('/tiles/geom/0/0/0.png', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(self.view.GetTile(request, layers='geom', z='0', x='0', y='0').status_code, 304)
+
+        handler = WMSCache.GeoDjangoCacheInvalidatingignalHandler(self.model, self.adapter.cache)
+        post_save.connect(handler)
+        try:
+            point = self.model.objects.all()[0]
+            point.name = point.name + ' (renamed)'
+            point.save()
+        finally:
+            post_save.disconnect(handler)
+        self.assertEqual(self.adapter.cache.collect(model='WFSPointTest').count(), 0)
+        self.assertEqual(self.view.GetTile(request, layers='geom', z='0', x='0', y='0').status_code, 200)
+
+
+class TestGeoDjangoFeatureInfo(TestCase):
+    fixtures = ['wfs_test.json']
+
+    def setUp(self):
+        from ga_ows.models.test_models import WFSPointTest
+        from ga_ows.views.wms import GeoDjangoWMSAdapter
+        self.point = WFSPointTest.objects.order_by('pk')[0]
+        self.adapter = GeoDjangoWMSAdapter(WFSPointTest, styles={})
+
+    def hits(self, dx, tolerance, **filter):
+        info = self.adapter.get_feature_info(self.point.geom.x + dx, self.point.geom.y, ['geom'], None, 'application/json', 10, '4326', filter, tolerance=tolerance)
+        return [row['id'] for row in info['geom']]
+
+    def testTolerance(self):
+        self.assertIn(self.point.pk, self.hits(0.0005, 0.001))
+        self.assertNotIn(self.point.pk, self.hits(0.002, 0.001))
+        self.assertEqual(self.hits(0.0005, 0.001, name=self.point.name + ' (not)'), [])
+
+
+class TestWarpPlanCache(unittest.TestCase):
+    def testZoomBuckets(self):
+        z = warp.WarpPlanCache.zoom
+        self.assertEqual(z(152.87), z(200.0))
+        self.assertNotEqual(z(152.87), z(76.4))
+        self.assertTrue(2.0 ** z(152.87) <= 152.87)
+        self.assertEqual(z(None), None)
+
+    def testPlansFollowTheSourceFile(self):
+        from osgeo import gdal, osr
+        path = tempfile.mktemp(suffix='.tif')
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+
+        def write(value):
+            ds = gdal.GetDriverByName('GTiff').Create(path, 16, 16, 1, gdal.GDT_Byte)
+            ds.SetGeoTransform((-80, 0.125, 0, 36, 0, -0.125))
+            ds.SetProjection(srs.ExportToWkt())
+            ds.GetRasterBand(1).Fill(value)
+            ds = None
+
+        plans = warp.WarpPlanCache()
+        mercator = osr.SpatialReference()
+        mercator.ImportFromEPSG(3857)
+        try:
+            write(1)
+            ds = gdal.Open(path)
+            vrt = plans.warped('test', ds, mercator.ExportToWkt(), 4000)
+            self.assertIs(plans.warped('test', gdal.Open(path), mercator.ExportToWkt(), 4000), vrt)
+            # the plan doesn't depend on the dataset of the request that built it
+            del ds
+            self.assertEqual(vrt.GetRasterBand(1).ReadAsArray().max(), 1)
+
+            write(2)
+            os.utime(path, (0, 0))
+            vrt = plans.warped('test', gdal.Open(path), mercator.ExportToWkt(), 4000)
+            self.assertEqual(vrt.GetRasterBand(1).ReadAsArray().max(), 2)
+            self.assertEqual(len(plans._plans), 1)
+        finally:
+            plans.clear()
+            os.unlink(path)
+
+
+class TestPalettes(unittest.TestCase):
+    def testVectorizedMatchesPerCell(self):
+        p = palettes.Palette(
+            palettes.ColorBin(palettes.rgba(0,0,0), 0.0, 30.0),
+            palettes.LinearGradient(palettes.rgba(255,0,0), palettes.rgba(0,0,255), 30.0, 60.0),
+            palettes.CatchAll(palettes.rgba(255,255,255,0))
+        )
+        self.assertTrue(p.vectorized)
+        values = np.linspace(-10.0, 80.0, 600).reshape(20, 30)
+        fast = p(values)
+        p.vectorized = False
+        slow = p(values)
+        self.assertEqual(fast.shape, (20, 30, 4))
+        self.assertEqual(fast.dtype, np.uint8)
+        self.assertTrue((fast == slow).all())
+
+
+class TestSLDCompiler(unittest.TestCase):
+    STYLE = """<?xml version="1.0"?>
+<FeatureTypeStyle xmlns="http://www.opengis.net/sld" xmlns:ogc="http://www.opengis.net/ogc">
+  <Rule>
+    <ogc:Filter>
+      <ogc:And>
+        <ogc:PropertyIsGreaterThan>
+          <ogc:PropertyName>pop</ogc:PropertyName><ogc:Literal>1000</ogc:Literal>
+        </ogc:PropertyIsGreaterThan>
+        <ogc:Or>
+          <ogc:PropertyIsLike wildCard="*" singleChar="." escape="!">
+            <ogc:PropertyName>name</ogc:PropertyName><ogc:Literal>Ca*</ogc:Literal>
+          </ogc:PropertyIsLike>
+          <ogc:PropertyIsBetween>
+            <ogc:Add><ogc:PropertyName>area</ogc:PropertyName><ogc:Literal>1</ogc:Literal></ogc:Add>
+            <ogc:LowerBoundary><ogc:Literal>10</ogc:Literal></ogc:LowerBoundary>
+            <ogc:UpperBoundary><ogc:Literal>20</ogc:Literal></ogc:UpperBoundary>
+          </ogc:PropertyIsBetween>
+        </ogc:Or>
+      </ogc:And>
+    </ogc:Filter>
+  </Rule>
+</FeatureTypeStyle>"""
+
+    def setUp(self):
+        self.rule = sld.SLDParser()(self.STYLE)[0]
+        self.records = [dict(pop=p, name=n, area=a) for p in (500, 2000) for n in ('Cary', 'Durham') for a in (5, 12, 25)]
+
+    def testCompiledMatchesTree(self):
+        f = self.rule.compiled()
+        for record in self.records:
+            self.assertEqual(bool(self.rule(record, 1)), f(record, 1))
+
+    def testVectorizedMatchesTree(self):
+        data = dict((k, np.array([r[k] for r in self.records])) for k in ('pop', 'name', 'area'))
+        mask = self.rule.compiled(vectorized=True)(data, 1)
+        self.assertEqual(list(mask), [bool(self.rule(r, 1)) for r in self.records])
+
+    def testDivisionIsTrueDivision(self):
+        ratio = sld.Divide(sld.PA('area'), sld.PA('pop'))
+        self.assertEqual(sld.compile_expression(ratio)({'area' : 5, 'pop' : 2}), 2.5)
+        data = {'area' : np.array([5, 12]), 'pop' : np.array([2, 8])}
+        self.assertEqual(list(sld.compile_expression(ratio, vectorized=True)(data)), [2.5, 1.5])
+        self.assertEqual(list(sld.compile_expression(sld.Divide(sld.PA('area'), sld.PA('pop'), sld.PA('pop')), vectorized=True)(data)), [1.25, 0.1875])
+
+    def testOGRSQL(self):
+        self.assertEqual(
+            sld.rules_filter([self.rule], sld.to_ogr_sql),
+            """((("pop" > 1000.0) AND (("name" LIKE 'Ca%') OR (("area" + 1.0) BETWEEN 10.0 AND 20.0))))"""
+        )
+
+    def testOGRSQLKeepsNulls(self):
+        self.assertEqual(sld.to_ogr_sql(sld.Ne(sld.PA('name'), sld.L('Cary'))), """(("name" <> 'Cary') OR "name" IS NULL)""")
+        self.assertEqual(sld.to_ogr_sql(sld.NotIn(sld.PA('pop'), sld.L('1'), sld.L('2'))), """(("pop" NOT IN (1.0, 2.0)) OR "pop" IS NULL)""")
+        self.assertEqual(
+            sld.to_ogr_sql(sld.Not(sld.Gt(sld.Add(sld.PA('area'), sld.PA('pop')), sld.L('1')))),
+            """((NOT (("area" + "pop") > 1.0)) OR "area" IS NULL OR "pop" IS NULL)"""
+        )
+        self.assertEqual(sld.to_ogr_sql(sld.Not(sld.Null(sld.PA('name')))), '("name" IS NOT NULL)')
+
+    def testQ(self):
+        q = sld.to_q(sld.Or(sld.Gt(sld.L('5'), sld.PA('a')), sld.Like(sld.PA('n'), 'Ca*', wild_card='*')))
+        self.assertEqual(q.connector, 'OR')
+        self.assertEqual(q.children, [('a__lt', 5.0), ('n__startswith', 'Ca')])
+
+    def testUntranslatableRulesFetchEverything(self):
+        self.assertRaises(sld.NotTranslatable, sld.to_q, self.rule.clauses[0])
+        self.assertIsNone(sld.rules_filter([self.rule, sld.Rule()], sld.to_ogr_sql))
+
+
+class TestSLDRuleSet(unittest.TestCase):
+    def setUp(self):
+        self.rules = sld.SLDParser()(sld.TEST_SLD)
+
+    def testActiveMatchesScan(self):
+        self.assertIsInstance(self.rules, sld.RuleSet)
+        for denominator in (1000, 34999, 35000, 69999, 70000, 139999, 140000, 1e7):
+            pxsize = sld.pixel_size(denominator)
+            self.assertEqual(list(self.rules.active(pxsize)), [rule for rule in self.rules if rule.active(pxsize)])
+        self.assertEqual(len(self.rules.active(sld.pixel_size(50000))), 1)
+        self.assertEqual(len(self.rules.active(sld.pixel_size(200000))), 0)
+
+    def testReindexOnAppend(self):
+        rule = sld.Rule()
+        rule.clauses.append(sld.Gt(sld.PA('pop'), sld.L('10')))
+        self.rules.append(rule)
+        self.assertIn(rule, self.rules.active(sld.pixel_size(200000)))
+        self.assertEqual(self.rules.required_fields(sld.pixel_size(200000)), set(['pop']))
+
+
+class TestSLDCache(unittest.TestCase):
+    def testParseByContent(self):
+        cache = sld.SLDCache(size=2)
+        rules = cache.parse(sld.TEST_SLD)
+        self.assertIs(cache.parse(sld.TEST_SLD), rules)
+        self.assertIs(cache.parse(unicode(sld.TEST_SLD, 'iso-8859-1')), rules)
+        cache.parse(TestSLDCompiler.STYLE)
+        cache.parse(TestSLDCompiler.STYLE.replace('1000', '2000'))
+        self.assertIsNot(cache.parse(sld.TEST_SLD), rules)
+
+    def testParseFileFollowsMtime(self):
+        cache = sld.SLDCache()
+        with tempfile.NamedTemporaryFile(suffix='.sld') as f:
+            f.write(sld.TEST_SLD)
+            f.flush()
+            rules = cache.parse_file(f.name)
+            self.assertIs(cache.parse_file(f.name), rules)
+            f.seek(0)
+            f.write(TestSLDCompiler.STYLE)
+            f.truncate()
+            f.flush()
+            os.utime(f.name, (0, 0))
+            self.assertEqual(len(cache.parse_file(f.name)), 1)
+
+    def testUrlsAreChecked(self):
+        cache = sld.SLDCache(allowed_hosts=['styles.example.com'])
+        self.assertRaises(sld.ForbiddenURL, cache.parse_url, 'file:///etc/passwd')
+        self.assertRaises(sld.ForbiddenURL, cache.parse_url, 'http://169.254.169.254/latest/meta-data/')
+        self.assertRaises(sld.ForbiddenURL, sld.SLDCache(allowed_hosts=[]).parse_url, 'http://styles.example.com/roads.sld')
+
+    def testBadSLDIsInvalidParameter(self):
+        from ga_ows.views.wms.base import WMSAdapterBase
+        adapter = WMSAdapterBase({})
+        self.assertRaises(common.InvalidParameterValue, adapter.get_stylesheet, sld_body='<StyledLayerDescriptor')
+        self.assertRaises(common.InvalidParameterValue, adapter.get_stylesheet, sld='file:///etc/passwd')
+        for filter in (
+            '<ogc:Function name="noSuchFunction"><ogc:PropertyName>pop</ogc:PropertyName></ogc:Function>',
+            '<ogc:NoSuchOperator/>',
+            '<ogc:PropertyIsBetween><ogc:PropertyName>pop</ogc:PropertyName><ogc:LowerBoundary><ogc:Literal>1</ogc:Literal></ogc:LowerBoundary></ogc:PropertyIsBetween>',
+            '<ogc:PropertyIsBetween/>',
+        ):
+            body = TestSLDCompiler.STYLE.replace(TestSLDCompiler.STYLE[TestSLDCompiler.STYLE.index('<ogc:And>'):TestSLDCompiler.STYLE.index('</ogc:Filter>')], filter)
+            self.assertRaises(common.InvalidParameterValue, adapter.get_stylesheet, sld_body=body)
+
+    def testRememberedFilesAreBounded(self):
+        cache = sld.SLDCache(size=2)
+        files = [tempfile.NamedTemporaryFile(suffix='.sld') for k in range(3)]
+        for f in files:
+            f.write(sld.TEST_SLD)
+            f.flush()
+            cache.parse_file(f.name)
+        self.assertEqual(list(cache._files), [files[1].name, files[2].name])
+        for f in files:
+            f.close()
+
+
+class TestVectorTile(unittest.TestCase):
+    def testClipAndQuantize(self):
+        from shapely import wkb
+        from shapely.geometry import Point, LineString
+        tile = mvt.TileEncoder((0, 0, 100, 100), extent=4096, buffer=64)
+        tile.add_layer('things', [
+            (Point(50, 50), { 'name' : 'middle', 'empty' : None }, 7),
+            (Point(500, 500), { 'name' : 'elsewhere' }, 8),
+            (LineString([(-50, 50), (150, 50)]), { 'name' : 'across' }, 9),
+        ])
+        features = tile.layers[0]['features']
+        self.assertEqual([f['id'] for f in features], [7, 9])
+        self.assertEqual(features[0]['properties'], { 'name' : 'middle' })
+        self.assertEqual(wkb.loads(features[0]['geometry']).coords[0], (2048, 2048))
+        self.assertEqual(wkb.loads(features[1]['geometry']).bounds, (-64, 2048, 4160, 2048))
+
+
+class TestWFSStreaming(unittest.TestCase):
+    def setUp(self):
+        from osgeo import ogr
+        self.ds = ogr.GetDriverByName('Memory').CreateDataSource('streaming')
+        self.layer = self.ds.CreateLayer('points', geom_type=ogr.wkbPoint)
+        self.layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        for i, name in enumerate(['Durham', 'Chapel Hill & Carrboro', 'Raleigh']):
+            feature = ogr.Feature(self.layer.GetLayerDefn())
+            feature.SetField('name', name)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt('POINT({x} 36)'.format(x=-79 + i)))
+            self.layer.CreateFeature(feature)
+
+    def testGeoJSON(self):
+        chunks = list(wfs.stream_geojson(self.layer))
+        collection = json.loads(''.join(chunks))
+        self.assertEqual([f['properties']['name'] for f in collection['features']], ['Durham', 'Chapel Hill & Carrboro', 'Raleigh'])
+
+    def testGML(self):
+        released = []
+        doc = etree.fromstring(''.join(wfs.stream_gml(self.layer, cleanup=lambda: released.append(True))))
+        names = doc.findall('.//{http://ogr.maptools.org/}name')
+        self.assertEqual([n.text for n in names], ['Durham', 'Chapel Hill & Carrboro', 'Raleigh'])
+        self.assertEqual(len(doc.findall('.//{http://www.opengis.net/gml}Point')), 3)
+        self.assertEqual(released, [True])
+
+    def testGeoJSONSeq(self):
+        records = ''.join(wfs.stream_geojsonseq(self.layer)).split(wfs.RECORD_SEPARATOR)
+        self.assertEqual(records[0], '')
+        self.assertEqual([json.loads(r)['properties']['name'] for r in records[1:]], ['Durham', 'Chapel Hill & Carrboro', 'Raleigh'])
+
+    def testFlatGeobuf(self):
+        from osgeo import gdal, ogr
+        if ogr.GetDriverByName('FlatGeobuf') is None:
+            return
+        data = ''.join(wfs.stream_flatgeobuf(self.layer))
+        gdal.FileFromMemBuffer('/vsimem/test.fgb', data)
+        ds = ogr.Open('/vsimem/test.fgb')
+        self.assertEqual(ds.GetLayer(0).GetFeatureCount(), 3)
+        del ds
+        gdal.Unlink('/vsimem/test.fgb')
+
+    def testGeoJSONPrecision(self):
+        self.assertEqual(wfs.geojson_precision(4326), 7)
+        self.assertEqual(wfs.geojson_precision(3857), 2)
+
+
+class TestOGRDataSourcePool(unittest.TestCase):
+    def setUp(self):
+        self.paths = []
+        for i in range(2):
+            _0, path = tempfile.mkstemp(suffix='.json')
+            os.close(_0)
+            with open(path, 'w') as f:
+                f.write('{"type": "FeatureCollection", "features": []}')
+            self.paths.append(path)
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def testReuse(self):
+        pool = utils.OGRDataSourcePool(max_size=2)
+        with pool.connection(self.paths[0]) as ds:
+            first = ds
+        with pool.connection(self.paths[0]) as ds:
+            self.assertIs(ds, first)
+
+    def testBounded(self):
+        pool = utils.OGRDataSourcePool(max_size=1, timeout=0)
+        with pool.connection(self.paths[0]):
+            self.assertRaises(utils.PoolExhausted, pool.acquire, self.paths[1])
+        # the idle datasource for the first path is closed to make room for the second
+        with pool.connection(self.paths[1]) as ds:
+            self.assertIsNotNone(ds)
+        self.assertEqual(pool._open, 1)
+
+    def testCloseAllClosesLentDatasourcesOnReturn(self):
+        pool = utils.OGRDataSourcePool(max_size=2)
+        with pool.connection(self.paths[1]):
+            pass
+        with pool.connection(self.paths[0]) as ds:
+            pool.close_all()
+            self.assertEqual(pool._open, 1)
+        self.assertEqual(pool._open, 0)
+        with pool.connection(self.paths[0]) as ds:
+            pass
+        self.assertEqual(pool._open, 1)
+
+
+class TestWFSAdHocQuery(TestCase):
+    def query(self, **cleaned_data):
+        from ga_ows.models.test_models import WFSPointTest
+        self.parms = common.RequestForm()
+        self.parms.cleaned_data = dict(type_names=['ga_ows:WFSPointTest'], filter=None, filter_language=None, bbox=None,
+            sort_by=None, count=None, max_features=None, start_index=None, srs_name='EPSG:4326', srs_format=None,
+            page_token=None)
+        self.parms.cleaned_data.update(cleaned_data)
+        return wfs.GeoDjangoWFSAdapter([WFSPointTest]).AdHocQuery(None, self.parms)
+
+    def testBBoxIsApplied(self):
+        sql = str(self.query(bbox=(-81, 29, -76, 36)).query)
+        self.assertIn('&&', sql)
+        self.assertNotIn('ST_Transform', sql)
+
+    def testBBoxInNativeSRS(self):
+        box = wfs.bbox_polygon((-9016878.75, 3375646.03, -8460281.30, 4300621.37), 3857, 4326)
+        minx, miny, maxx, maxy = box.extent
+        self.assertAlmostEqual(minx, -81, 3)
+        self.assertAlmostEqual(maxx, -76, 3)
+        self.assertAlmostEqual(miny, 29, 3)
+        self.assertAlmostEqual(maxy, 36, 3)
+
+    def testTransformIsApplied(self):
+        qs = self.query(bbox=(-9016878.75, 3375646.03, -8460281.30, 4300621.37), srs_name='EPSG:3857')
+        self.assertEqual(qs.query.transformed_srid, 3857)
+
+    def testSrsNameForms(self):
+        for name in ('EPSG:3857', '3857', 'urn:ogc:def:crs:EPSG::3857', 'urn:ogc:def:crs:EPSG:6.18:3857',
+                     'http://www.opengis.net/def/crs/EPSG/0/3857', 'http://www.opengis.net/gml/srs/epsg.xml#3857'):
+            self.assertEqual(wfs.srid_of(name), 3857)
+        self.assertEqual(wfs.srid_of('urn:ogc:def:crs:OGC:1.3:CRS84'), 4326)
+        self.assertRaises(common.InvalidParameterValue, wfs.srid_of, 'urn:ogc:def:crs:ESRI::102003')
+        self.assertRaises(common.InvalidParameterValue, self.query, srs_name='+proj=longlat')
+
+    def testBBoxUsesSpatialIndex(self):
+        from django.db import connection
+        from ga_ows.models.test_models import WFSPointTest
+        if connection.vendor != 'postgresql':
+            self.skipTest('needs PostGIS')
+        qs = self.query(bbox=(-9016878.75, 3375646.03, -8460281.30, 4300621.37), srs_name='urn:ogc:def:crs:EPSG::3857')
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexdef LIKE '%%USING gist%%'", [WFSPointTest._meta.db_table])
+        indexes = [row[0] for row in cursor.fetchall()]
+        self.assertTrue(indexes)
+        # the fixture is small enough that the planner would rather scan it
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        sql, params = qs.query.sql_with_params()
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertTrue(any(index in plan for index in indexes), plan)
+
+    def fetch(self, query_set):
+        page = self.parms.page
+        rows = page.fetch(query_set.values(*page.keys).iterator(), lambda row: [row[column] for column in page.keys])
+        return [row['id'] for row in rows]
+
+    def testKeysetPaging(self):
+        from ga_ows.models.test_models import WFSPointTest
+        expected = list(WFSPointTest.objects.order_by('-state', 'pk').values_list('pk', flat=True))
+        seen = []
+        token = None
+        while True:
+            page = self.query(count=2, sort_by='-state', page_token=token)
+            self.assertNotIn('OFFSET', str(page.query))
+            seen.extend(self.fetch(page))
+            token = self.parms.page.next_token
+            if not token:
+                break
+        self.assertEqual(seen, expected)
+
+    def testBadPageToken(self):
+        self.assertRaises(common.OWSException, self.query, count=2, page_token=base64.urlsafe_b64encode('[1, 2, 3]'))
+        self.fetch(self.query(count=1, sort_by='state'))
+        token = self.parms.page.next_token
+        self.assertRaises(common.OWSException, self.query, count=1, sort_by='name', page_token=token)
+        self.assertRaises(common.OWSException, self.query, count=1, sort_by='state', filter='{"in_cluster": 1}', page_token=token)
+
+    def testNullSortKeys(self):
+        from ga_ows.models.test_models import WFSPointTest
+        sql = str(WFSPointTest.objects.filter(wfs.keyset_filter(['state', 'pk'], [None, 3])).query)
+        self.assertIn('IS NULL', sql)
+        self.assertNotIn('> None', sql)
+        self.assertIn('IS NOT NULL', str(WFSPointTest.objects.filter(wfs.keyset_filter(['-state', 'pk'], [None, 3])).query))
+
+        # SQLite sorts NULLs first, so the non-NULL states follow a NULL one in ascending order
+        self.assertIn('IS NOT NULL', str(WFSPointTest.objects.filter(wfs.keyset_filter(['state', 'pk'], [None, 3], 'sqlite')).query))
+        sql = str(WFSPointTest.objects.filter(wfs.keyset_filter(['-state', 'pk'], [None, 3], 'sqlite')).query)
+        self.assertNotIn('IS NOT NULL', sql)
+        self.assertNotIn('< None', sql)
+
+    def testQuerySetFlatGeobuf(self):
+        from osgeo import gdal, ogr
+        if ogr.GetDriverByName('FlatGeobuf') is None:
+            return
+        qs = self.query(bbox=(-81, 29, -76, 36))
+        data = ''.join(wfs.stream_queryset_flatgeobuf(qs, wfs._geometry_field(qs)))
+        gdal.FileFromMemBuffer('/vsimem/test.fgb', data)
+        ds = ogr.Open('/vsimem/test.fgb')
+        self.assertEqual(ds.GetLayer(0).GetFeatureCount(), qs.count())
+        self.assertTrue(ds.GetLayer(0).GetLayerDefn().GetFieldIndex('state') >= 0)
+        del ds
+        gdal.Unlink('/vsimem/test.fgb')
+
+    def testSortByGeometryIsRejected(self):
+        self.assertRaises(common.OWSException, self.query, count=1, sort_by='geom')
+
+    def testCountIgnoresPaging(self):
+        from ga_ows.models.test_models import WFSPointTest
+        self.assertEqual(wfs.count_matched(self.query(count=1)), (WFSPointTest.objects.count(), None))
+
+    def testHitsAboveLimitAreUnknown(self):
+        from django.db import connection
+        doc = etree.fromstring(wfs.hits_response(None, 'text/xml').content)
+        self.assertEqual(doc.get('numberMatched'), 'unknown')
+        self.assertNotIn('numberMatched', json.loads(wfs.hits_response(None, 'GeoJSON').content))
+        self.assertEqual(json.loads(wfs.hits_response(3, 'GeoJSON').content)['numberMatched'], 3)
+
+        doc = etree.fromstring(wfs.hits_response(None, 'text/xml', estimate=120000).content)
+        self.assertEqual(doc.get('numberMatched'), 'unknown')
+        self.assertEqual(doc.get('{' + wfs.GA_OWS_NS + '}numberMatchedEstimate'), '120000')
+        self.assertEqual(json.loads(wfs.hits_response(None, 'GeoJSON', estimate=120000).content)['numberMatchedEstimate'], 120000)
+        if connection.vendor == 'postgresql':
+            number_matched, estimate = wfs.count_matched(self.query(), exact_limit=-1)
+            self.assertEqual(number_matched, None)
+            self.assertTrue(estimate >= 0)
+
+
+class TestLayerExtent(TestCase):
+    fixtures = ['wfs_test.json']
+
+    def setUp(self):
+        from ga_ows.models import wms
+        from ga_ows.models.test_models import WFSPointTest
+        self.wms = wms
+        self.model = WFSPointTest
+        self.have_celery = wms.HAVE_CELERY
+        wms.HAVE_CELERY = False
+        wms.LayerExtent.watch(WFSPointTest)
+
+    def tearDown(self):
+        self.wms.HAVE_CELERY = self.have_celery
+
+    def testExtentFollowsFeatures(self):
+        from django.contrib.gis.geos import Point
+        LayerExtent = self.wms.LayerExtent
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom'), self.model.objects.extent())
+
+        far = self.model.objects.create(geom=Point(170, 80, srid=4326), name='far', state='far', in_cluster=0)
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom')[2:], (170, 80))
+
+        far.delete()
+        self.assertTrue(LayerExtent.objects.get(source='ga_ows.WFSPointTest', layer='geom').stale)
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom'), self.model.objects.extent())
+
+    def testBrokerFailureLeavesExtentStale(self):
+        from django.contrib.gis.geos import Point
+        LayerExtent = self.wms.LayerExtent
+        LayerExtent.of_model(self.model, 'geom')
+        far = self.model.objects.create(geom=Point(170, 80, srid=4326), name='far', state='far', in_cluster=0)
+
+        def unreachable(*args):
+            raise IOError('broker unreachable')
+        try:
+            from ga_ows import tasks
+        except ImportError:
+            tasks = None # queueing fails on the import instead
+        if tasks is not None:
+            tasks.recompute_extent.delay = unreachable
+        self.wms.HAVE_CELERY = True
+        try:
+            far.delete()
+        finally:
+            if tasks is not None:
+                del tasks.recompute_extent.delay
+        self.assertTrue(LayerExtent.objects.get(source='ga_ows.WFSPointTest', layer='geom').stale)
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom'), self.model.objects.extent())
+
+    def testRecomputeKeepsConcurrentGrowth(self):
+        LayerExtent = self.wms.LayerExtent
+        LayerExtent.of_model(self.model, 'geom')
+        extent = self.model.objects.extent
+        def extent_during_a_save(**kwargs):
+            ret = extent(**kwargs)
+            LayerExtent.grow('ga_ows.WFSPointTest', 'geom', (170, 80, 170, 80))
+            return ret
+        self.model.objects.extent = extent_during_a_save
+        try:
+            minx, miny, maxx, maxy = LayerExtent.recompute('ga_ows.WFSPointTest', 'geom')
+        finally:
+            del self.model.objects.extent
+        self.assertEqual((maxx, maxy), (170, 80))
+        self.assertEqual((minx, miny), extent()[:2])
+
+    def testOnlyChangedGeometriesShrinkExtents(self):
+        from django.contrib.gis.geos import Point
+        LayerExtent = self.wms.LayerExtent
+        maxx = LayerExtent.of_model(self.model, 'geom')[2]
+        pk = [f.pk for f in self.model.objects.all() if f.geom.x == maxx][0]
+        edge = self.model.objects.get(pk=pk)
+
+        edge.name = 'renamed'
+        edge.save()
+        self.assertFalse(LayerExtent.objects.get(source='ga_ows.WFSPointTest', layer='geom').stale)
+
+        edge.geom = Point(edge.geom.x - 1, edge.geom.y, srid=edge.geom.srid)
+        edge.save()
+        self.assertTrue(LayerExtent.objects.get(source='ga_ows.WFSPointTest', layer='geom').stale)
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom'), self.model.objects.extent())
+
+    def testExpiredExtentsCatchUpWithUpdates(self):
+        from datetime import timedelta
+        from django.contrib.gis.geos import Point
+        from django.utils import timezone
+        LayerExtent = self.wms.LayerExtent
+        LayerExtent.of_model(self.model, 'geom')
+        self.model.objects.filter(pk=self.model.objects.all()[0].pk).update(geom=Point(170, 80, srid=4326))
+        self.assertNotEqual(LayerExtent.of_model(self.model, 'geom')[2:], (170, 80))
+
+        expired = timezone.now() - timedelta(seconds=self.wms.EXTENT_TTL + 1)
+        LayerExtent.objects.filter(source='ga_ows.WFSPointTest', layer='geom').update(computed=expired)
+        self.assertEqual(LayerExtent.of_model(self.model, 'geom')[2:], (170, 80))
+
+    def testEmptyLayerDescription(self):
+        from ga_ows.views.wms import GeoDjangoWMSAdapter
+        self.model.objects.all().delete()
+        self.assertEqual(self.wms.LayerExtent.of_model(self.model, 'geom'), None)
+        description = GeoDjangoWMSAdapter(self.model, styles={}).get_layer_descriptions()[0]
+        self.assertEqual((description['minx'], description['maxx']), (0, 0))
+
+
+class TestSpatialIndex(TestCase):
+    def setUp(self):
+        from osgeo import ogr, osr
+        from ga_ows.models import wms
+        self.wms = wms
+        self.have_celery = wms.HAVE_CELERY
+        wms.HAVE_CELERY = False
+
+        self.dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.dir, 'points.shp')
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(self.location)
+        layer = ds.CreateLayer('points', srs, ogr.wkbPoint)
+        for k in range(100):
+            f = ogr.Feature(layer.GetLayerDefn())
+            f.SetGeometry(ogr.CreateGeometryFromWkt('POINT({0} {0})'.format(k * 0.5)))
+            layer.CreateFeature(f)
+        ds = None
+
+    def tearDown(self):
+        import shutil
+        self.wms.HAVE_CELERY = self.have_celery
+        shutil.rmtree(self.dir)
+
+    def testRegistrationBuildsIndex(self):
+        from django.contrib.gis.geos import Polygon
+        collection = self.wms.OGRDatasetCollection.objects.create(name='test')
+        dataset = self.wms.OGRDataset(collection=collection, location=self.location, checksum='1', name='points', extent=Polygon.from_bbox((0, 0, 50, 50)))
+        self.assertEqual(dataset.spatial_index_state(), 'missing')
+        dataset.save()
+        self.assertEqual(dataset.spatial_index, 'created')
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'points.qix')))
+
+        dataset.checksum = '2'
+        dataset.save()
+        self.assertEqual(self.wms.OGRDataset.objects.get(pk=dataset.pk).spatial_index, 'present')
+
+    def testIndexSpeedsUpWindowReads(self):
+        """Window reads over a 5000 point shapefile are faster once its .qix is built, and read the same features"""
+        import time
+        from osgeo import ogr, osr
+        location = os.path.join(self.dir, 'grid.shp')
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(location)
+        layer = ds.CreateLayer('grid', srs, ogr.wkbPoint)
+        for k in range(5000):
+            f = ogr.Feature(layer.GetLayerDefn())
+            f.SetGeometry(ogr.CreateGeometryFromWkt('POINT({0} {1})'.format(k % 100, k // 100)))
+            layer.CreateFeature(f)
+        ds = None
+
+        def read_windows():
+            ds = ogr.Open(location)
+            layer = ds.GetLayer(0)
+            read = 0
+            start = time.time()
+            for k in range(200):
+                x, y = k % 90, k % 40
+                layer.SetSpatialFilterRect(x, y, x + 5, y + 5)
+                read += sum(1 for _ in layer)
+            return time.time() - start, read, layer.TestCapability(ogr.OLCFastSpatialFilter)
+
+        unindexed, unindexed_read, fast = read_windows()
+        self.assertFalse(fast)
+        dataset = self.wms.OGRDataset(location=location, checksum='1', name='grid')
+        self.assertEqual(dataset.create_spatial_index(), 'created')
+        indexed, indexed_read, fast = read_windows()
+        self.assertTrue(fast)
+        self.assertEqual(indexed_read, unindexed_read)
+        # 200 small windows read a few dozen points each through the index, but scan all 5000 without it
+        self.assertLess(indexed, unindexed)
+
+
+class TestOGRDatasetCollectionAdapter(TestCase):
+    def setUp(self):
+        from osgeo import ogr, osr
+        from django.contrib.gis.geos import Polygon
+        from ga_ows.models import wms
+        self.wms = wms
+        self.have_celery = wms.HAVE_CELERY
+        wms.HAVE_CELERY = False
+
+        self.dir = tempfile.mkdtemp()
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        collection = wms.OGRDatasetCollection.objects.create(name='tiles')
+        self.locations = {}
+        for name, x in (('west', 0), ('east', 20)):
+            location = self.locations[name] = os.path.join(self.dir, name + '.shp')
+            ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(location)
+            layer = ds.CreateLayer('parcels', srs, ogr.wkbPolygon)
+            layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+            f = ogr.Feature(layer.GetLayerDefn())
+            f.SetField('name', name)
+            f.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON(({0} 1, {1} 1, {1} 9, {0} 9, {0} 1))'.format(x + 1, x + 9)))
+            layer.CreateFeature(f)
+            ds = None
+            extent = Polygon.from_bbox((x, 0, x + 10, 10))
+            dataset = wms.OGRDataset.objects.create(collection=collection, location=location, checksum='1', name=name, extent=extent)
+            wms.OGRLayer.objects.create(dataset=dataset, name='parcels', extent=extent)
+
+        opened = self.opened = []
+        class RecordingPool(utils.OGRDataSourcePool):
+            def acquire(self, connection_string):
+                opened.append(connection_string)
+                return super(RecordingPool, self).acquire(connection_string)
+
+        from ga_ows.rendering.styler import Stylesheet
+        from ga_ows.views.wms import OGRDatasetCollectionAdapter
+        self.adapter = OGRDatasetCollectionAdapter('tiles', styles={'default' : Stylesheet(fill_color=(1., 0., 0., 1.))}, pool=RecordingPool())
+
+    def tearDown(self):
+        import shutil
+        self.adapter.pool.close_all()
+        self.wms.HAVE_CELERY = self.have_celery
+        shutil.rmtree(self.dir)
+
+    def testRenderOpensOverlappingDatasets(self):
+        box = self.adapter._lonlat_box('EPSG:4326', 0, 0, 10, 10)
+        self.assertEqual(box.srid, 4326)
+        self.assertEqual([row.dataset.name for row in self.adapter._layers(['parcels'], box)], ['west'])
+
+        surface = self.adapter.get_2d_dataset(layers=['parcels'], srs='EPSG:4326', bbox=(0, 0, 10, 10), width=64, height=64, styles=None)
+        self.assertEqual(self.opened, [self.locations['west']])
+        self.assertTrue(any(ord(c) for c in str(surface.get_data())))
+
+    def testGetFeatureInfo(self):
+        info = self.adapter.get_feature_info(25, 5, ['parcels'], None, 'application/json', 1, 'EPSG:4326', None, tolerance=0.1)
+        self.assertEqual([f['name'] for f in info['parcels']], ['east'])
+        self.assertEqual(self.opened, [self.locations['east']])
+
+        info = self.adapter.get_feature_info(15, 5, ['parcels'], None, 'application/json', 1, '4326', None, tolerance=0.1)
+        self.assertEqual(info['parcels'], [])
+
+        info = self.adapter.get_feature_info(25, 5, ['parcels'], None, 'application/json', 1, 'EPSG:4326', {'name' : 'west'}, tolerance=0.1)
+        self.assertEqual(info['parcels'], [])
+        info = self.adapter.get_feature_info(9.05, 5, ['parcels'], None, 'application/json', 1, 'EPSG:4326', {'name' : 'west'}, tolerance=0.1)
+        self.assertEqual([f['name'] for f in info['parcels']], ['west'])
+        info = self.adapter.get_feature_info(9.2, 5, ['parcels'], None, 'application/json', 1, 'EPSG:4326', None, tolerance=0.1)
+        self.assertEqual(info['parcels'], [])
+
+
+class TestPreloadedLayer(unittest.TestCase):
+    def setUp(self):
+        from osgeo import ogr, osr
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        self.ds = ogr.GetDriverByName('Memory').CreateDataSource('preload')
+        layer = self.ds.CreateLayer('points', srs, ogr.wkbPoint)
+        layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+        for k in range(100):
+            f = ogr.Feature(layer.GetLayerDefn())
+            f.SetField('value', k)
+            f.SetGeometry(ogr.CreateGeometryFromWkt('POINT({0} {0})'.format(k * 0.5)))
+            layer.CreateFeature(f)
+        self.layer = layer
+
+    def testQueryAndSelect(self):
+        from ga_ows.views.wms.ogr import PreloadedLayer
+        preloaded = PreloadedLayer(self.layer)
+        self.assertEqual(len(preloaded), 100)
+
+        positions = preloaded.query(10, 10, 20, 20)
+        self.assertEqual(list(positions), range(20, 41))
+
+        rules = sld.SLDParser()("""<FeatureTypeStyle xmlns="http://www.opengis.net/sld" xmlns:ogc="http://www.opengis.net/ogc">
+  <Rule>
+    <ogc:Filter>
+      <ogc:PropertyIsGreaterThan><ogc:PropertyName>value</ogc:PropertyName><ogc:Literal>35</ogc:Literal></ogc:PropertyIsGreaterThan>
+    </ogc:Filter>
+  </Rule>
+</FeatureTypeStyle>""")
+        self.assertEqual(list(preloaded.select(positions, rules, 1.0)), range(36, 41))
+
+        features = list(preloaded.features(preloaded.select(positions, rules, 1.0), ['value'], 'points'))
+        self.assertEqual([f['value'] for f in features], range(36, 41))
+        self.assertEqual(features[0]['points'].coords, (18.0, 18.0))
+
+
 class TestWFSHttpGet(TestCase):
     fixtures = ['wfs_test.json']
 
@@ -62,7 +1077,7 @@ class TestWFSHttpGet(TestCase):
         self.assertEqual(response.status_code, 200)
         _0, name = tempfile.mkstemp(dir='/Users/jeff/geoanalytics/tmp', prefix=request, suffix=suffix+".xml") #yes, I intend for this to not be deleted upon exit
         f = open(name,'w')
-        f.write(response.content)
+        f.write(''.join(response.streaming_content) if getattr(response, 'streaming', False) else response.content)
         f.close()
         print name
         return response
@@ -140,6 +1155,17 @@ class TestWFSHttpGet(TestCase):
             'outputformat' : 'GeoJSON',
         })
 
+    def testGetFeatureHits(self):
+        response = self.stdTestCall("GetFeature", suffix='-hits', parms={
+            'typenames' : ['ga_ows:WFSPointTest'],
+            'bbox' : '-81,29,-76,36',
+            'resulttype' : 'hits',
+            'outputformat' : 'GeoJSON',
+        })
+        hits = json.loads(response.content)
+        self.assertEqual(hits['numberReturned'], 0)
+        self.assertEqual(hits['features'], [])
+
     def testDescribeFeatureTypeJSON(self):
         self.stdTestCall("DescribeFeatureType", parms={"typename" : "ga_ows:WFSPointTest", "outputformat" : "json"})
 
@@ -3,12 +3,16 @@ functions in the module are probably the date manipulation functions.
 """
 
 from collections import namedtuple
+from contextlib import contextmanager
 import datetime
+import threading
+import time
 from django.core.exceptions import ValidationError
 from django.forms import MultipleChoiceField, Field
 from django.utils.formats import sanitize_separators
-from osgeo import osr
+from osgeo import gdal, ogr, osr
 import re
+import math
 
 def _from_today(match):    
     plusminus = match.group(1)
@@ -117,6 +121,34 @@ def parsetime(t):
     else:
         raise ValueError('time data does not match any valid format: ' + t)
 
+def compress_ranges(values, min_run=3):
+    """Collapse runs of evenly spaced values into ``{ 'range' : [first, last], 'step' : step }`` entries.  Values
+    that aren't part of a run of at least min_run values are left as they are.  This is the form GetValidTimes and
+    friends use for regular series, such as hourly model output::
+
+        >>> compress_ranges([1, 2, 3, 4, 10, 20])
+        [{'range': [1, 4], 'step': 1}, 10, 20]
+
+    :param values: A sorted list of values that support subtraction, such as numbers or datetimes.
+    :param min_run: The fewest values worth collapsing into a range.
+    """
+    ret = []
+    i = 0
+    n = len(values)
+    while i < n:
+        j = i + 1
+        if j < n:
+            step = values[j] - values[i]
+            while j + 1 < n and values[j + 1] - values[j] == step:
+                j += 1
+            if step and j - i + 1 >= min_run:
+                ret.append({ 'range' : [values[i], values[j]], 'step' : step })
+                i = j + 1
+                continue
+        ret.append(values[i])
+        i += 1
+    return ret
+
 def create_spatialref(srs, srs_format='srid'):
     """
     **Deprecated - use Django's SpatialRef class**. Create an :py:class:`osgeo.osr.SpatialReference` from an srid, wkt,
@@ -136,6 +168,35 @@ def create_spatialref(srs, srs_format='srid'):
         spatialref.ImportFromEPSG(int(srs.split(':')[1]))
     return spatialref
 
+def meters_per_unit(srs):
+    """
+    The length in meters of one unit of a spatial reference's coordinates, for converting pixel sizes to SLD scale
+    denominators.  Degrees are measured along the equator.  Accepts an :py:class:`osgeo.osr.SpatialReference` or a
+    Django SpatialReference.
+    """
+    if hasattr(srs, 'IsGeographic'):
+        geographic, linear_units = srs.IsGeographic(), srs.GetLinearUnits()
+    else:
+        geographic, linear_units = srs.geographic, srs.linear_units
+    if geographic:
+        return 6378137.0 * 2 * math.pi / 360
+    return linear_units or 1.0
+
+def stream_vsi(path, chunk_size=1 << 16):
+    """Generate the contents of a file in chunks through GDAL's virtual filesystem and unlink it afterwards.  This works
+    the same way for ``/vsimem`` buffers and for regular files on disk.
+    """
+    fp = gdal.VSIFOpenL(path, 'rb')
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, chunk_size, fp)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        gdal.VSIFCloseL(fp)
+        gdal.Unlink(path)
+
 mimetypes = namedtuple("MimeTypes", (
     'json', 'jsonp')
 )(
@@ -210,3 +271,149 @@ class BBoxField(Field):
         ux = float(sanitize_separators(ux))
         uy = float(sanitize_separators(uy))
         return lx, ly, ux, uy
+
+
+class PoolExhausted(Exception):
+    """Raised when every datasource in an :py:class:`OGRDataSourcePool` is in use and none is returned in time"""
+
+
+class OGRDataSourcePool(object):
+    """
+    A thread-safe, size-bounded pool of open OGR datasources keyed by connection string.  OGR datasources can't be
+    shared between threads, so a datasource is lent to one borrower at a time and goes back to the pool afterwards::
+
+        with ogr_pool.connection("PG:dbname='gis'") as ds:
+            layer = ds.GetLayerByName('roads')
+            ...
+
+    Datasources that have sat idle for longer than max_idle seconds are closed.  An idle datasource is health-checked
+    before it's lent out again if it has been idle for more than check_after seconds, and replaced if the check fails.
+    When all max_size datasources are in use, borrowers wait up to timeout seconds for one to come back.
+    """
+
+    def __init__(self, max_size=16, max_idle=300, check_after=30, timeout=30, update=False):
+        """
+        :param max_size: The maximum number of datasources open at once, across all connection strings
+        :param max_idle: Seconds an unused datasource is kept open
+        :param check_after: Seconds an unused datasource may sit before it is health-checked on checkout
+        :param timeout: Seconds to wait for a datasource when the pool is full
+        :param update: Open datasources for update.
+        """
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.update = update
+        self._lock = threading.Condition()
+        self._idle = {} # connection string -> list of (datasource, time returned)
+        self._open = 0
+        self._generation = 0 # bumped by close_all
+        self._lent = {} # id of a lent out datasource -> the generation it was lent in
+
+    def _close(self, ds):
+        self._open -= 1
+        ds.Release()
+
+    def _evict(self, now, everything=False):
+        for key in self._idle.keys():
+            keep = []
+            for ds, returned in self._idle[key]:
+                if everything or now - returned > self.max_idle:
+                    self._close(ds)
+                else:
+                    keep.append((ds, returned))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def _evict_oldest(self):
+        oldest = None
+        for key, idle in self._idle.items():
+            if idle and (oldest is None or idle[0][1] < oldest[1]):
+                oldest = (key, idle[0][1])
+        if oldest:
+            ds, _ = self._idle[oldest[0]].pop(0)
+            self._close(ds)
+            return True
+        return False
+
+    def healthy(self, ds):
+        """Check a datasource that has been idle for a while.  Database connections run a trivial query."""
+        try:
+            if ds.GetDriver().GetName() in ('PostgreSQL', 'MySQL', 'OCI', 'MSSQLSpatial'):
+                result = ds.ExecuteSQL('SELECT 1')
+                if result is None:
+                    return False
+                ds.ReleaseResultSet(result)
+            return ds.GetLayerCount() >= 0
+        except Exception:
+            return False
+
+    def acquire(self, connection_string):
+        """Borrow a datasource.  It must be given back with :py:meth:`release`."""
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                self._evict(now)
+                idle = self._idle.get(connection_string)
+                while idle:
+                    ds, returned = idle.pop()
+                    if now - returned <= self.check_after or self.healthy(ds):
+                        self._lent[id(ds)] = self._generation
+                        return ds
+                    self._close(ds)
+                if self._open < self.max_size or self._evict_oldest():
+                    self._open += 1
+                    break
+                if now >= deadline:
+                    raise PoolExhausted(connection_string)
+                self._lock.wait(deadline - now)
+
+        try:
+            ds = ogr.Open(connection_string, 1 if self.update else 0)
+        except Exception:
+            ds = None
+        with self._lock:
+            if ds is None:
+                self._open -= 1
+                self._lock.notify()
+            else:
+                self._lent[id(ds)] = self._generation
+        if ds is None:
+            raise IOError('could not open OGR datasource ' + connection_string)
+        return ds
+
+    def release(self, connection_string, ds, discard=False):
+        """Give back a borrowed datasource.  Discarded datasources, and ones lent out before the last
+        :py:meth:`close_all`, are closed instead of kept."""
+        with self._lock:
+            if self._lent.pop(id(ds), self._generation) != self._generation:
+                discard = True
+            if discard:
+                self._close(ds)
+            else:
+                self._idle.setdefault(connection_string, []).append((ds, time.time()))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, connection_string):
+        """Borrow a datasource for the duration of a with block.  It is discarded if the block raises."""
+        ds = self.acquire(connection_string)
+        try:
+            yield ds
+        except Exception:
+            self.release(connection_string, ds, discard=True)
+            raise
+        else:
+            self.release(connection_string, ds)
+
+    def close_all(self):
+        """Close every idle datasource.  Datasources that are lent out are closed when they come back."""
+        with self._lock:
+            self._generation += 1
+            self._evict(time.time(), everything=True)
+
+#: The process-wide OGR datasource pool.
+ogr_pool = OGRDataSourcePool()
@@ -1,11 +1,16 @@
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
 from django.http import HttpResponse
 from django.views.generic import View
 from django import forms as f
 from lxml import etree
 import pprint
 from ga_ows import utils
+from datetime import datetime, timedelta
+import hashlib
 import json
 import re
+from uuid import uuid4
 
 from ga_ows.utils import CaseInsensitiveDict, MultipleValueField
 
@@ -155,11 +160,72 @@ class CommonParameters(RequestForm):
         elif 'request' not in request:
             raise MissingParameterValue.at('request')
 
+def _generation_key(model):
+    return 'ga_ows:generation:' + model._meta.db_table
+
+def model_generation(model):
+    """The current generation of the responses cached about a model, such as capabilities documents and valid times.
+    A generation is a random token, so if it is evicted from the cache a new one takes its place and no stale response
+    is found under it."""
+    key = _generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+def invalidate_model(sender, **kwargs):
+    """Signal handler that retires every cached response about the sending model"""
+    cache.set(_generation_key(sender), uuid4().hex, None)
+
+_watched_models = set()
+
+def watch_model(model):
+    """Invalidate cached responses about a model whenever one of its instances is saved or deleted"""
+    if model not in _watched_models:
+        uid = 'ga_ows_generation_' + model._meta.db_table
+        post_save.connect(invalidate_model, sender=model, dispatch_uid=uid)
+        post_delete.connect(invalidate_model, sender=model, dispatch_uid=uid)
+        _watched_models.add(model)
+
+def adapter_models(adapter):
+    """The models behind an adapter, whose saves and deletes invalidate responses cached about it"""
+    if hasattr(adapter, 'cls'):
+        return [adapter.cls]
+    models = getattr(adapter, 'models', None) or []
+    if isinstance(models, dict):
+        models = models.values()
+    return sorted(models, key=lambda model: model._meta.db_table)
+
+def watch_adapter(adapter):
+    """Invalidate cached responses about an adapter's models whenever one of them is saved or deleted.  Adapters call
+    this when they're constructed, so that every process invalidates the shared generations from its first save
+    on, whether or not it has served a cached response yet."""
+    for model in adapter_models(adapter):
+        watch_model(model)
+
+def generational_key(view, *parts):
+    """A cache key for a response of a view that changes only when its request, the models behind it, or the
+    checksum of an adapter's files (its ``checksum()``, if it has one) do"""
+    adapter = getattr(view, 'adapter', None)
+    models = adapter_models(adapter)
+    checksum = adapter.checksum() if callable(getattr(adapter, 'checksum', None)) else None
+    return hashlib.sha1(str((
+        type(view).__module__,
+        type(view).__name__,
+        parts,
+        [model_generation(model) for model in models],
+        checksum
+    ))).hexdigest()
+
 class GetCapabilitiesMixin(object):
     """Class-based view mixin for parsing GetCapabilitles requests"""
 
     #: A request object containing .service, .accepted_versions, .sections, .accepted_formats, and .update_sequence.  See the OWS standard document for more details
 
+    #: Seconds a rendered capabilities document stays in Django's cache.  None renders it on every request.
+    capabilities_cache_timeout = 3600
+
     class Parameters(RequestForm):
         service = f.CharField()
         accepted_versions = MultipleValueField()
@@ -192,7 +258,27 @@ class GetCapabilitiesMixin(object):
         else:
             req =  GetCapabilitiesMixin.Parameters.create(kwargs)
 
-        return self.get_capabilities_response(request, req)
+        if self.capabilities_cache_timeout is None:
+            return self.get_capabilities_response(request, req)
+
+        # the document only changes when the request or the data does, so the generations of the models it describes
+        # name both the cache entry and the ETag
+        key = generational_key(self, request.build_absolute_uri().split('?')[0], sorted(req.cleaned_data.items()))
+        etag = '"' + key + '"'
+
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponse(status=304)
+        else:
+            document = cache.get('ga_ows:capabilities:' + key)
+            if document is None:
+                response = self.get_capabilities_response(request, req)
+                if response.status_code != 200:
+                    return response
+                document = (response.content, response['Content-Type'])
+                cache.set('ga_ows:capabilities:' + key, document, self.capabilities_cache_timeout)
+            response = HttpResponse(document[0], mimetype=document[1])
+        response['ETag'] = etag
+        return response
 
     def _parse_xml_GetCapabilities(self, root):
         """A document that should parse::
@@ -246,39 +332,29 @@ class GetCapabilitiesMixin(object):
 class OWSMixinBase(object):
     adapter = None
 
-class GetValidTimesMixin(OWSMixinBase):
-    class Parameters(CommonParameters):
-        callback = f.CharField(required=False)
-        layers = utils.MultipleValueField()
-
-        @classmethod
-        def from_request(cls, request):
-            request['layers'] = request.get('layers', '').split(',')
-            request['callback'] = request.get('callback', None)
-            if not request['callback']:
-                request['callback'] = request.get('jsonp', None)
+def _format_time(t):
+    return t.strftime('%Y.%m.%d-%H:%M:%S.%f')
 
+def _format_step(step):
+    if isinstance(step, timedelta):
+        return 'PT{seconds}S'.format(seconds=step.days * 86400 + step.seconds + step.microseconds / 1e6)
+    return step
 
-    def GetValidTimes(self, r, kwargs):
-        """Vendor extension that returns valid timestamps in json format"""
-        parms = GetValidTimesMixin.Parameters.create(kwargs)
-        if 'filter' in kwargs:
-            parms.cleaned_data['filter'] = json.loads(kwargs['filter'])
-        else:
-            parms.cleaned_data['filter'] = get_filter_params(kwargs)
+class ValidValuesMixinBase(OWSMixinBase):
+    """Shared handling of the GetValid* vendor extensions.  Answers are computed by the adapter, which should use
+    DISTINCT queries, and cached until a model behind the adapter changes.  The models' signals are connected when the
+    view or adapter is constructed (see :func:`watch_adapter`), so views using this mixin outside of :class:`OWSView`
+    should call it from their own constructor.  With compress=true, evenly spaced values are collapsed into
+    ``{ "range" : [first, last], "step" : step }`` entries.
+    """
 
-        if 'callback' in parms.cleaned_data and parms.cleaned_data['callback']:
-            return HttpResponse("{callback}({js})".format(
-                callback=kwargs['callback'],
-                js=json.dumps([t.strftime('%Y.%m.%d-%H:%M:%S.%f') for t in self.adapter.get_valid_times(**parms.cleaned_data)]), mimetype='test/jsonp'
-            ))
-        else:
-            return HttpResponse(json.dumps([t.strftime('%Y.%m.%d-%H:%M:%S.%f') for t in self.adapter.get_valid_times(**parms.cleaned_data)]), mimetype='application/json')
+    #: Seconds a GetValid* answer stays in Django's cache.  None computes it on every request.
+    valid_values_cache_timeout = 3600
 
-class GetValidVersionsMixin(OWSMixinBase):
     class Parameters(CommonParameters):
         callback = f.CharField(required=False)
         layers = utils.MultipleValueField()
+        compress = f.BooleanField(required=False)
 
         @classmethod
         def from_request(cls, request):
@@ -286,50 +362,68 @@ class GetValidVersionsMixin(OWSMixinBase):
             request['callback'] = request.get('callback', None)
             if not request['callback']:
                 request['callback'] = request.get('jsonp', None)
+            request['compress'] = request.get('compress', 'false') == 'true'
 
-    def GetValidVersions(self, r, kwargs):
-        """Vendor extension that returns valid version bands in json format"""
-        parms = GetValidTimesMixin.Parameters.create(kwargs)
+    def valid_values_response(self, kwargs, compute, format_value=lambda value: value):
+        """Answer a GetValid* request.
+
+        :param kwargs: The request parameters
+        :param compute: Called with the cleaned parameters to get the valid values from the adapter.
+        :param format_value: Turns each value into something JSON serializable.
+        """
+        parms = ValidValuesMixinBase.Parameters.create(kwargs)
         if 'filter' in kwargs:
             parms.cleaned_data['filter'] = json.loads(kwargs['filter'])
         else:
             parms.cleaned_data['filter'] = get_filter_params(kwargs)
-
-        if 'callback' in parms.cleaned_data and parms.cleaned_data['callback']:
-            return HttpResponse("{callback}({js})".format(
-                callback=kwargs['callback'],
-                js=json.dumps([t for t in self.adapter.get_valid_versions(**parms.cleaned_data)]), mimetype='test/jsonp'
-            ))
+        callback = parms.cleaned_data['callback']
+
+        def answer():
+            values = compute(**parms.cleaned_data)
+            if isinstance(values, dict):
+                return dict((format_value(k), v) for k, v in values.items())
+            values = list(values or [])
+            if parms.cleaned_data['compress']:
+                try:
+                    values = utils.compress_ranges(values)
+                except TypeError:
+                    pass  # values that can't be subtracted, such as version names
+            return [
+                { 'range' : [format_value(v['range'][0]), format_value(v['range'][1])], 'step' : _format_step(v['step']) }
+                if isinstance(v, dict) else format_value(v)
+                for v in values
+            ]
+
+        if self.valid_values_cache_timeout is None:
+            js = json.dumps(answer())
         else:
-            return HttpResponse(json.dumps([t for t in self.adapter.get_valid_versions(**parms.cleaned_data)]), mimetype='application/json')
+            cleaned = dict((k, v) for k, v in parms.cleaned_data.items() if k != 'callback')
+            key = 'ga_ows:valid:' + generational_key(self, compute.__name__, sorted(cleaned.items()))
+            js = cache.get(key)
+            if js is None:
+                js = json.dumps(answer())
+                cache.set(key, js, self.valid_values_cache_timeout)
+
+        if callback:
+            return HttpResponse("{callback}({js})".format(callback=callback, js=js), mimetype='text/javascript')
+        else:
+            return HttpResponse(js, mimetype='application/json')
 
-class GetValidElevationsMixin(OWSMixinBase):
-    class Parameters(CommonParameters):
-        callback = f.CharField(required=False)
-        layers = utils.MultipleValueField()
+class GetValidTimesMixin(ValidValuesMixinBase):
+    def GetValidTimes(self, r, kwargs):
+        """Vendor extension that returns valid timestamps in json format"""
+        return self.valid_values_response(kwargs, self.adapter.get_valid_times, _format_time)
 
-        @classmethod
-        def from_request(cls, request):
-            request['layers'] = request.get('layers', '').split(',')
-            request['callback'] = request.get('callback', None)
-            if not request['callback']:
-                request['callback'] = request.get('jsonp', None)
+class GetValidVersionsMixin(ValidValuesMixinBase):
+    def GetValidVersions(self, r, kwargs):
+        """Vendor extension that returns valid version bands in json format"""
+        return self.valid_values_response(kwargs, self.adapter.get_valid_versions,
+            lambda v: _format_time(v) if isinstance(v, datetime) else v)
 
+class GetValidElevationsMixin(ValidValuesMixinBase):
     def GetValidElevations(self, r, kwargs):
         """Vendor extension that returns valid elevation bands in json format"""
-        parms = GetValidTimesMixin.Parameters.create(kwargs)
-        if 'filter' in kwargs:
-            parms.cleaned_data['filter'] = json.loads(kwargs['filter'])
-        else:
-            parms.cleaned_data['filter'] = get_filter_params(kwargs)
-
-        if 'callback' in parms.cleaned_data:
-            return HttpResponse("{callback}({js})".format(
-                callback=kwargs['callback'],
-                js=json.dumps([t for t in self.adapter.get_valid_elevations(**parms.cleaned_data)]), mimetype='test/jsonp'
-            ))
-        else:
-            return HttpResponse(json.dumps([t for t in self.adapter.get_valid_elevations(**parms.cleaned_data)]), mimetype='application/json')
+        return self.valid_values_response(kwargs, self.adapter.get_valid_elevations)
 
 
 class OWSView(View, GetCapabilitiesMixin):
@@ -340,6 +434,11 @@ class OWSView(View, GetCapabilitiesMixin):
     #: you almost never get these
     extended_exceptions = True
 
+    def __init__(self, **kwargs):
+        super(OWSView, self).__init__(**kwargs)
+        # adapters built by ga_ows watch their models themselves; this covers any other adapter
+        watch_adapter(getattr(self, 'adapter', None))
+
     def _parse_xml_Request(self, raw_post_data):
         root = etree.fromstring(raw_post_data)
         request = re.sub('{[^}]}', '', root.tag)
@@ -0,0 +1,486 @@
+"""
+An implementation of OGC WCS 1.0.0 over the top of GDAL.  The module provides a generic view, :py:class:WCS, that
+answers GetCapabilities, DescribeCoverage and GetCoverage requests for any raster GDAL can open.  To use WCS with your
+application, derive from :py:class:WCSAdapterBase or use :py:class:GDALWCSAdapter directly::
+
+    url(r'^wcs/?', WCS.as_view(
+        adapter=GDALWCSAdapter({
+            'elevation' : '/data/srtm/n35w080.tif',
+            'landcover' : '/data/nlcd/nlcd2006.tif'
+        }),
+        title='My app\'s WCS'
+    ))
+
+GetCoverage never reads more of the source raster than the requested bounding box.  Subsets are read with windowed
+(and, where a resolution or size is requested, decimated) GDAL reads one strip of rows at a time and written to an
+encoded file in ``/vsimem`` or, for large extracts, to a temporary file on disk.  The encoded file is streamed back
+to the client in chunks, so a multi-gigabyte extract never has to sit in process memory all at once.
+
+Coverages requested in a CRS other than their own are reprojected through in-memory warped VRTs, which are cached per
+source, target CRS, and zoom level by :mod:ga_ows.rendering.warp.
+
+The following features remain unimplemented:
+    * Interpolation methods other than nearest neighbour
+    * Time and elevation subsetting
+    * XML encoded POST requests
+"""
+import math
+import os
+import tempfile
+from uuid import uuid4
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django import forms as f
+from lxml import etree
+from osgeo import gdal, osr
+
+from ga_ows import utils
+from ga_ows.rendering import warp
+from ga_ows.views import common
+
+WCS_NS = 'http://www.opengis.net/wcs'
+GML_NS = 'http://www.opengis.net/gml'
+
+#: GDAL driver names and mimetypes for the formats that GetCoverage will recognize by their common names.  Any other
+#: format is assumed to be the short name of a GDAL driver.
+FORMATS = {
+    'geotiff' : ('GTiff', 'tif', 'image/tiff'),
+    'gtiff' : ('GTiff', 'tif', 'image/tiff'),
+    'tiff' : ('GTiff', 'tif', 'image/tiff'),
+    'image/tiff' : ('GTiff', 'tif', 'image/tiff'),
+    'png' : ('PNG', 'png', 'image/png'),
+    'image/png' : ('PNG', 'png', 'image/png'),
+    'jpeg' : ('JPEG', 'jpg', 'image/jpeg'),
+    'jpg' : ('JPEG', 'jpg', 'image/jpeg'),
+    'image/jpeg' : ('JPEG', 'jpg', 'image/jpeg'),
+    'netcdf' : ('netCDF', 'nc', 'application/x-netcdf'),
+    'hfa' : ('HFA', 'img', 'application/octet-stream'),
+}
+
+#: The number of bytes handed to the webserver per chunk of a streamed coverage.
+CHUNK_SIZE = 1 << 16
+
+#: The number of output rows read and written at a time when subsetting a coverage.
+STRIP_HEIGHT = 256
+
+
+def _output_format(fmt):
+    """Return the GDAL driver, file extension, and mimetype for a requested format"""
+    if fmt.lower() in FORMATS:
+        drvname, ext, mimetype = FORMATS[fmt.lower()]
+    else:
+        drvname, ext, mimetype = fmt, fmt.lower(), 'application/octet-stream'
+
+    driver = gdal.GetDriverByName(drvname.encode('ascii'))
+    if driver is None:
+        raise common.InvalidParameterValue.at('format', 'format {fmt} not supported'.format(fmt=fmt))
+    return driver, ext, mimetype
+
+
+class Subset(object):
+    """The pixel window of a source raster that covers a requested bounding box, and the size and geotransform of the
+    output grid it is resampled to.
+    """
+
+    def __init__(self, ds, bbox, width=None, height=None, resx=None, resy=None):
+        """
+        :param ds: The source gdal.Dataset.  Must be north-up (no rotation terms in its geotransform)
+        :param bbox: (minx, miny, maxx, maxy) in the source dataset's coordinate system
+        :param width: The output width in pixels, optional
+        :param height: The output height in pixels, optional
+        :param resx: The output x resolution in coordinate system units, optional.  Ignored if width is given.
+        :param resy: The output y resolution in coordinate system units, optional.  Ignored if height is given.
+        """
+        gt = ds.GetGeoTransform()
+        if gt[2] != 0 or gt[4] != 0:
+            raise common.NoApplicableCode.at('GetCoverage', 'rotated rasters are not supported')
+
+        minx, miny, maxx, maxy = bbox
+        x0 = int(math.floor((minx - gt[0]) / gt[1]))
+        x1 = int(math.ceil((maxx - gt[0]) / gt[1]))
+        y0 = int(math.floor((maxy - gt[3]) / gt[5]))
+        y1 = int(math.ceil((miny - gt[3]) / gt[5]))
+
+        self.xoff = max(0, x0)
+        self.yoff = max(0, y0)
+        self.xsize = min(ds.RasterXSize, x1) - self.xoff
+        self.ysize = min(ds.RasterYSize, y1) - self.yoff
+        if self.xsize <= 0 or self.ysize <= 0:
+            raise common.InvalidParameterValue.at('bbox', 'bbox does not intersect the coverage')
+
+        # bounds of the clamped pixel window, in coordinate system units
+        west = gt[0] + self.xoff * gt[1]
+        north = gt[3] + self.yoff * gt[5]
+        span_x = self.xsize * gt[1]
+        span_y = self.ysize * -gt[5]
+
+        if width:
+            self.width = width
+        elif resx:
+            self.width = max(1, int(round(span_x / resx)))
+        else:
+            self.width = self.xsize
+
+        if height:
+            self.height = height
+        elif resy:
+            self.height = max(1, int(round(span_y / resy)))
+        else:
+            self.height = self.ysize
+
+        self.geotransform = (west, span_x / self.width, 0, north, 0, -span_y / self.height)
+
+    def strips(self, strip_height=STRIP_HEIGHT):
+        """Yield (source_yoff, source_ysize, output_yoff, output_ysize) for each strip of output rows."""
+        scale = float(self.ysize) / self.height
+        for row in range(0, self.height, strip_height):
+            rows = min(strip_height, self.height - row)
+            src_y0 = self.yoff + int(math.floor(row * scale))
+            src_y1 = self.yoff + int(math.ceil((row + rows) * scale))
+            yield src_y0, max(1, min(src_y1, self.yoff + self.ysize) - src_y0), row, rows
+
+
+def write_subset(src, subset, bands, target, driver, creation_options=()):
+    """Copy the subset of a source dataset into a new dataset at target, a strip of rows at a time.  Drivers that can
+    only CreateCopy are filled through an intermediate MEM dataset.
+
+    :param src: The source gdal.Dataset
+    :param subset: A :class:Subset of the source dataset
+    :param bands: A list of 1-based band indices to copy
+    :param target: A path (including ``/vsimem`` paths) to write to
+    :param driver: The output GDAL driver
+    :param creation_options: Driver specific creation options
+    """
+    datatype = src.GetRasterBand(bands[0]).DataType
+    can_create = driver.GetMetadataItem(gdal.DCAP_CREATE) == 'YES'
+    if can_create:
+        dst = driver.Create(target, subset.width, subset.height, len(bands), datatype, list(creation_options))
+    else:
+        dst = gdal.GetDriverByName('MEM').Create('', subset.width, subset.height, len(bands), datatype)
+
+    dst.SetGeoTransform(subset.geotransform)
+    dst.SetProjection(src.GetProjection())
+
+    for i, band in enumerate(bands):
+        src_band = src.GetRasterBand(band)
+        dst_band = dst.GetRasterBand(i+1)
+        nodata = src_band.GetNoDataValue()
+        if nodata is not None:
+            dst_band.SetNoDataValue(nodata)
+        for src_y, src_rows, dst_y, dst_rows in subset.strips():
+            data = src_band.ReadRaster(subset.xoff, src_y, subset.xsize, src_rows, subset.width, dst_rows)
+            dst_band.WriteRaster(0, dst_y, subset.width, dst_rows, data)
+
+    if not can_create:
+        # the copy is closed, and so written out, as soon as it's dropped
+        driver.CreateCopy(target, dst, 0, list(creation_options))
+    del dst
+
+
+########################################################################################################################
+# Adapter class
+########################################################################################################################
+
+class WCSAdapterBase(object):
+    """ An abstract base-class for adapting a raster source to the WCS implementation given in this module.
+    """
+
+    #: Encoded coverages estimated to be smaller than this many bytes are written to ``/vsimem``.  Larger ones are
+    #: written to a temporary file on disk before being streamed.
+    in_memory_limit = 64 * 1024 * 1024
+
+    #: The :class:ga_ows.rendering.warp.WarpPlanCache used when a coverage is requested in a CRS other than its own.
+    warp_plans = warp.warp_plans
+
+    def coverage_list(self):
+        """**REQUIRED** Get a listing of the valid coverage names.
+        :return: A list of coverage names
+        """
+        raise NotImplementedError("Must implement coverage_list to avoid being abstract")
+
+    def get_coverage_dataset(self, coverage):
+        """**REQUIRED** Get the source dataset for a coverage.
+        :param coverage: The coverage name
+        :return: An osgeo.gdal.Dataset
+        """
+        raise NotImplementedError("Must implement get_coverage_dataset to avoid being abstract")
+
+    def get_coverage_title(self, coverage):
+        """The human readable title of the coverage.  Defaults to the coverage name."""
+        return coverage
+
+    def get_coverage_description(self, coverage):
+        """Describe a coverage for DescribeCoverage and GetCapabilities.
+
+        :return: a dict in this format::
+
+            { "name" : coverage_name,
+              "title" : human_readable_title,
+              "srs" : native_srs_wkt,
+              "bbox" : (minx, miny, maxx, maxy), // native srs
+              "ll_bbox" : (minx, miny, maxx, maxy), // epsg:4326
+              "width" : raster_width,
+              "height" : raster_height,
+              "bands" : band_count }
+        """
+        ds = self.get_coverage_dataset(coverage)
+        if ds is None:
+            raise common.InvalidParameterValue.at('coverage', coverage)
+        gt = ds.GetGeoTransform()
+        minx = gt[0]
+        maxx = gt[0] + ds.RasterXSize * gt[1]
+        maxy = gt[3]
+        miny = gt[3] + ds.RasterYSize * gt[5]
+
+        s_srs = osr.SpatialReference()
+        s_srs.ImportFromWkt(ds.GetProjection())
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromEPSG(4326)
+        crx = osr.CoordinateTransformation(s_srs, t_srs)
+        ll_minx, ll_miny, _0 = crx.TransformPoint(minx, miny, 0)
+        ll_maxx, ll_maxy, _0 = crx.TransformPoint(maxx, maxy, 0)
+
+        return {
+            "name" : coverage,
+            "title" : self.get_coverage_title(coverage),
+            "srs" : ds.GetProjection(),
+            "bbox" : (minx, miny, maxx, maxy),
+            "ll_bbox" : (ll_minx, ll_miny, ll_maxx, ll_maxy),
+            "width" : ds.RasterXSize,
+            "height" : ds.RasterYSize,
+            "bands" : ds.RasterCount
+        }
+
+    def get_coverage(self, coverage, bbox, crs, width, height, resx, resy, bands, format, **kwargs):
+        """Subset and encode a coverage.
+
+        :param coverage: The coverage name
+        :param bbox: The bounding box (minx, miny, maxx, maxy) in the request CRS
+        :param crs: The request CRS as an EPSG code, or None for the coverage's native CRS.  Coverages requested in
+            another CRS are read through a cached warp plan (see :mod:ga_ows.rendering.warp)
+        :param width: The output width or None
+        :param height: The output height or None
+        :param resx: The output x resolution or None.
+        :param resy: The output y resolution or None
+        :param bands: A list of 1-based band indices, or an empty list for all bands.
+        :param format: The output format, see :const:FORMATS
+        :return: A tuple of (path, extension, mimetype) of the encoded coverage.  The path is a GDAL virtual filesystem
+            path and should be streamed with :func:ga_ows.utils.stream_vsi, which removes it when it's done.
+        """
+        ds = self.get_coverage_dataset(coverage)
+        if ds is None:
+            raise common.InvalidParameterValue.at('coverage', coverage)
+
+        if crs:
+            native = osr.SpatialReference()
+            native.ImportFromWkt(ds.GetProjection())
+            t_srs = utils.create_spatialref(crs, srs_format=None)
+            if not native.IsSame(t_srs):
+                minx, miny, maxx, maxy = bbox
+                if width:
+                    pixel_size = (maxx - minx) / width
+                else:
+                    pixel_size = resx
+                ds = self.warp_plans.warped(coverage, ds, t_srs.ExportToWkt(), pixel_size)
+
+        if not bands:
+            bands = range(1, ds.RasterCount+1)
+        elif [b for b in bands if b < 1 or b > ds.RasterCount]:
+            raise common.InvalidParameterValue.at('band', 'coverage {c} has {n} bands'.format(c=coverage, n=ds.RasterCount))
+
+        subset = Subset(ds, bbox, width=width, height=height, resx=resx, resy=resy)
+        driver, ext, mimetype = _output_format(format)
+
+        pixel_bytes = gdal.GetDataTypeSize(ds.GetRasterBand(bands[0]).DataType) / 8
+        estimate = subset.width * subset.height * len(bands) * pixel_bytes
+        if estimate <= self.in_memory_limit:
+            target = '/vsimem/ga_ows_wcs_{uuid}.{ext}'.format(uuid=uuid4(), ext=ext)
+        else:
+            fd, target = tempfile.mkstemp(prefix='ga_ows_wcs_', suffix='.' + ext)
+            os.close(fd)
+
+        written = False
+        try:
+            write_subset(ds, subset, bands, target, driver)
+            written = True
+        finally:
+            # a partly written coverage would never be streamed, and so never removed
+            if not written:
+                gdal.Unlink(target)
+        return target, ext, mimetype
+
+
+class GDALWCSAdapter(WCSAdapterBase):
+    """A default implementation of the WCS adapter for a set of rasters that GDAL can open."""
+
+    def __init__(self, coverages, titles=None):
+        """
+        :param coverages: A dict of coverage names to GDAL openable locations
+        :param titles: An optional dict of coverage names to human readable titles.
+        """
+        self.coverages = coverages
+        self.titles = titles or {}
+
+    def coverage_list(self):
+        return sorted(self.coverages.keys())
+
+    def get_coverage_title(self, coverage):
+        return self.titles.get(coverage, coverage)
+
+    def get_coverage_dataset(self, coverage):
+        if coverage not in self.coverages:
+            raise common.InvalidParameterValue.at('coverage', coverage)
+        return gdal.Open(self.coverages[coverage])
+
+
+########################################################################################################################
+# WCS itself.
+########################################################################################################################
+
+class DescribeCoverageMixin(common.OWSMixinBase):
+    """ Handle the DescribeCoverage request in WCS.
+    """
+    class Parameters(common.CommonParameters):
+        coverage = utils.MultipleValueField()
+
+        @classmethod
+        def from_request(cls, request):
+            request['coverage'] = request.get('coverage', '').split(',')
+
+    def _coverage_offering(self, parent, description, brief=False):
+        offering = etree.SubElement(parent, '{%s}CoverageOffering%s' % (WCS_NS, 'Brief' if brief else ''))
+        etree.SubElement(offering, '{%s}name' % WCS_NS).text = description['name']
+        etree.SubElement(offering, '{%s}label' % WCS_NS).text = description['title']
+        env = etree.SubElement(offering, '{%s}lonLatEnvelope' % WCS_NS, srsName='urn:ogc:def:crs:OGC:1.3:CRS84')
+        etree.SubElement(env, '{%s}pos' % GML_NS).text = '{0} {1}'.format(*description['ll_bbox'][0:2])
+        etree.SubElement(env, '{%s}pos' % GML_NS).text = '{0} {1}'.format(*description['ll_bbox'][2:4])
+        if brief:
+            return offering
+
+        spatial = etree.SubElement(etree.SubElement(offering, '{%s}domainSet' % WCS_NS), '{%s}spatialDomain' % WCS_NS)
+        env = etree.SubElement(spatial, '{%s}Envelope' % GML_NS)
+        etree.SubElement(env, '{%s}pos' % GML_NS).text = '{0} {1}'.format(*description['bbox'][0:2])
+        etree.SubElement(env, '{%s}pos' % GML_NS).text = '{0} {1}'.format(*description['bbox'][2:4])
+        grid = etree.SubElement(spatial, '{%s}Grid' % GML_NS, dimension='2')
+        limits = etree.SubElement(etree.SubElement(grid, '{%s}limits' % GML_NS), '{%s}GridEnvelope' % GML_NS)
+        etree.SubElement(limits, '{%s}low' % GML_NS).text = '0 0'
+        etree.SubElement(limits, '{%s}high' % GML_NS).text = '{0} {1}'.format(description['width']-1, description['height']-1)
+
+        rng = etree.SubElement(etree.SubElement(offering, '{%s}rangeSet' % WCS_NS), '{%s}RangeSet' % WCS_NS)
+        etree.SubElement(rng, '{%s}name' % WCS_NS).text = 'band'
+        axis = etree.SubElement(etree.SubElement(rng, '{%s}axisDescription' % WCS_NS), '{%s}AxisDescription' % WCS_NS)
+        etree.SubElement(axis, '{%s}name' % WCS_NS).text = 'band'
+        values = etree.SubElement(axis, '{%s}values' % WCS_NS)
+        for band in range(1, description['bands']+1):
+            etree.SubElement(values, '{%s}singleValue' % WCS_NS).text = str(band)
+
+        crss = etree.SubElement(offering, '{%s}supportedCRSs' % WCS_NS)
+        etree.SubElement(crss, '{%s}requestResponseCRSs' % WCS_NS).text = description['srs']
+        formats = etree.SubElement(offering, '{%s}supportedFormats' % WCS_NS)
+        for fmt in sorted(set(FORMATS[k][0] for k in FORMATS)):
+            etree.SubElement(formats, '{%s}formats' % WCS_NS).text = fmt
+        return offering
+
+    def DescribeCoverage(self, r, kwargs):
+        parms = DescribeCoverageMixin.Parameters.create(kwargs).cleaned_data
+        coverages = [c for c in parms['coverage'] if c] or self.adapter.coverage_list()
+
+        response = etree.Element('{%s}CoverageDescription' % WCS_NS, nsmap={None : WCS_NS, 'gml' : GML_NS}, version='1.0.0')
+        for coverage in coverages:
+            self._coverage_offering(response, self.adapter.get_coverage_description(coverage))
+        return HttpResponse(etree.tostring(response, pretty_print=True, xml_declaration=True), mimetype='text/xml')
+
+
+class GetCoverageMixin(common.OWSMixinBase):
+    """ Handle the GetCoverage request.  This is the central request of WCS.
+    """
+    class Parameters(common.CommonParameters):
+        coverage = f.CharField()
+        crs = f.CharField(required=False)
+        bbox = utils.BBoxField()
+        width = f.IntegerField(required=False)
+        height = f.IntegerField(required=False)
+        resx = f.FloatField(required=False)
+        resy = f.FloatField(required=False)
+        bands = utils.MultipleValueField(required=False)
+        format = f.CharField()
+
+        @classmethod
+        def from_request(cls, request):
+            request['coverage'] = request.get('coverage')
+            request['crs'] = request.get('crs', None)
+            request['bbox'] = request.get('bbox')
+            request['width'] = request.get('width')
+            request['height'] = request.get('height')
+            request['resx'] = request.get('resx')
+            request['resy'] = request.get('resy')
+            request['bands'] = [b for b in request.get('band', '').split(',') if b]
+            request['format'] = request.get('format', 'GeoTIFF')
+
+    def GetCoverage(self, r, kwargs):
+        parms = GetCoverageMixin.Parameters.create(kwargs).cleaned_data
+
+        try:
+            parms['bands'] = [int(b) for b in parms['bands']]
+        except ValueError:
+            raise common.InvalidParameterValue.at('band', 'bands must be integer indices')
+
+        path, ext, mimetype = self.adapter.get_coverage(**parms)
+
+        resp = StreamingHttpResponse(utils.stream_vsi(path, CHUNK_SIZE), mimetype=mimetype)
+        resp['Content-Disposition'] = 'attachment; filename={coverage}.{ext}'.format(coverage=parms['coverage'], ext=ext)
+        return resp
+
+
+class WCS(
+    common.OWSView,
+    DescribeCoverageMixin,
+    GetCoverageMixin
+):
+    """
+    A Django generic view for handling a WCS service.  The basic WCS service contains methods for GetCapabilities,
+    DescribeCoverage, and GetCoverage.
+
+    As with :class:ga_ows.views.wms.WMS, the view parses and validates requests and leaves the actual work to an
+    adapter, which should derive from :class:WCSAdapterBase.
+    """
+
+    #: The WCSAdapterBase subclass assigned to this view.  This is **required**.
+    adapter = None
+
+    #: The title of the service
+    title = "Geoanalytics WCS"
+
+    #: Metadata keywords as a list
+    keywords = []
+
+    #: Fees associated with using the service
+    fees = None
+
+    #: Constraints on service usage
+    constraints = None
+
+    def get_capabilities_response(self, request, req):
+        response = etree.Element('{%s}WCS_Capabilities' % WCS_NS, nsmap={None : WCS_NS, 'gml' : GML_NS}, version='1.0.0')
+        service = etree.SubElement(response, '{%s}Service' % WCS_NS)
+        etree.SubElement(service, '{%s}name' % WCS_NS).text = 'WCS'
+        etree.SubElement(service, '{%s}label' % WCS_NS).text = self.title
+        if self.keywords:
+            keywords = etree.SubElement(service, '{%s}keywords' % WCS_NS)
+            for keyword in self.keywords:
+                etree.SubElement(keywords, '{%s}keyword' % WCS_NS).text = keyword
+        etree.SubElement(service, '{%s}fees' % WCS_NS).text = self.fees or 'NONE'
+        etree.SubElement(service, '{%s}accessConstraints' % WCS_NS).text = self.constraints or 'NONE'
+
+        capability = etree.SubElement(response, '{%s}Capability' % WCS_NS)
+        endpoint = request.build_absolute_uri().split('?')[0]
+        requests = etree.SubElement(capability, '{%s}Request' % WCS_NS)
+        for operation in ('GetCapabilities', 'DescribeCoverage', 'GetCoverage'):
+            http = etree.SubElement(etree.SubElement(etree.SubElement(requests, '{%s}%s' % (WCS_NS, operation)), '{%s}DCPType' % WCS_NS), '{%s}HTTP' % WCS_NS)
+            etree.SubElement(etree.SubElement(http, '{%s}Get' % WCS_NS), '{%s}OnlineResource' % WCS_NS, attrib={'{http://www.w3.org/1999/xlink}href' : endpoint})
+
+        contents = etree.SubElement(response, '{%s}ContentMetadata' % WCS_NS)
+        for coverage in self.adapter.coverage_list():
+            self._coverage_offering(contents, self.adapter.get_coverage_description(coverage), brief=True)
+
+        return HttpResponse(etree.tostring(response, pretty_print=True, xml_declaration=True), mimetype='text/xml')
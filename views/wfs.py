@@ -20,19 +20,29 @@ The following features remain unimplemented:
     * The standard XML filter language (instead I intend to support OGR SQL and the Django filter language)
 """
 from collections import namedtuple
+import base64
+import hashlib
+import itertools
+from datetime import datetime
 from uuid import uuid4
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from xml.sax.saxutils import escape as xml_escape, quoteattr
 from django.contrib.gis.db.models.query import GeoQuerySet
 from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import Polygon
+from django.contrib.gis.gdal import SpatialReference
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
 from django import forms as f
 import json
+from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import render_to_response
+from ga_ows.models.wms import LayerExtent
 from ga_ows.views import common
-from ga_ows.utils import MultipleValueField, BBoxField, CaseInsensitiveDict
+from ga_ows.utils import MultipleValueField, BBoxField, CaseInsensitiveDict, stream_vsi
 from lxml import etree
 from ga_ows.views.common import RequestForm, CommonParameters, GetCapabilitiesMixin
-from osgeo import ogr
-from django.conf import settings
+from osgeo import gdal, ogr, osr
 from tempfile import gettempdir
 from django.db import connections
 import re
@@ -60,9 +70,11 @@ class PresentationParameters(RequestForm):
     start_index = f.IntegerField()
     max_features = f.IntegerField()
     output_format = f.CharField()
+    result_type = f.CharField(required=False)
 
     @classmethod
     def from_request(cls, request):
+        request['result_type'] = request.get('resulttype', 'results').lower()
         request['count'] = int(request.get('count', '1'))
         request['start_index'] = int(request.get('startindex','1'))
         request['max_features'] = int(request.get('maxfeatures', '1'))
@@ -76,6 +88,7 @@ class AdHocQueryParameters(RequestForm):
     resource_id = f.CharField(required=False)
     bbox = BBoxField()
     sort_by = f.CharField(required=False)
+    page_token = f.CharField(required=False)
 
     @classmethod
     def from_request(cls, request):
@@ -86,6 +99,7 @@ class AdHocQueryParameters(RequestForm):
         request['resource_id'] = request.get('resource_id')
         request['bbox'] = request.get('bbox')
         request['sort_by'] = request.get('sortby')
+        request['page_token'] = request.get('pagetoken')
 
 class StoredQueryParameters(RequestForm):
     stored_query_id = f.CharField(required=False)
@@ -218,6 +232,151 @@ class WFSAdapter(object):
     def supports_feature_versioning(self):
         return False
 
+def query_digest(*parts):
+    """A short digest of the parts of a GetFeature query that decide which features it matches and their order"""
+    return hashlib.sha1(json.dumps(parts, cls=DjangoJSONEncoder)).hexdigest()[:16]
+
+def encode_page_token(digest, key):
+    """An opaque GetFeature page token holding the sort key (sort fields then primary key) of the last feature of a
+    page, and the digest of the query it belongs to"""
+    return base64.urlsafe_b64encode(json.dumps({ 'q' : digest, 'k' : list(key) }, cls=DjangoJSONEncoder))
+
+def decode_page_token(token, digest, length):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (ValueError, TypeError):
+        decoded = None
+    if not isinstance(decoded, dict) or decoded.get('q') != digest or not isinstance(decoded.get('k'), list) or len(decoded['k']) != length:
+        raise common.InvalidParameterValue.at('pageToken', 'page token does not belong to this query')
+    return decoded['k']
+
+#: Databases that sort NULLs after every value in ascending order, and before every value in descending order.
+#: The others (SQLite and Spatialite, MySQL) sort them the other way around.
+NULLS_LAST_VENDORS = ('postgresql', 'oracle')
+
+def keyset_filter(sort_keys, key, vendor='postgresql'):
+    """A filter that selects the rows that come after key in the order given by sort_keys.  For keys (a, b, pk) that is
+    a > ka OR (a = ka AND b > kb) OR (a = ka AND b = kb AND pk > kpk), with < for descending keys.  Each page is then
+    an index seek instead of an OFFSET that scans every row before it.
+
+    NULLs are placed the way the database named by vendor (a connection's ``vendor``) orders them; see
+    :const:`NULLS_LAST_VENDORS`.
+    """
+    nulls_last = vendor in NULLS_LAST_VENDORS
+
+    def equal(field, value):
+        return Q(**{ field + '__isnull' : True }) if value is None else Q(**{ field : value })
+
+    def after(sort_key, value):
+        field = sort_key.lstrip('-')
+        descending = sort_key.startswith('-')
+        # whether NULLs come after the values in this key's direction
+        nulls_after = descending != nulls_last
+        if value is None:
+            return None if nulls_after else Q(**{ field + '__isnull' : False })
+        q = Q(**{ field + ('__lt' if descending else '__gt') : value })
+        return q | Q(**{ field + '__isnull' : True }) if nulls_after else q
+
+    q = None
+    for i, sort_key in enumerate(sort_keys):
+        term = after(sort_key, key[i])
+        if term is None:
+            continue
+        for previous, value in zip(sort_keys[:i], key[:i]):
+            term &= equal(previous.lstrip('-'), value)
+        q = term if q is None else q | term
+    # only reachable when every key but the primary key is NULL, and the primary key never is
+    return q if q is not None else Q(pk__in=[])
+
+
+class FeaturePage(object):
+    """A page of GetFeature results.  The query set is sliced to one row more than the page, so the query that fetches
+    the page also tells whether a next page exists, and the last row of the page gives its token.  The serializers
+    read their rows through :meth:`fetch`.
+    """
+    def __init__(self, size, keys, digest):
+        """
+        :param size: The number of features on a page
+        :param keys: The attnames of the sort key columns, the primary key last
+        :param digest: The :func:`query_digest` of the query, which the page token is bound to
+        """
+        self.size = size
+        self.keys = keys
+        self.digest = digest
+        self.next_token = None
+        #: A function of a page token that gives the URL of that page.  Set by the view.
+        self.url = None
+
+    @property
+    def next_url(self):
+        if self.next_token and self.url:
+            return self.url(self.next_token)
+        return None
+
+    def fetch(self, rows, key):
+        """Read the page from an iterable of up to size+1 rows.
+
+        :param rows: The rows of the sliced query set
+        :param key: A function giving the sort key of a row, in the order of keys.
+        :return: A list of at most size rows.
+        """
+        rows = list(itertools.islice(rows, self.size + 1))
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            self.next_token = encode_page_token(self.digest, key(rows[-1]))
+        return rows
+
+def _page_rows(rows, page, key):
+    """The rows of a values() or values_list() query set, through a page if there is one"""
+    if page is None:
+        return rows.iterator()
+    return page.fetch(rows.iterator(), key)
+
+def bbox_polygon(bbox, srid, target_srid, densify=8):
+    """A bounding box as a polygon in another SRS.  Each side is split into densify segments before it is transformed,
+    so that the polygon still covers the whole box where the projection curves straight lines.
+
+    :param bbox: (minx, miny, maxx, maxy) in srid
+    :param srid: The SRID of the bbox
+    :param target_srid: The SRID of the polygon
+    :return: A GEOS Polygon
+    """
+    mnx, mny, mxx, mxy = bbox
+    dx = (mxx - mnx) / densify
+    dy = (mxy - mny) / densify
+    ring = [(mnx + dx*i, mny) for i in range(densify)] + \
+           [(mxx, mny + dy*i) for i in range(densify)] + \
+           [(mxx - dx*i, mxy) for i in range(densify)] + \
+           [(mnx, mxy - dy*i) for i in range(densify)] + \
+           [(mnx, mny)]
+    polygon = Polygon(ring, srid=srid)
+    if srid != target_srid:
+        polygon.transform(target_srid)
+    return polygon
+
+#: srsName forms that name an EPSG code: EPSG:4326, urn:ogc:def:crs:EPSG::4326, http://www.opengis.net/def/crs/EPSG/0/4326
+#: and http://www.opengis.net/gml/srs/epsg.xml#4326.  A bare number is taken as an SRID.
+SRS_NAME_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'^(?:epsg:)?(\d+)$',
+    r'^urn:ogc:def:crs:epsg:[^:]*:(\d+)$',
+    r'^https?://www\.opengis\.net/def/crs/epsg/[^/]+/(\d+)$',
+    r'^https?://www\.opengis\.net/gml/srs/epsg\.xml#(\d+)$',
+)]
+
+#: srsName forms of OGC:CRS84, which is WGS84 in longitude, latitude order.
+CRS84_NAMES = ('crs:84', 'urn:ogc:def:crs:ogc:1.3:crs84', 'http://www.opengis.net/def/crs/ogc/1.3/crs84')
+
+def srid_of(srs_name):
+    """The SRID a srsName names.  Raises InvalidParameterValue for names that aren't an EPSG code or CRS84."""
+    srs_name = srs_name.strip()
+    if srs_name.lower() in CRS84_NAMES:
+        return 4326
+    for pattern in SRS_NAME_PATTERNS:
+        match = pattern.match(srs_name)
+        if match:
+            return int(match.group(1))
+    raise common.InvalidParameterValue.at('srsName', '{0} is not an EPSG code, EPSG URN or URL, or CRS84'.format(srs_name))
+
 class GeoDjangoWFSAdapter(WFSAdapter):
     def __init__(self, models):
         self.models = {}
@@ -230,6 +389,8 @@ class GeoDjangoWFSAdapter(WFSAdapter):
                 if isinstance(field, GeometryField):
                     self.geometries[model._meta.app_label + ":" + model._meta.object_name] = field
                     self.srids[model._meta.app_label + ":" + model._meta.object_name] = field.srid
+            LayerExtent.watch(model)
+            common.watch_model(model)
 
     def list_stored_queries(self, request):
         sq = super(GeoDjangoWFSAdapter, self).list_stored_queries(request)
@@ -241,11 +402,8 @@ class GeoDjangoWFSAdapter(WFSAdapter):
     def get_feature_descriptions(self, request, *types):
         namespace = request.build_absolute_uri().split('?')[0] + "/schema" # todo: include https://bitbucket.org/eegg/django-model-schemas/wiki/Home
 
-        for model in self.models.values():
-            if model.objects.count() > 0:
-                extent = model.objects.extent()
-            else:
-                extent = (0,0,0,0)
+        for name, model in self.models.items():
+            extent = LayerExtent.of_model(model, self.geometries[name].name) or (0,0,0,0)
 
             yield FeatureDescription(
                 ns=namespace,
@@ -279,6 +437,7 @@ class GeoDjangoWFSAdapter(WFSAdapter):
         #aliases = parms.cleaned_data['aliases'] # ignored for now
         flt = parms.cleaned_data['filter'] # filter should be in JSON 
         flt_lang = parms.cleaned_data['filter_language'] # only support JSON now
+        page_token = parms.cleaned_data['page_token']
         #res_id = parms.cleaned_data['resource_id'] # ignored
         bbox = parms.cleaned_data['bbox'] 
         sort_by = parms.cleaned_data['sort_by']
@@ -293,46 +452,66 @@ class GeoDjangoWFSAdapter(WFSAdapter):
         geometry_field = self.geometries[type_names[0]]
         query_set = model.objects.all()
 
+        srid = geometry_field.srid
+        if srs_name and (not srs_format or srs_format == 'srid'):
+            srid = srid_of(srs_name)
+
         if bbox:
-            mnx, mny, mxx, mxy = bbox
-            query_set.filter(**{ geometry_field.name + "__bboverlaps" :
-                "POLYGON(({mnx} {mny}, {mxx} {mny}, {mxx} {mxy}, {mnx} {mxy}, {mnx} {mny}))".format(
-                    mnx=mnx, 
-                    mny=mny, 
-                    mxx=mxx, 
-                    mxy=mxy)
-            })
+            # && against the bbox in the layer's own SRS, so that the spatial index on the column can be used
+            query_set = query_set.filter(**{ geometry_field.name + "__bboverlaps" : bbox_polygon(bbox, srid, geometry_field.srid) })
 
         if flt:
             flt = json.loads(flt)
             query_set = query_set.filter(**flt)
 
-        if sort_by and ',' in sort_by:
-            sort_by = sort_by.split(',')
-            query_set = query_set.order_by(*sort_by)
-        elif sort_by:
-            query_set = query_set.order_by(sort_by)
+        sort_keys = sort_by.split(',') if sort_by else []
+        parms.page = None
+        if count or page_token:
+            # paging needs a total order, so that the next page can pick up right after the last feature of this one
+            sort_keys.append('pk')
+            digest = query_digest(type_names[0], sort_by, parms.cleaned_data['filter'], bbox, srs_name)
+            parms.page = FeaturePage(count, [self._key_column(model, key) for key in sort_keys], digest) if count else None
+        if sort_keys:
+            query_set = query_set.order_by(*sort_keys)
 
-        if start_index and count:
-            query_set = query_set[start_index:start_index+count]
-        elif start_index:
-            query_set = query_set[start_index:]
-        elif count:
-            query_set = query_set[:count]
+        if page_token:
+            key = decode_page_token(page_token, digest, len(sort_keys))
+            query_set = query_set.filter(keyset_filter(sort_keys, key, connections[query_set.db].vendor))
 
-        if srs_name:
-            if (not srs_format or srs_format == 'srid') and srs_name != geometry_field.srid:
-                if srs_name.lower().startswith('epsg:'):
-                    srs_name = srs_name[5:]
-                query_set.transform(int(srs_name))
+        if srid != geometry_field.srid:
+            query_set = query_set.transform(srid)
 
         # TODO support proj and WKT formats by manually transforming geometries.
-        # First create a list() from the queryset, then create SpatialReference objects for 
+        # First create a list() from the queryset, then create SpatialReference objects for
         # the source and dest.  Then import them from their corresponding SRS definitions
         # then loop over the list and transform each model instance's geometry record
 
+        # a page is fetched with one row extra, which tells whether there is a next page.  See FeaturePage.
+        if page_token:
+            if count:
+                query_set = query_set[:count+1]
+        elif start_index and count:
+            query_set = query_set[start_index:start_index+count+1]
+        elif start_index:
+            query_set = query_set[start_index:]
+        elif count:
+            query_set = query_set[:count+1]
+
         return query_set
 
+    def _key_column(self, model, sort_key):
+        """The column of a sort key in the rows the serializers read.  Only the model's own attributes can be paged by."""
+        name = sort_key.lstrip('-')
+        if name == 'pk':
+            return model._meta.pk.attname
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise common.InvalidParameterValue.at('sortBy', '{name} is not a field of {model}'.format(name=name, model=model._meta.object_name))
+        if isinstance(field, GeometryField):
+            raise common.InvalidParameterValue.at('sortBy', 'features cannot be sorted by geometry')
+        return field.attname
+
     def SQ_GetFeatureById(self, request, parms):
         my_parms = GetFeatureByIdParameters.create(request.REQUEST)
         typename, pk =  my_parms.cleaned_data['feature_id'].split('.')
@@ -340,6 +519,402 @@ class GeoDjangoWFSAdapter(WFSAdapter):
 
 
 
+########################################################################################################################
+# Streaming output
+########################################################################################################################
+
+#: The number of bytes GetFeature buffers before handing a chunk of output to the server.
+CHUNK_SIZE = 1 << 16
+
+#: Precedes each record of a GeoJSON text sequence.
+RECORD_SEPARATOR = '\x1e'
+
+#: outputFormat values that are streamed natively rather than through an arbitrary OGR driver.
+GEOJSONSEQ_FORMATS = ('application/geo+json-seq', 'GeoJSONSeq')
+FLATGEOBUF_FORMATS = ('application/flatgeobuf', 'FlatGeobuf')
+
+def _chunked(pieces, chunk_size=CHUNK_SIZE):
+    """Join small strings into chunks of roughly chunk_size bytes so that the server isn't handed one write per feature"""
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
+def _primed(chunks):
+    """Start a stream before the response is built.  Streams of a paged query fetch their page before the first chunk,
+    so the next page is known in time for the Link header."""
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    return itertools.chain([first] if first is not None else [], chunks)
+
+def _features(layer):
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        yield feature
+        feature = layer.GetNextFeature()
+
+def stream_geojson(layer, cleanup=None):
+    """Generate a GeoJSON FeatureCollection from an OGR layer one feature at a time.
+
+    :param layer: An ogr.Layer
+    :param cleanup: An optional callable to run once the last feature is written, such as releasing a result set.
+    """
+    def pieces():
+        yield '{"type": "FeatureCollection", "features": ['
+        first = True
+        for feature in _features(layer):
+            if not first:
+                yield ', '
+            first = False
+            yield feature.ExportToJson()
+        yield ']}'
+
+    try:
+        for chunk in _chunked(pieces()):
+            yield chunk
+    finally:
+        if cleanup:
+            cleanup()
+
+def stream_geojsonseq(layer, cleanup=None):
+    """Generate a GeoJSON text sequence (RFC 8142) from an OGR layer: each feature is preceded by an ASCII record
+    separator and followed by a newline.
+
+    :param layer: An ogr.Layer
+    :param cleanup: An optional callable to run once the last feature is written, such as releasing a result set.
+    """
+    try:
+        for chunk in _chunked(RECORD_SEPARATOR + feature.ExportToJson() + '\n' for feature in _features(layer)):
+            yield chunk
+    finally:
+        if cleanup:
+            cleanup()
+
+def _flatgeobuf_driver():
+    driver = ogr.GetDriverByName('FlatGeobuf')
+    if driver is None:
+        raise OperationProcessingFailed.at('GetFeature', 'FlatGeobuf output requires GDAL 3.1 or later')
+    return driver
+
+def stream_flatgeobuf(layer, cleanup=None):
+    """Generate a FlatGeobuf file with a packed R-tree from an OGR layer.  The index sits in the header, ahead of the
+    features, so the file is built in GDAL's in-memory filesystem and then streamed out of it; no temp file touches the
+    disk.  The file is written before this returns, so errors surface before the response starts.
+
+    :param layer: An ogr.Layer
+    :param cleanup: An optional callable to run once the layer has been read.
+    """
+    driver = _flatgeobuf_driver()
+    path = '/vsimem/{uuid}.fgb'.format(uuid=uuid4())
+    try:
+        ds = driver.CreateDataSource(path)
+        ds.CopyLayer(layer, 'WFS_result', ['SPATIAL_INDEX=YES'])
+        del ds
+    finally:
+        if cleanup:
+            cleanup()
+    return stream_vsi(path, CHUNK_SIZE)
+
+def stream_gml(layer, type_name='WFS_result', cleanup=None):
+    """Generate a GML FeatureCollection from an OGR layer one feature at a time.  The document is laid out the same way
+    OGR's GML driver lays it out, without the boundedBy envelope, which would need a second pass over the features.
+
+    :param layer: An ogr.Layer
+    :param type_name: The element name of each feature.
+    :param cleanup: An optional callable to run once the last feature is written, such as releasing a result set.
+    """
+    defn = layer.GetLayerDefn()
+    field_names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+    def pieces():
+        yield ('<?xml version="1.0" encoding="utf-8" ?>\n'
+               '<ogr:FeatureCollection xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xmlns:ogr="http://ogr.maptools.org/" xmlns:gml="http://www.opengis.net/gml">\n')
+        for feature in _features(layer):
+            yield '  <gml:featureMember>\n    <ogr:{name} fid="{name}.{fid}">\n'.format(name=type_name, fid=feature.GetFID())
+            geometry = feature.GetGeometryRef()
+            if geometry is not None:
+                yield '      <ogr:geometryProperty>' + geometry.ExportToGML() + '</ogr:geometryProperty>\n'
+            for i, field in enumerate(field_names):
+                if feature.IsFieldSet(i):
+                    yield '      <ogr:{field}>{value}</ogr:{field}>\n'.format(field=field, value=xml_escape(feature.GetFieldAsString(i)))
+            yield '    </ogr:{name}>\n  </gml:featureMember>\n'.format(name=type_name)
+        yield '</ogr:FeatureCollection>\n'
+
+    try:
+        for chunk in _chunked(pieces()):
+            yield chunk
+    finally:
+        if cleanup:
+            cleanup()
+
+def _geometry_field(query_set):
+    for field in query_set.model._meta.fields:
+        if isinstance(field, GeometryField):
+            return field
+
+def _attribute_fields(query_set):
+    return [field for field in query_set.model._meta.fields if not isinstance(field, GeometryField)]
+
+def _rendered(query_set, method, **kwargs):
+    """Apply a GeoQuerySet geometry function such as geojson() or gml() to a query set.  Those add an extra select, which
+    Django refuses once a query set is sliced, so the slice is lifted while the function is applied."""
+    low, high = query_set.query.low_mark, query_set.query.high_mark
+    query_set = query_set._clone()
+    query_set.query.clear_limits()
+    query_set = getattr(query_set, method)(**kwargs)
+    query_set.query.set_limits(low, high)
+    return query_set
+
+#: The encoder for GeoJSON properties.  One encoder is reused for every value instead of building one per json.dumps call.
+_JSON_ENCODER = DjangoJSONEncoder(separators=(',', ':'))
+
+def geojson_precision(srid):
+    """A sensible number of decimal places for coordinates in an SRS: about a centimeter."""
+    return 7 if SpatialReference(srid).geographic else 2
+
+def _queryset_features(query_set, geometry_field, precision, page=None):
+    """Generate each row of a GeoQuerySet as a GeoJSON Feature string.  Rows are read as tuples and property names are
+    encoded once up front.  With a :class:`FeaturePage`, the page is fetched as soon as the first feature is asked for."""
+    names = [field.attname for field in _attribute_fields(query_set)]
+    pk = names.index(query_set.model._meta.pk.attname)
+    if precision is None:
+        precision = geojson_precision(query_set.query.transformed_srid or geometry_field.srid)
+    rows = _rendered(query_set, 'geojson', field_name=geometry_field.name, precision=precision).values_list(*(names + ['geojson']))
+
+    encode = _JSON_ENCODER.encode
+    keys = [encode(name) + ':' for name in names]
+    sort_key = lambda row: [row[names.index(column)] for column in page.keys]
+    for row in _page_rows(rows, page, sort_key):
+        properties = ','.join([prefix + encode(value) for prefix, value in zip(keys, row)])
+        yield '{"type":"Feature","id":' + encode(row[pk]) + ',"geometry":' + (row[-1] or 'null') + \
+            ',"properties":{' + properties + '}}'
+
+def stream_queryset_geojson(query_set, geometry_field, precision=None, page=None):
+    """Generate a GeoJSON FeatureCollection from a GeoQuerySet.  Geometries are rendered to GeoJSON by the database
+    (ST_AsGeoJSON), so rows go straight from Django's connection to the client with one query and no OGR round trip.
+
+    :param query_set: A GeoQuerySet
+    :param geometry_field: The GeometryField to output
+    :param precision: The number of decimal places in coordinates.  None picks one from the output SRS with
+        :func:`geojson_precision`.
+    :param page: The :class:`FeaturePage` of a paged query.  Its next page, if any, is linked from the collection.
+    """
+    def pieces():
+        features = _queryset_features(query_set, geometry_field, precision, page)
+        if page is not None:
+            # the page is fetched before the collection starts, so that the link to the next page can lead it
+            features = list(features)
+        yield '{"type":"FeatureCollection",'
+        next_url = page.next_url if page is not None else None
+        if next_url:
+            yield '"links":[' + _JSON_ENCODER.encode({ 'href' : next_url, 'rel' : 'next', 'type' : 'application/json' }) + '],'
+        yield '"features":['
+        separator = ''
+        for feature in features:
+            yield separator
+            yield feature
+            separator = ','
+        yield ']}'
+
+    return _chunked(pieces())
+
+def stream_queryset_geojsonseq(query_set, geometry_field, precision=None, page=None):
+    """Generate a GeoJSON text sequence (RFC 8142) from a GeoQuerySet.  Each feature is a record of its own, so clients
+    can parse the response as it arrives instead of waiting for the closing bracket of a FeatureCollection.
+
+    :param query_set: A GeoQuerySet
+    :param geometry_field: The GeometryField to output
+    :param precision: The number of decimal places in coordinates.
+    :param page: The :class:`FeaturePage` of a paged query.
+    """
+    return _chunked(RECORD_SEPARATOR + feature + '\n' for feature in _queryset_features(query_set, geometry_field, precision, page))
+
+def stream_queryset_gml(query_set, geometry_field, type_name='WFS_result', page=None):
+    """Generate a GML FeatureCollection from a GeoQuerySet, laid out the same way as :func:`stream_gml`.  Geometries are
+    rendered to GML by the database (ST_AsGML).
+
+    :param query_set: A GeoQuerySet
+    :param geometry_field: The GeometryField to output
+    :param type_name: The element name of each feature.
+    :param page: The :class:`FeaturePage` of a paged query.  The URL of its next page, if any, goes in the
+        collection's next attribute.
+    """
+    names = [field.attname for field in _attribute_fields(query_set)]
+    pk = query_set.model._meta.pk.attname
+    rows = _rendered(query_set, 'gml', field_name=geometry_field.name).values(*(names + ['gml']))
+
+    def pieces():
+        page_rows = _page_rows(rows, page, lambda row: [row[column] for column in page.keys])
+        next_url = page.next_url if page is not None else None
+        yield ('<?xml version="1.0" encoding="utf-8" ?>\n'
+               '<ogr:FeatureCollection xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xmlns:ogr="http://ogr.maptools.org/" xmlns:gml="http://www.opengis.net/gml"' +
+               (' next=' + quoteattr(next_url) if next_url else '') + '>\n')
+        for row in page_rows:
+            yield '  <gml:featureMember>\n    <ogr:{name} fid="{name}.{fid}">\n'.format(name=type_name, fid=row[pk])
+            if row['gml']:
+                yield '      <ogr:geometryProperty>' + row['gml'].encode('utf-8') + '</ogr:geometryProperty>\n'
+            for field in names:
+                if row[field] is not None:
+                    yield '      <ogr:{field}>{value}</ogr:{field}>\n'.format(field=field, value=xml_escape(unicode(row[field]).encode('utf-8')))
+            yield '    </ogr:{name}>\n  </gml:featureMember>\n'.format(name=type_name)
+        yield '</ogr:FeatureCollection>\n'
+
+    return _chunked(pieces())
+
+#: OGR field types for Django model fields.  Anything else is written as a string.
+OGR_FIELD_TYPES = {
+    'AutoField' : ogr.OFTInteger,
+    'IntegerField' : ogr.OFTInteger,
+    'SmallIntegerField' : ogr.OFTInteger,
+    'PositiveIntegerField' : ogr.OFTInteger,
+    'PositiveSmallIntegerField' : ogr.OFTInteger,
+    'BooleanField' : ogr.OFTInteger,
+    'ForeignKey' : ogr.OFTInteger,
+    'FloatField' : ogr.OFTReal,
+    'DecimalField' : ogr.OFTReal,
+}
+
+def write_queryset(ds, query_set, geometry_field, options=None, page=None):
+    """Write a GeoQuerySet into a new layer of an OGR datasource, one row at a time as the rows arrive from Django's
+    connection.  Geometries arrive as WKB from the database.
+
+    :param ds: The ogr.DataSource to create the layer in.
+    :param options: Layer creation options for the datasource's driver.
+    :param page: The :class:`FeaturePage` of a paged query.
+    :return: The new layer.  It is only valid as long as the datasource is referenced.
+    """
+    fields = _attribute_fields(query_set)
+    names = [field.attname for field in fields]
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(query_set.query.transformed_srid or geometry_field.srid)
+
+    layer = ds.CreateLayer('WFS_result', srs=srs, options=options or [])
+    for field in fields:
+        layer.CreateField(ogr.FieldDefn(str(field.attname), OGR_FIELD_TYPES.get(field.get_internal_type(), ogr.OFTString)))
+
+    defn = layer.GetLayerDefn()
+    rows = query_set.values_list(*(names + [geometry_field.name]))
+    for row in _page_rows(rows, page, lambda row: [row[names.index(column)] for column in page.keys]):
+        feature = ogr.Feature(defn)
+        for i, value in enumerate(row[:-1]):
+            if value is None:
+                continue
+            if defn.GetFieldDefn(i).GetType() == ogr.OFTString:
+                value = unicode(value).encode('utf-8')
+            elif isinstance(value, bool):
+                value = int(value)
+            feature.SetField(i, value)
+        if row[-1] is not None:
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(row[-1].wkb)))
+        layer.CreateFeature(feature)
+    return layer
+
+def stream_queryset_flatgeobuf(query_set, geometry_field, page=None):
+    """Generate a FlatGeobuf file with a packed R-tree from a GeoQuerySet.  Rows are written straight into a FlatGeobuf
+    layer in GDAL's in-memory filesystem, which is streamed out once the index is built, as in :func:`stream_flatgeobuf`.
+
+    :param query_set: A GeoQuerySet
+    :param geometry_field: The GeometryField to output
+    :param page: The :class:`FeaturePage` of a paged query.
+    """
+    driver = _flatgeobuf_driver()
+    path = '/vsimem/{uuid}.fgb'.format(uuid=uuid4())
+    ds = driver.CreateDataSource(path)
+    try:
+        write_queryset(ds, query_set, geometry_field, options=['SPATIAL_INDEX=YES'], page=page)
+    except Exception:
+        ds = None
+        gdal.Unlink(path)
+        raise
+    ds = None
+    return stream_vsi(path, CHUNK_SIZE)
+
+def estimated_count(query_set):
+    """The PostgreSQL planner's estimate of the number of rows a query set returns, or None on other databases."""
+    connection = connections[query_set.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = query_set.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+#: Namespace of the vendor attributes ga_ows adds to WFS responses.
+GA_OWS_NS = 'urn:ga_ows'
+
+def count_matched(query_set, exact_limit=None):
+    """The number of features a query set matches, ignoring any slice taken for paging, as (number_matched, estimate).
+    If exact_limit is set and the planner estimates more rows than that, no full count is run: number_matched is None,
+    because the number is unknown, and estimate is the planner's.  Otherwise estimate is None.
+    """
+    query_set = query_set._clone()
+    query_set.query.clear_limits()
+    if exact_limit is not None:
+        estimate = estimated_count(query_set)
+        if estimate is not None and estimate > exact_limit:
+            return None, estimate
+    return query_set.count(), None
+
+def hits_response(number_matched, output_format, estimate=None):
+    """The response to a GetFeature request with resultType=hits: the feature count and no features.  A number_matched
+    of None is reported as numberMatched="unknown" in XML, and left out of GeoJSON.  An estimate of the count, if there
+    is one, is the ga_ows:numberMatchedEstimate attribute in XML and the numberMatchedEstimate member in GeoJSON."""
+    if output_format == 'GeoJSON' or 'json' in output_format:
+        collection = {
+            'type' : 'FeatureCollection',
+            'numberReturned' : 0,
+            'features' : []
+        }
+        if number_matched is not None:
+            collection['numberMatched'] = number_matched
+        if estimate is not None:
+            collection['numberMatchedEstimate'] = estimate
+        return HttpResponse(json.dumps(collection), mimetype='application/json')
+    else:
+        collection = etree.Element('{http://www.opengis.net/wfs/2.0}FeatureCollection', nsmap={'wfs' : 'http://www.opengis.net/wfs/2.0', 'ga_ows' : GA_OWS_NS})
+        collection.set('numberMatched', str(number_matched) if number_matched is not None else 'unknown')
+        if estimate is not None:
+            collection.set('{' + GA_OWS_NS + '}numberMatchedEstimate', str(estimate))
+        collection.set('numberReturned', '0')
+        collection.set('timeStamp', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return HttpResponse(etree.tostring(collection, xml_declaration=True, encoding='utf-8'), mimetype='text/xml')
+
+def stream_file(path, chunk_size=CHUNK_SIZE):
+    """Generate the contents of a file in chunks and remove it afterwards"""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.unlink(path)
+
+def output_formats():
+    """The outputFormat values GetFeature supports besides GML: the natively streamed formats, then every OGR driver
+    that can create datasets."""
+    drivers = [ogr.GetDriver(drv).GetName() for drv in range(ogr.GetDriverCount()) if ogr.GetDriver(drv).TestCapability(ogr.ODrCCreateDataSource)]
+    formats = ['application/json', GEOJSONSEQ_FORMATS[0]]
+    if 'FlatGeobuf' in drivers:
+        formats.append(FLATGEOBUF_FORMATS[0])
+    return formats + [name for name in drivers if name not in formats]
+
+
 # WFS itself.  All the individual classes are defined as mixins for the sake of modularity and ease of debugging.
 
 class WFSBase(object):
@@ -463,6 +1038,13 @@ class GetFeatureMixin(WFSBase):
         raise OperationNotSupported.at("GetFeature", "XML encoded POST for WFS.GetFeature needs implemented")
         #TODO implement this method.
 
+    #: Above this many rows (by the planner's estimate), resultType=hits reports numberMatched="unknown" and the estimate
+    #: as numberMatchedEstimate instead of running an exact count.  None always counts exactly.
+    exact_count_limit = 100000
+
+    #: Decimal places in GeoJSON coordinates.  None picks about a centimeter for the output SRS.
+    geojson_precision = None
+
     def GetFeature(self, request, kwargs):
         """
         """
@@ -477,80 +1059,79 @@ class GetFeatureMixin(WFSBase):
 
         # must be an OGR dataset or a QuerySet containing one layer
         response = self.adapter.get_features(request, parms)
+        output_format = parms.cleaned_data['output_format'].decode('ascii')
+
+        if parms.cleaned_data['result_type'] == 'hits':
+            if isinstance(response, GeoQuerySet):
+                number_matched, estimate = count_matched(response, self.exact_count_limit)
+                return hits_response(number_matched, output_format, estimate)
+            else:
+                layer = response.GetLayerByIndex(0)
+                number_matched = layer.GetFeatureCount(0)
+                if number_matched < 0:
+                    number_matched = layer.GetFeatureCount(1)
+                return hits_response(number_matched, output_format)
+
         if isinstance(response, GeoQuerySet):
-            layer = None
-            db_params = settings.DATABASES[response.db]
-            if db_params['ENGINE'].endswith('postgis'):
-                # Then we take the raw SQL from thr QuerySet and pass it through OGR instead.  This causes the SQL to be
-                # executed twice, but it's also the most expedient way to create our output. This could be done better,
-                # but it gets it out the door for now.
-
-                # Create the query from the QuerySet
-                # adapt() prevents SQL injection attacks
-                from psycopg2.extensions import adapt
-                query, parameters = response.query.get_compiler(response.db).as_sql()
-                parameters = tuple([adapt(p) for p in parameters])
-                query = query % parameters
-
-                # Connect to PostGIS with OGR.
-                drv = ogr.GetDriverByName("PostgreSQL")
-                connection_string = "PG:dbname='{db}'".format(db=db_params['NAME'])
-                if 'HOST' in db_params and db_params['HOST']:
-                    connection_string += " host='{host}'".format(host=db_params['HOST'])
-                if 'PORT' in db_params and db_params['PORT']:
-                    connection_string += " port='{port}'".format(port=db_params['PORT'])
-                if 'USER' in db_params and db_params['USER']:
-                    connection_string += " user='{user}'".format(user=db_params['USER'])
-                if 'PASSWORD' in db_params and db_params['PASSWORD']:
-                    connection_string += " password='{password}'".format(password=db_params['PASSWORD'])
-                conn = drv.Open(connection_string)
-
-                # Put the QuerySet into a layer the hard way.
-                layer = conn.ExecuteSQL(query.encode('ascii'))
-
-            elif db_params['ENGINE'].endswith('spatialite'):
-                # This works the same way as the if-statement above.
-                # todo replace this with the sqlite version of the same thing for preventing SQL injection attacks
-                from psycopg2.extensions import adapt
-                query, parameters = response.query.get_compiler(response.db).as_sql()
-                parameters = tuple([adapt(p) for p in parameters])
-                query = query % parameters
-
-                drv = ogr.GetDriverByName("Spatialite")
-                conn = drv.Open(db_params['NAME'])
-                layer = conn.ExecuteSQL(query)
+            # Serialize straight from Django's connection.  The database renders the geometries, so each row is
+            # fetched once with the query the adapter built.
+            geometry_field = _geometry_field(response)
+            page = getattr(parms, 'page', None)
+            if page is not None:
+                page.url = lambda token: self._next_page_url(request, token)
+            to_gml = lambda: _primed(stream_queryset_gml(response, geometry_field, page=page))
+            to_geojson = lambda: _primed(stream_queryset_geojson(response, geometry_field, precision=self.geojson_precision, page=page))
+            to_geojsonseq = lambda: _primed(stream_queryset_geojsonseq(response, geometry_field, precision=self.geojson_precision, page=page))
+            to_flatgeobuf = lambda: stream_queryset_flatgeobuf(response, geometry_field, page=page)
+            def to_file(driver, path):
+                ds = driver.CreateDataSource(path)
+                write_queryset(ds, response, geometry_field, page=page).SyncToDisk()
         else:
+            page = None
             layer = response.GetLayerByIndex(0)
+            # the layer is only valid as long as its dataset, so the response holds on to the dataset until it's done
+            cleanup = lambda: response
+            to_gml = lambda: stream_gml(layer, cleanup=cleanup)
+            to_geojson = lambda: stream_geojson(layer, cleanup=cleanup)
+            to_geojsonseq = lambda: stream_geojsonseq(layer, cleanup=cleanup)
+            to_flatgeobuf = lambda: stream_flatgeobuf(layer, cleanup)
+            def to_file(driver, path):
+                ds = driver.CreateDataSource(path)
+                ds.CopyLayer(layer, 'WFS_result').SyncToDisk()
 
         drivers = dict([(ogr.GetDriver(drv).GetName(), ogr.GetDriver(drv)) for drv in range(ogr.GetDriverCount()) if ogr.GetDriver(drv).TestCapability(ogr.ODrCCreateDataSource)])
-        output_format = parms.cleaned_data['output_format'].decode('ascii')
-        if 'gml' in output_format or 'xml' in output_format:
-            tmpname = "{tmpdir}{sep}{uuid}.{output_format}".format(tmpdir=gettempdir(), uuid=uuid4(), output_format='gml', sep=os.path.sep)
-            drv = ogr.GetDriverByName("GML")
-            ds = drv.CreateDataSource(tmpname)
-            l2 = ds.CopyLayer(layer, 'WFS_result')
-            l2.SyncToDisk()
-            del ds
-            responsef = open(tmpname)
-            rdata = responsef.read()
-            responsef.close()
-            os.unlink(tmpname)
-            return HttpResponse(rdata, mimetype=output_format)
+        if output_format in GEOJSONSEQ_FORMATS:
+            resp = StreamingHttpResponse(to_geojsonseq(), mimetype='application/geo+json-seq')
+        elif output_format in FLATGEOBUF_FORMATS:
+            resp = StreamingHttpResponse(to_flatgeobuf(), mimetype='application/flatgeobuf')
+        elif 'gml' in output_format or 'xml' in output_format:
+            resp = StreamingHttpResponse(to_gml(), mimetype=output_format)
+        elif output_format == 'GeoJSON' or output_format.endswith('json'):
+            resp = StreamingHttpResponse(to_geojson(), mimetype='application/json')
         elif output_format in drivers:
+            # querysets are written into the driver's file row by row, so no format holds the whole result in memory
             tmpname = "{tmpdir}{sep}{uuid}.{output_format}".format(tmpdir=gettempdir(), uuid=uuid4(), output_format=output_format, sep=os.path.sep)
-            drv = drivers[output_format]
-            ds = drv.CreateDataSource(tmpname)
-            l2 = ds.CopyLayer(layer, 'WFS_result')
-            l2.SyncToDisk()
-            del ds
-            responsef = open(tmpname)
-            rdata = responsef.read()
-            responsef.close()
-            os.unlink(tmpname)
-            return HttpResponse(rdata, mimetype=mimetypes.get(output_format,'text/plain'))
+            to_file(drivers[output_format], tmpname)
+            resp = StreamingHttpResponse(stream_file(tmpname), mimetype=mimetypes.get(output_format,'text/plain'))
         else:
             raise OperationProcessingFailed.at('GetFeature', 'outputFormat {of} not supported ({formats})'.format(of=output_format, formats=drivers.keys()))
 
+        if page is not None and page.next_url:
+            resp['Link'] = '<{url}>; rel="next"'.format(url=page.next_url)
+        return resp
+
+    def _next_page_url(self, request, next_page_token):
+        """The URL of the next page of a GetFeature request: the same request with the page token in place of
+        startIndex."""
+        if not next_page_token or request.method != 'GET':
+            return None
+        query = request.GET.copy()
+        for key in query.keys():
+            if key.lower() in ('pagetoken', 'startindex'):
+                del query[key]
+        query['pageToken'] = next_page_token
+        return request.build_absolute_uri(request.path) + '?' + query.urlencode()
+
 class ListStoredQueriesMixin(WFSBase):
     """
     Defines the ListStoredQueries operation in section 14.3 of the standard
@@ -668,7 +1249,7 @@ class WFS(
             "fees" : self.fees,
             "access_constraints" : self.access_constraints,
             "endpoint" : request.build_absolute_uri().split('?')[0],
-            "output_formats" : [ogr.GetDriver(drv).GetName() for drv in range(ogr.GetDriverCount()) if ogr.GetDriver(drv).TestCapability(ogr.ODrCCreateDataSource)],
+            "output_formats" : output_formats(),
             "addr_street" : self.addr_street,
             "addr_city" : self.addr_city,
             "addr_admin_area" : self.addr_admin_area,
@@ -690,7 +1271,7 @@ class WFST(WFS,TransactionMixin,GetFeatureWithLockMixin, LockFeatureMixin):
             "fees" : self.fees,
             "access_constraints" : self.access_constraints,
             "endpoint" : request.build_absolute_uri().split('?')[0],
-            "output_formats" : [ogr.GetDriver(drv).GetName() for drv in range(ogr.GetDriverCount()) if ogr.GetDriver(drv).TestCapability(ogr.ODrCCreateDataSource)],
+            "output_formats" : output_formats(),
             "addr_street" : self.addr_street,
             "addr_city" : self.addr_city,
             "addr_admin_area" : self.addr_admin_area,
@@ -1,6 +1,7 @@
 from ga_ows.views.wms.base import WMS, WMSAdapterBase
+from ga_ows.views.wms.tiles import TiledWMS, TileGrid
 
-__all__ = [WMS, WMSAdapterBase]
+__all__ = [WMS, WMSAdapterBase, TiledWMS, TileGrid]
 
 try:
     from ga_ows.views.wms.geodjango import GeoDjangoWMSAdapter
@@ -9,7 +10,8 @@ except ImportError:
     pass
 
 try:
-    from ga_ows.views.wms.ogr import OGRDatasetWMSAdapter
+    from ga_ows.views.wms.ogr import OGRDatasetWMSAdapter, OGRDatasetCollectionAdapter
     __all__.append(OGRDatasetWMSAdapter)
+    __all__.append(OGRDatasetCollectionAdapter)
 except ImportError:
     pass
@@ -1,13 +1,16 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse
+from django.utils.http import http_date, parse_http_date_safe
 from django.shortcuts import render_to_response
+import calendar
 import json
 from lxml import etree
 
 try:
-    import scipy.misc
-    HAVE_SCIPY = True
+    import numpy as np
+    HAVE_NUMPY = True
 except ImportError:
-    HAVE_SCIPY = False
+    HAVE_NUMPY = False
 
 try:
     import cairo
@@ -17,12 +20,103 @@ except ImportError:
 
 from osgeo import gdal
 import tempfile
+from uuid import uuid4
 
 from ga_ows import utils
+from ga_ows.rendering.sld import sld_cache, ForbiddenURL
+from ga_ows.rendering.styler import Stylesheet
 from ga_ows.views import common
 import django.forms as f
 
 
+def not_modified(request, metadata):
+    """True if a conditional request's copy of a cached item is still current"""
+    if request is None or not metadata:
+        return False
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        tags = [tag.strip() for tag in request.META['HTTP_IF_NONE_MATCH'].split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return '*' in tags or '"' + metadata['_etag'] + '"' in tags
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and since >= calendar.timegm(metadata['_creation_time'].utctimetuple())
+
+def cache_headers(response, metadata, max_age=None):
+    """Set the validators of a cached item and its freshness lifetime on a response"""
+    if metadata:
+        response['ETag'] = '"' + metadata['_etag'] + '"'
+        response['Last-Modified'] = http_date(calendar.timegm(metadata['_creation_time'].utctimetuple()))
+    if max_age is not None:
+        response['Cache-Control'] = 'max-age={max_age}'.format(max_age=max_age)
+    return response
+
+def get_driver(fmt):
+    """Get the GDAL driver for a GetMap format, such as png, jpeg, or geotiff"""
+    if fmt == 'tiff' or fmt == 'geotiff':
+        return gdal.GetDriverByName('GTiff')
+    elif fmt == 'jpg' or fmt == 'jpeg':
+        return gdal.GetDriverByName('jpeg')
+    elif fmt == 'jp2k' or fmt == 'jpeg2000':
+        return gdal.GetDriverByName('jpeg2000')
+    else:
+        return gdal.GetDriverByName(fmt.encode('ascii'))
+
+def encode_array(arr, fmt):
+    """Encode a numpy array as an image directly from its buffer.  The array is wrapped by a GDAL MEM dataset that
+    points at the array's own memory, so nothing is copied until the driver writes the encoded image into /vsimem.
+
+    :param arr: An NxM, NxMx3, or NxMx4 array of uint8, such as the output of a
+        :class:`ga_ows.rendering.palettes.Palette`.  Formats without an alpha channel, like JPEG, drop the fourth band.
+    :param fmt: The image format, as in the GetMap format parameter
+    :return: The encoded image as a string.
+    """
+    arr = np.ascontiguousarray(arr, dtype=np.uint8) # no copy if it's already contiguous uint8
+    if arr.ndim == 2:
+        height, width = arr.shape
+        channels = 1
+    else:
+        height, width, channels = arr.shape
+
+    driver = get_driver(fmt)
+    bands = channels
+    if channels == 4 and driver.ShortName == 'JPEG':
+        bands = 3
+
+    old_enable_open = gdal.GetConfigOption('GDAL_MEM_ENABLE_OPEN')
+    gdal.SetConfigOption('GDAL_MEM_ENABLE_OPEN', 'YES')
+    try:
+        mem = gdal.Open('MEM:::DATAPOINTER={ptr},PIXELS={width},LINES={height},BANDS={bands},DATATYPE=Byte,'
+                        'PIXELOFFSET={channels},LINEOFFSET={stride},BANDOFFSET=1'.format(
+            ptr=arr.ctypes.data,
+            width=width,
+            height=height,
+            bands=bands,
+            channels=channels,
+            stride=width*channels
+        ))
+    finally:
+        gdal.SetConfigOption('GDAL_MEM_ENABLE_OPEN', old_enable_open)
+
+    path = '/vsimem/ga_ows_wms_{uuid}.{fmt}'.format(uuid=uuid4(), fmt=fmt)
+    try:
+        out = driver.CreateCopy(path, mem)
+        del out
+        del mem
+        fp = gdal.VSIFOpenL(path, 'rb')
+        try:
+            return gdal.VSIFReadL(1, gdal.VSIStatL(path).size, fp)
+        finally:
+            gdal.VSIFCloseL(fp)
+    finally:
+        gdal.Unlink(path)
+
+#: What SLDParser raises for a well-formed document it can't build rules from, such as an unsupported function
+#: (NotImplementedError), an unknown element (KeyError) or a PropertyIsBetween missing its boundaries.
+SLD_PARSE_ERRORS = (NotImplementedError, KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+def _sld_error(ex):
+    if isinstance(ex, KeyError):
+        return 'unsupported element ' + str(ex)
+    return str(ex) or type(ex).__name__
 
 class WMSAdapterBase(object):
     """ An abstract base-class for adapting a data model to the WMS implementation given in this module.
@@ -39,7 +133,7 @@ class WMSAdapterBase(object):
         """Cache away the result of a WMS render.
         :param item: The item to cache.  Should be a binary image
         :param kwargs:
-        :return:
+        :return: The cache record's metadata, as get_cache_metadata returns it, or None
         """
 
     def get_cache_record(self, layers, srs, bbox, width, height, styles, format, bgcolor, transparent, time, elevation, v, filter, **kwargs):
@@ -48,6 +142,65 @@ class WMSAdapterBase(object):
         """
         return None
 
+    def get_cache_metadata(self, **kwargs):
+        """ Get the metadata of the cache record for a set of parameters without fetching the record itself
+        :return: A dict with the record's _etag and _creation_time, or None
+        """
+        return None
+
+    def cache_keys(self):
+        """ The keys every item this adapter caches is saved under besides its own locator, such as the model that
+        :class:`ga_ows.views.wms.cache.WMSCache.GeoDjangoCacheInvalidatingignalHandler` retires items by.
+        :return: A dict
+        """
+        return {}
+
+    def get_stylesheet(self, styles=None, sld=None, sld_body=None):
+        """ Resolve the stylesheet for a request.  An SLD_BODY or SLD url takes precedence over named styles.  Named
+        styles whose value is a path to an SLD file are read through the SLD cache, so they are only parsed again
+        when the file changes.
+
+        :param styles: The requested style name, or the list of names from the STYLES parameter.
+        :param sld: The URL of an SLD document
+        :param sld_body: The text of an SLD document
+        :return: A :class:`ga_ows.rendering.styler.Stylesheet` or None
+        """
+        if sld_body:
+            try:
+                return Stylesheet(rules=sld_cache.parse(sld_body))
+            except etree.XMLSyntaxError as ex:
+                raise common.InvalidParameterValue.at('sld_body', 'SLD_BODY is not well-formed XML: ' + str(ex))
+            except SLD_PARSE_ERRORS as ex:
+                raise common.InvalidParameterValue.at('sld_body', 'SLD_BODY could not be understood: ' + _sld_error(ex))
+        elif sld:
+            try:
+                return Stylesheet(rules=sld_cache.parse_url(sld))
+            except ForbiddenURL as ex:
+                raise common.InvalidParameterValue.at('sld', str(ex))
+            except IOError as ex:
+                raise common.InvalidParameterValue.at('sld', 'The SLD could not be fetched: ' + str(ex))
+            except etree.XMLSyntaxError as ex:
+                raise common.InvalidParameterValue.at('sld', 'The SLD is not well-formed XML: ' + str(ex))
+            except SLD_PARSE_ERRORS as ex:
+                raise common.InvalidParameterValue.at('sld', 'The SLD could not be understood: ' + _sld_error(ex))
+
+        if isinstance(styles, (list, tuple)):
+            styles = styles[0] if styles else None
+
+        if type(self.styles) is dict:
+            if not styles and 'default' in self.styles:
+                ss = self.styles['default']
+            elif styles:
+                ss = self.styles[styles]
+            else:
+                ss = None
+        else:
+            ss = self.styles
+
+        if isinstance(ss, basestring):
+            ss = Stylesheet(name=styles, rules=sld_cache.parse_file(ss))
+        return ss
+
     def get_valid_elevations(self, **kwargs):
         """ Get valid elevations for the specified query.
         :param kwargs:  All the keyword arguments that would normally be valid for a GetMap request.  See ga_ows.common.GetValidElevationsMixin.
@@ -96,11 +249,11 @@ class WMSAdapterBase(object):
         :param v: The version parameter to add to the query
         :param filter: A dict object containing the object filter.  Different adapters may implement this differently
         :param kwargs: Any other keyword arguments that are added to the request.  Handled adapter by adapter.
-        :return: One of three kind of data: A Cairo Surface object; a Scipy NxNx4-channel array; An osgeo.gdal.Dataset
+        :return: One of three kind of data: A Cairo Surface object; a numpy NxMx4-channel uint8 array; An osgeo.gdal.Dataset
         """
         raise NotImplementedError("Must implement get_2d_dataset to avoid being abstract")
 
-    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter):
+    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter, tolerance=0, **kwargs):
         """**REQUIRED** Get a formatted feature_info document that can be returned by GetFeatureInfo.
 
         :param wherex: The X-coordinate in the target reference system.
@@ -111,10 +264,28 @@ class WMSAdapterBase(object):
         :param feature_count: A maximum number of features to return per layer.
         :param srs: The spatial reference of the request.
         :param filter: The filter that went into the WMS GetMap request
-        :return: A dict containing the feature info results in a JSON seralizable format.
+        :param tolerance: How far from the point, in the units of srs, a feature may be and still be reported.
+        :return: A dict of layer names to lists of feature properties, in a JSON seralizable format.
         """
         raise NotImplementedError("Must implement get_feature_info to avoid being abstract")
 
+    def get_vector_tile(self, layers, srs, bbox, extent, buffer, styles, time, elevation, v, filter, **kwargs):
+        """Get the features GetMap would draw for a bbox as a Mapbox Vector Tile, with one tile layer per requested layer.
+
+        :param layers: The layers to return.
+        :param srs: The spatial reference system of the bbox, which the tile's geometries are projected into.
+        :param bbox: The bounds of the tile as a tuple of (minx, miny, maxx, maxy)
+        :param extent: The number of grid units along each side of the tile.
+        :param buffer: How many grid units beyond the tile's edges geometries are kept.
+        :param styles: The styles the client will draw the tile with.  Only the attributes those styles use are sent.
+        :param time: The time -parameter to add to the query.
+        :param elevation: The elevaltion parameter to add to the query
+        :param v: The version parameter to add to the query
+        :param filter: A dict object containing the object filter.
+        :return: The tile as a protobuf byte string.
+        """
+        raise NotImplementedError("This adapter does not serve vector tiles")
+
     def nativesrs(self, layer):
         """**REQUIRED** Get the native SRS for the layer as a WKT string.
         :param layer:
@@ -187,6 +358,12 @@ class GetMapMixin(common.OWSMixinBase):
     #: WMS requests.
     task = None
 
+    #: Seconds clients may reuse a map without revalidating it.  None sends no Cache-Control header.
+    cache_max_age = None
+
+    #: Per-layer overrides of cache_max_age.  A map of several layers is fresh as long as its shortest-lived layer.
+    layer_cache_max_age = {}
+
     class Parameters(common.CommonParameters):
         layers = utils.MultipleValueField()
         srs = f.CharField(required=False)
@@ -202,6 +379,8 @@ class GetMapMixin(common.OWSMixinBase):
         elevation = f.FloatField(required=False)
         v = f.CharField(required=False)
         fresh = f.BooleanField(required=False)
+        sld = f.CharField(required=False)
+        sld_body = f.CharField(required=False)
 
         @classmethod
         def from_request(cls, request):
@@ -219,21 +398,48 @@ class GetMapMixin(common.OWSMixinBase):
             request['elevation'] = request.get('elevation', None)
             request['v'] = request.get('v', None)
             request['fresh'] = request.get('fresh', False)
+            request['sld'] = request.get('sld')
+            request['sld_body'] = request.get('sld_body')
 
     def GetMap(self, r, kwargs):
         parms = GetMapMixin.Parameters.create(kwargs).cleaned_data
 
         kwargs = { i : j for i, j in kwargs.items() if i not in parms }
 
-        item = self.adapter.get_cache_record(**parms)
-        if item and not parms['fresh']:
-            return HttpResponse(item, mimetype='image/'+parms['format'])
+        max_age = self.max_age(parms['layers'])
+        if not parms['fresh']:
+            # answer revalidations from the record's metadata alone, before fetching or rendering the image
+            metadata = self.adapter.get_cache_metadata(**parms)
+            if not_modified(r, metadata):
+                return cache_headers(HttpResponse(status=304), metadata, max_age)
+            item = self.adapter.get_cache_record(**parms)
+            if item:
+                return cache_headers(HttpResponse(item, mimetype='image/'+parms['format']), metadata, max_age)
 
         if self.adapter.requires_time and 'time' not in parms:
             raise common.MissingParameterValue.at('time')
         if self.adapter.requires_elevation and 'elevation' not in parms:
             raise common.MissingParameterValue.at('elevation')
 
+        saved = []
+        ret, fmt = self.render_map(parms, kwargs, lambda item: saved.append(self.adapter.cache_result(item, **parms)))
+        resp = HttpResponse(ret, mimetype=fmt if '/' in fmt else 'image/'+fmt)
+        return cache_headers(resp, saved[0] if saved else None, max_age)
+
+    def max_age(self, layers):
+        """The Cache-Control max-age of a map of some layers, or None"""
+        ages = [self.layer_cache_max_age.get(layer, self.cache_max_age) for layer in layers]
+        ages = [age for age in ages if age is not None]
+        return min(ages) if ages else None
+
+    def render_map(self, parms, kwargs, save):
+        """Render a map for a set of cleaned GetMap parameters.
+
+        :param parms: The cleaned data of :class:`GetMapMixin.Parameters`
+        :param kwargs: Any other request parameters, which are handed to the adapter.
+        :param save: Called with the encoded image when the result should be cached.
+        :return: (image, format): the encoded image, and the format stripped of any "image/" prefix.
+        """
         if parms['format'].startswith('image/'):
             fmt = parms['format'][len('image/'):]
         else:
@@ -260,6 +466,8 @@ class GetMapMixin(common.OWSMixinBase):
                 v=parms['v'],
                 filter = fltr,
                 format = fmt.encode('ascii'),
+                sld = parms['sld'],
+                sld_body = parms['sld_body'],
                 **kwargs
             )
 
@@ -273,7 +481,8 @@ class GetMapMixin(common.OWSMixinBase):
             # B: return a filename.  This is assumed to already be in the proper format.  If it's not, you're going to
             # confuse a bunch of people
             #
-            # C: return a numpy array in which case scipy is asked to handle it through "imsave"
+            # C: return a numpy array of uint8 in NxMx4 RGBA form (the output of a Palette), which is encoded straight
+            # from its buffer by encode_array
             #
             # D: return a file or StringIO instance.  This is also already assumed to be in the proper format
             #
@@ -293,28 +502,17 @@ class GetMapMixin(common.OWSMixinBase):
                 elif isinstance(ds, basestring):
                     try:
                         ret = open(ds)
-                    except IOError:
-                        if HAVE_SCIPY:
-                            tmp = tempfile.NamedTemporaryFile(suffix='.tif')
-                            scipy.misc.imsave(tmp.name, ds)
-                            ds = gdal.Open(tmp.name)
-                            # TODO add all the appropriate metadata from the request into the dataset if this == being returned as a GeoTIFF
-                elif HAVE_SCIPY:
-                    tmp = tempfile.NamedTemporaryFile(suffix='.tif')
-                    scipy.misc.imsave(tmp.name, ds)
-                    ds = gdal.Open(tmp.name)
-                    # TODO add all the appropriate metadata from the request into the dataset if this == being returned as a GeoTIFF
+                    except IOError as ex:
+                        raise common.NoApplicableCode(str(ex))
+                elif HAVE_NUMPY and isinstance(ds, np.ndarray):
+                    try:
+                        ret = encode_array(ds, fmt)
+                    except Exception as ex:
+                        raise common.NoApplicableCode(str(ex))
+                    save(ret)
 
             if not ret:
-                if fmt == 'tiff' or fmt == 'geotiff':
-                    driver = gdal.GetDriverByName('GTiff')
-                elif fmt == 'jpg' or fmt == 'jpeg':
-                    driver = gdal.GetDriverByName('jpeg')
-                elif fmt == 'jp2k' or fmt == 'jpeg2000':
-                    tmp = tempfile.NamedTemporaryFile(suffix='.jp2')
-                    driver = gdal.GetDriverByName('jpeg2000')
-                else:
-                    driver = gdal.GetDriverByName(fmt.encode('ascii'))
+                driver = get_driver(fmt)
 
                 try:
                     tmp = tempfile.NamedTemporaryFile(suffix='.' + fmt)
@@ -322,18 +520,108 @@ class GetMapMixin(common.OWSMixinBase):
                     del ds2
                     tmp.seek(0)
                     ret = tmp.read()
-                    self.adapter.cache_result(ret, **parms)
+                    save(ret)
                 except Exception as ex:
                     del tmp
                     raise common.NoApplicableCode(str(ex))
 
-        resp = HttpResponse(ret, mimetype=fmt if '/' in fmt else 'image/'+fmt)
-        return resp
+        return ret, fmt
+
+
+#: The MIME type of Mapbox Vector Tiles
+VECTOR_TILE_MIMETYPE = 'application/vnd.mapbox-vector-tile'
+
+class GetVectorTileMixin(common.OWSMixinBase):
+    """ Handle the GetVectorTile request: the features GetMap would draw for a bbox, clipped and encoded as a Mapbox
+    Vector Tile so that clients can style them locally.  Tiles are cached alongside GetMap's images.  Requires that the
+    get_vector_tile method is implemented in the adapter.
+    """
+
+    #: How many grid units beyond the tile's edges geometries are kept, so lines don't show seams between tiles.
+    vector_tile_buffer = 64
+
+    class Parameters(common.CommonParameters):
+        layers = utils.MultipleValueField()
+        srs = f.CharField(required=False)
+        bbox = utils.BBoxField()
+        extent = f.IntegerField()
+        styles = utils.MultipleValueField(required=False)
+        time = f.DateTimeField(required=False)
+        filter = f.CharField(required=False)
+        elevation = f.FloatField(required=False)
+        v = f.CharField(required=False)
+        fresh = f.BooleanField(required=False)
+        sld = f.CharField(required=False)
+        sld_body = f.CharField(required=False)
+
+        @classmethod
+        def from_request(cls, request):
+            request['layers'] = request.get('layers').split(',')
+            request['srs'] = request.get('srs', None)
+            request['filter'] = request.get('filter')
+            request['bbox'] = request.get('bbox')
+            request['extent'] = int( request.get('extent', 4096) )
+            request['styles'] = request.get('styles', '').split(',')
+            request['time'] = utils.parsetime(request.get('time'))
+            request['elevation'] = request.get('elevation', None)
+            request['v'] = request.get('v', None)
+            request['fresh'] = request.get('fresh', False)
+            request['sld'] = request.get('sld')
+            request['sld_body'] = request.get('sld_body')
+
+    def GetVectorTile(self, r, kwargs):
+        parms = GetVectorTileMixin.Parameters.create(kwargs).cleaned_data
+
+        # a tile is cached under the same locator as a GetMap image of the same size
+        locator = dict(parms, width=parms['extent'], height=parms['extent'], format=VECTOR_TILE_MIMETYPE, bgcolor=None, transparent=True)
+        del locator['extent']
+
+        max_age = self.max_age(parms['layers'])
+        if not parms['fresh']:
+            metadata = self.adapter.get_cache_metadata(**locator)
+            if not_modified(r, metadata):
+                return cache_headers(HttpResponse(status=304), metadata, max_age)
+            item = self.adapter.get_cache_record(**locator)
+            if item:
+                return cache_headers(HttpResponse(item, mimetype=VECTOR_TILE_MIMETYPE), metadata, max_age)
+
+        if self.adapter.requires_time and 'time' not in parms:
+            raise common.MissingParameterValue.at('time')
+        if self.adapter.requires_elevation and 'elevation' not in parms:
+            raise common.MissingParameterValue.at('elevation')
+
+        fltr = None
+        if parms['filter']:
+            fltr = json.loads(parms['filter'])
+
+        try:
+            tile = self.adapter.get_vector_tile(
+                layers=parms['layers'],
+                srs=parms['srs'],
+                bbox=parms['bbox'],
+                extent=parms['extent'],
+                buffer=self.vector_tile_buffer,
+                styles=parms['styles'],
+                time=parms['time'],
+                elevation=parms['elevation'],
+                v=parms['v'],
+                filter=fltr,
+                sld=parms['sld'],
+                sld_body=parms['sld_body']
+            )
+        except (ImportError, NotImplementedError) as ex:
+            raise common.NoApplicableCode.at('GetVectorTile', str(ex))
+
+        metadata = self.adapter.cache_result(tile, **locator)
+        return cache_headers(HttpResponse(tile, mimetype=VECTOR_TILE_MIMETYPE), metadata, max_age)
 
 
 class GetFeatureInfoMixin(common.OWSMixinBase):
     """ Handle the GetFeatureInfo request in WMS.  Requires that the get_feature_info method is implemented in the adapter.
     """
+
+    #: How many pixels from the click a feature may be and still be reported, so that points and lines can be hit.
+    feature_info_tolerance = 3
     class Parameters(common.CommonParameters):
         layers = utils.MultipleValueField()
         bbox = utils.BBoxField()
@@ -384,12 +672,13 @@ class GetFeatureInfoMixin(common.OWSMixinBase):
         for k,v in kwargs.items():
             if k not in parms:
                 parms[k.lower()] = v
+        parms['tolerance'] = self.feature_info_tolerance * (bbox[2]-bbox[0]) / width
         info = self.adapter.get_feature_info(wherex, wherey, **parms)
 
         if parms['callback']:
-            return HttpResponse("{callback}({json})".format(callback=parms['callback'], json=json.dumps(info)))
-        elif parms['format'] == 'application/json' or r.META['HTTP_ACCEPT_LANGUAGE'] == 'application/json':
-            return HttpResponse(json.dumps(info), mimetype='application/json')
+            return HttpResponse("{callback}({json})".format(callback=parms['callback'], json=json.dumps(info, cls=DjangoJSONEncoder)))
+        elif parms['format'] == 'application/json' or r.META.get('HTTP_ACCEPT') == 'application/json':
+            return HttpResponse(json.dumps(info, cls=DjangoJSONEncoder), mimetype='application/json')
         else:
             elt = etree.Element('FeatureInfoResponse')
             for i, layer in enumerate(info.keys()):
@@ -426,6 +715,7 @@ class WMS(
     common.GetValidTimesMixin,
     GetFeatureInfoMixin,
     GetMapMixin,
+    GetVectorTileMixin,
     # GetStylesMixin,
     # GetLegendGraphicMixin,
     # DescribeLayerMixin
@@ -467,6 +757,7 @@ class WMS(
     requests = [
         { "name" : "GetMap", "formats" : []},
         { "name" : "GetFeatureInfo", "formats" : ['json','text/plain','text/html']},
+        { "name" : "GetVectorTile", "formats" : [VECTOR_TILE_MIMETYPE]},
         { "name" : "GetValidTimes", "formats" : ['json']},
         { "name" : "GetValidVersions", "formats" : ['json']},
         { "name" : "GetValidTimes", "formats" : ['json']},
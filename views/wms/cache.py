@@ -1,4 +1,6 @@
 from bson import Binary
+from datetime import datetime
+from django.conf import settings
 import hashlib
 import pymongo
 
@@ -30,31 +32,49 @@ class WMSCache(object):
         self.collection.ensure_index([("_creation_time", pymongo.DESCENDING)])
         self.collection.ensure_index([("_used_time", pymongo.DESCENDING)])
 
+    @staticmethod
+    def docid(**keys):
+        """The document id of a set of keys"""
+        docid = hashlib.new('md5')
+        docid.update(str(sorted(keys.items())))
+        return docid.hexdigest()
+
     def save(self, item, **keys):
         """ Save or update a cache item.
         :param item: The item to save.
         :param keys: The keys to save the item under.  Must be serializable by PyMongo.
-        :return:
+        :return: The item's metadata, as :meth:`metadata` returns it.
         """
         document = keys
-        docid = hashlib.new('md5')
-        docid.update(str(sorted(keys.items())))
-        docid = docid.hexdigest()
+        docid = self.docid(**keys)
 
         document['_id'] = docid
         document['_item'] = Binary(item)
+        document['_etag'] = hashlib.md5(docid + hashlib.md5(item).hexdigest()).hexdigest()
         document['_creation_time'] = datetime.utcnow()
         document['_used_time'] = document['_creation_time']
         self.collection.save(document)
+        return { '_id' : docid, '_etag' : document['_etag'], '_creation_time' : document['_creation_time'] }
+
+    def metadata(self, **keys):
+        """ Find the metadata of a single item in the cache without fetching the item itself, for answering
+        conditional requests.
+        :param keys:
+        :return: A dict of _id, _etag, which is derived from the keys and the item's content, and _creation_time; or
+            None if the item isn't cached.
+        """
+        return self.collection.find_and_modify(
+            { '_id' : self.docid(**keys), '_etag' : { '$exists' : True } },
+            { '$set' : { '_used_time' : datetime.utcnow() } },
+            fields={ '_etag' : True, '_creation_time' : True }
+        )
 
     def locate(self, **keys):
         """ Find a single item in the cache.
         :param keys:
         :return:
         """
-        docid = hashlib.new("md5")
-        docid.update(str(sorted(keys.items())))
-        docid = docid.hexdigest()
+        docid = self.docid(**keys)
 
         item = self.collection.find_and_modify({ '_id' : docid }, {"$set" : {'_used_time' : datetime.utcnow() }})
         if item:
@@ -1,19 +1,31 @@
-from ga_ows.views.wms.base import WMSAdapterBase, WMSCache
+from ga_ows.views import common
+from ga_ows.views.wms.base import WMSAdapterBase
+from ga_ows.views.wms.cache import WMSCache
 
 from collections import defaultdict
+import operator
+import threading
+from django.db.models import Q
 from django.contrib.gis.db.models.proxy import GeometryProxy
 from django.contrib.gis.db.models import GeometryField
-import shapely.geometry as g
-from django.contrib.gis.geos import GEOSGeometry, Point
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
 from osgeo import osr
 from django.contrib.gis import gdal as djgdal
 from ga_ows.rendering.cairo_geodjango_renderer import RenderingContext
-from ga_ows.utils import create_spatialref
+from ga_ows.models.wms import LayerExtent
+from ga_ows.rendering import sld
+from ga_ows.rendering.mvt import TileEncoder
+from ga_ows.rendering.sld import sld_digest
+from ga_ows.utils import meters_per_unit
 
 
 class GeoDjangoWMSAdapter(WMSAdapterBase):
     """ A default implementation of the WMS adapter for an object in the GeoDjango ORM."""
 
+    #: The most features GetFeatureInfo reads from the database.  Every one of them touches the click, so this only
+    #: matters when feature_count is large or many layers are queried at once.
+    feature_info_candidates = 1000
+
     def __init__(self, cls, styles, time_property=None, elevation_property=None, version_property=None, requires_time=False, requires_version=False, requires_elevation=False, cache_route='default', simplify=False):
         """
         :param cls: The model class to expose
@@ -38,17 +50,19 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
         self.cls = cls
         self.cache = WMSCache.for_geodjango_model(self.cls, route=cache_route)
         self.simplify = simplify
+        LayerExtent.watch(self.cls)
+        common.watch_adapter(self)
+        self._local = threading.local()
 
     def cache_result(self, item, **kwargs):
-        locator = kwargs
-        if 'fresh' in locator:
-            del locator['fresh']
-        locator['model'] = self.cls._meta.object_name
+        # saved under the same locator get_cache_record and get_cache_metadata look items up by
+        return self.cache.save(item, **self._locator(**kwargs))
 
-        self.cache.save(item, **kwargs)
+    def get_cache_record(self, **kwargs):
+        return self.cache.locate(**self._locator(**kwargs))
 
-    def get_cache_record(self, layers, srs, bbox, width, height, styles, format, bgcolor, transparent, time, elevation, v, filter, **kwargs):
-        locator = {
+    def _locator(self, layers, srs, bbox, width, height, styles, format, bgcolor, transparent, time, elevation, v, filter, **kwargs):
+        return {
             'layers' : layers,
             'srs' : srs,
             'bbox' : bbox,
@@ -62,30 +76,61 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
             'elevation' : elevation,
             'v' : v,
             'filter' : filter,
+            'sld' : kwargs.get('sld'),
+            'sld_body' : sld_digest(kwargs['sld_body']) if kwargs.get('sld_body') else None,
             'model' : self.cls._meta.object_name
         }
 
-        return self.cache.locate(**locator)
-
-    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter):
-        if type(srs) is int:
-            kind='srid'
-        elif srs.upper().startswith('EPSG'):
-            kind=None
-        elif srs.startswith('-') or srs.startswith('+'):
-            kind='proj'
-        else:
-            kind='wkt'
-
-        s_srs = create_spatialref(srs, srs_format=kind)
-        t_srs = self.cls.srs
-        crx = osr.CoordinateTransformation(s_srs, t_srs)
-        wherex, wherey, _0 = crx.TransformPoint(wherex, wherey, 0)
-
-        if not filter:
-            return [self.cls.objects.filter({ layer + "__contains" : g.Point(wherex, wherey) }).limit(feature_count).values() for layer in layers]
-        else:
-            return [self.cls.objects.filter({ layer + "__contains" : g.Point(wherex, wherey) }).filter(**filter).limit(feature_count).values() for layer in layers]
+    def cache_keys(self):
+        return { 'model' : self.cls._meta.object_name }
+
+    def get_cache_metadata(self, **kwargs):
+        return self.cache.metadata(**self._locator(**kwargs))
+
+    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter, tolerance=0, **kwargs):
+        feature_count = feature_count or 1
+
+        # the click, widened by the tolerance, in each layer's native SRS
+        boxes = dict((layer, self._click_box(wherex, wherey, tolerance, srs, self.nativesrs(layer))) for layer in layers)
+
+        # one round trip for all the layers.  The exact intersection test runs in the database, behind the spatial
+        # index, so the candidates are all hits and the limit can't cut off a hit in favour of a near miss.  A row
+        # may be a hit in only some of the layers, which the prepared geometries sort out here.
+        qs = self.cls.objects.filter(reduce(operator.or_, [Q(**{ layer + '__intersects' : boxes[layer] }) for layer in layers]))
+        if filter:
+            qs = qs.filter(**filter)
+        qs = qs.order_by('pk')
+        names = [field.name for field in self.cls._meta.fields if not isinstance(field, GeometryField)]
+        prepared = dict((layer, boxes[layer].prepared) for layer in layers)
+
+        info = dict((layer, []) for layer in layers)
+        for row in qs.values(*(names + list(layers)))[:self.feature_info_candidates]:
+            geometries = dict((layer, row.pop(layer)) for layer in layers)
+            for layer in layers:
+                if len(info[layer]) < feature_count and geometries[layer] is not None and prepared[layer].intersects(geometries[layer]):
+                    info[layer].append(row)
+        return info
+
+    def _click_box(self, x, y, tolerance, srs, srid):
+        """A square of tolerance around a point in the request SRS, as a polygon in a layer's native SRS"""
+        box = Polygon.from_bbox((x - tolerance, y - tolerance, x + tolerance, y + tolerance))
+        transformation = self._transformation(srs, srid)
+        if transformation is not None:
+            box.transform(transformation)
+            box = Polygon.from_bbox(box.extent)
+        box.srid = srid
+        return box
+
+    def _transformation(self, srs, srid):
+        """A cached transformation from a request SRS to a native SRID, or None if they're the same"""
+        transformations = getattr(self._local, 'transformations', None)
+        if transformations is None:
+            transformations = self._local.transformations = {}
+        if (srs, srid) not in transformations:
+            s_srs = djgdal.SpatialReference(srs)
+            t_srs = djgdal.SpatialReference(srid)
+            transformations[(srs, srid)] = None if s_srs.srid == srid else djgdal.CoordTransform(s_srs, t_srs)
+        return transformations[(srs, srid)]
 
     def get_2d_dataset(self, **kwargs):
         layers, srs, bbox, width, height, styles, bgcolor, transparent, time, elevation, v, filter = [kwargs[k] if k in kwargs else None for k in ['layers', 'srs', 'bbox', 'width', 'height', 'styles', 'bgcolor', 'transparent', 'time', 'elevation', 'v', 'filter']]
@@ -99,38 +144,22 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
         if self.requires_elevation and not elevation:
             raise Exception('this service requires an elevation')
 
-        ss = None
-        required_fields = tuple()
-        if type(self.styles) is dict:
-            if not styles and 'default' in self.styles:
-                ss = self.styles['default']
-            elif styles:
-                ss = self.styles[styles]
-        else:
-            ss = self.styles
-            required_fields = ss.required_fields
+        ss = self.get_stylesheet(styles, kwargs.get('sld'), kwargs.get('sld_body'))
 
         ctx = RenderingContext(ss, minx, miny, maxx, maxy, width, height)
 
         t_srs = djgdal.SpatialReference(srs)
         s_srs = djgdal.SpatialReference(self.nativesrs(layers[0]))
 
-        s_mins = Point(minx, miny, srid=t_srs.wkt)
-        s_maxs = Point(maxx, maxy, srid=t_srs.wkt)
-        s_mins.transform(s_srs.wkt)
-        s_maxs.transform(s_srs.wkt)
-
-        geom = GEOSGeometry('POLYGON(({minx} {miny}, {maxx} {miny}, {maxx} {maxy}, {minx} {maxy}, {minx} {miny}))'.format(
-            minx=s_mins.x,
-            miny=s_mins.y,
-            maxx=s_maxs.x,
-            maxy=s_maxs.y
-        ))
+        selection = self._style_selection(ss, (maxx - minx) / width * meters_per_unit(t_srs))
+        if selection is None:
+            return ctx.surface
+        required_fields, rules_q = selection
 
+        geom = self._native_bbox(bbox, t_srs, s_srs)
         for query_layer in layers:
             filter[query_layer + "__bboverlaps"] = geom
 
-
         def xform(g):
             if self.simplify:
                 k = g.simplify((maxx-minx) / width)
@@ -141,8 +170,11 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
 
         for query_layer in layers:
             qs = self.cls.objects.filter(**filter)
+            if rules_q is not None:
+                qs = qs.filter(rules_q)
             if required_fields:
-                qs = qs.only(*required_fields).values(*required_fields)
+                columns = tuple(set(required_fields) | set([query_layer]))
+                qs = qs.only(*columns).values(*columns)
             else:
                 qs = qs.values()
 
@@ -154,6 +186,89 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
 
         return ctx.surface
 
+    def get_vector_tile(self, layers, srs, bbox, extent, buffer, styles, time, elevation, v, filter, **kwargs):
+        minx, miny, maxx, maxy = bbox
+        filter = dict(filter or {})
+
+        if self.requires_time and not time:
+            raise Exception("this service requires a time parameter")
+        if self.requires_elevation and not elevation:
+            raise Exception('this service requires an elevation')
+
+        tile = TileEncoder(bbox, extent=extent, buffer=buffer)
+        ss = self.get_stylesheet(styles, kwargs.get('sld'), kwargs.get('sld_body'))
+
+        t_srs = djgdal.SpatialReference(srs)
+        s_srs = djgdal.SpatialReference(self.nativesrs(layers[0]))
+
+        selection = self._style_selection(ss, (maxx - minx) / extent * meters_per_unit(t_srs))
+        if selection is None:
+            return tile.encode()
+        required_fields, rules_q = selection
+
+        # features in the buffer around the tile are drawn too
+        margin_x = (maxx - minx) * buffer / extent
+        margin_y = (maxy - miny) * buffer / extent
+        geom = self._native_bbox((minx - margin_x, miny - margin_y, maxx + margin_x, maxy + margin_y), t_srs, s_srs)
+
+        pk = self.cls._meta.pk.attname
+        if required_fields:
+            names = [name for name in required_fields if name not in layers]
+        else:
+            names = [field.attname for field in self.cls._meta.fields if not isinstance(field, GeometryField)]
+
+        for query_layer in layers:
+            qs = self.cls.objects.filter(**dict(filter, **{ query_layer + "__bboverlaps" : geom }))
+            if rules_q is not None:
+                qs = qs.filter(rules_q)
+            columns = list(set(names) | set([pk, query_layer]))
+            native = self.nativesrs(query_layer) == srs
+
+            def features(rows):
+                for row in rows:
+                    geometry = row.pop(query_layer)
+                    if geometry is not None and not native:
+                        geometry.transform(t_srs.wkt)
+                    feature_id = row[pk] if pk in names else row.pop(pk)
+                    yield geometry, row, feature_id
+
+            tile.add_layer(query_layer, features(qs.values(*columns).iterator()))
+
+        return tile.encode()
+
+    def _style_selection(self, ss, pxsize):
+        """Work out which rows and columns a stylesheet needs at a pixel size.
+
+        :return: None if no rule of the stylesheet is active at this scale; otherwise (required_fields, rules_q), where
+            required_fields is empty when every field is needed, and rules_q is None when every row is.
+        """
+        required_fields = ss.required_fields if ss is not None else tuple()
+        rules_q = None
+        # only the rules active at this scale can select features or need fields
+        if getattr(ss, 'rules', None):
+            active_rules = ss.rules.active(pxsize)
+            if not active_rules:
+                return None
+            if required_fields:
+                required_fields = tuple(set(required_fields) | ss.rules.required_fields(pxsize))
+            rules_q = sld.rules_filter(active_rules, sld.to_q)
+        return required_fields, rules_q
+
+    def _native_bbox(self, bbox, t_srs, s_srs):
+        """A bbox in the request SRS as a polygon in the native SRS, for bboverlaps lookups"""
+        minx, miny, maxx, maxy = bbox
+        s_mins = Point(minx, miny, srid=t_srs.wkt)
+        s_maxs = Point(maxx, maxy, srid=t_srs.wkt)
+        s_mins.transform(s_srs.wkt)
+        s_maxs.transform(s_srs.wkt)
+
+        return GEOSGeometry('POLYGON(({minx} {miny}, {maxx} {miny}, {maxx} {maxy}, {minx} {maxy}, {minx} {miny}))'.format(
+            minx=s_mins.x,
+            miny=s_mins.y,
+            maxx=s_maxs.x,
+            maxy=s_maxs.y
+        ))
+
     def layerlist(self):
         for k,v in self.cls.__dict__.items():
             if type(v) is GeometryProxy:
@@ -163,14 +278,18 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
         return self.cls.__dict__[layer]._field.srid
 
     def nativebbox(self):
-        return self.cls.objects.extent()
+        extents = [extent for extent in (LayerExtent.of_model(self.cls, layer) for layer in self.layerlist()) if extent]
+        if not extents:
+            return None
+        minxs, minys, maxxs, maxys = zip(*extents)
+        return min(minxs), min(minys), max(maxxs), max(maxys)
 
     def get_valid_times(self, **kwargs):
         if self.time_property:
             qs = self.cls.objects.all()
             if 'filter' in kwargs:
                 qs = qs.filter(**kwargs['filter'])
-            return [t[0] for t in qs.values_list(self.time_property)]
+            return list(qs.order_by(self.time_property).values_list(self.time_property, flat=True).distinct())
 
     def get_valid_versions(self, **kwargs):
         qs = self.cls.objects.all()
@@ -179,11 +298,11 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
 
         if self.version_property and self.time_property:
             ret = defaultdict(lambda: [])
-            for t in qs.values_list(self.time_property, self.version_property):
-                ret[t[0]].append(t[1])
+            for t, v in qs.order_by(self.time_property, self.version_property).values_list(self.time_property, self.version_property).distinct():
+                ret[t].append(v)
             return ret
         elif self.version_property:
-            return [t[0] for t in qs.values_list(self.version_property)]
+            return list(qs.order_by(self.version_property).values_list(self.version_property, flat=True).distinct())
 
     def get_valid_elevations(self, **kwargs):
         qs = self.cls.objects.all()
@@ -191,7 +310,7 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
             qs = qs.filter(**kwargs['filter'])
 
         if self.elevation_property:
-            return [t[0] for t in qs.values_list(self.elevation_property)]
+            return list(qs.order_by(self.elevation_property).values_list(self.elevation_property, flat=True).distinct())
 
     def get_service_boundaries(self):
         return self.nativebbox()
@@ -204,7 +323,7 @@ class GeoDjangoWMSAdapter(WMSAdapterBase):
             layer['title'] = field.verbose_name
             layer['srs'] = field.srid
             layer['queryable'] = True
-            minx, miny, maxx, maxy = self.cls.objects.all().extent()
+            minx, miny, maxx, maxy = LayerExtent.of_model(self.cls, field.name) or (0,0,0,0)
             layer['minx'] = minx
             layer['miny'] = miny
             layer['maxx'] = maxx
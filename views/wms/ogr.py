@@ -1,52 +1,179 @@
-from ga_ows.views.wms.base import WMSAdapterBase, WMSCache
-
-from django.contrib.gis.geos import Point
-from osgeo import osr
+from ga_ows.views import common
+from ga_ows.views.wms.base import WMSAdapterBase
+from ga_ows.views.wms.cache import WMSCache
+
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import threading
+import numpy as np
+import shapely
+from shapely.geometry import box
+from shapely.strtree import STRtree
+from django.contrib.gis import gdal as djgdal
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+from osgeo import ogr, osr
+from ga_ows.models.wms import LayerExtent, OGRDataset, OGRLayer
 from ga_ows.rendering.cairo_geodjango_renderer import RenderingContext
-from ga_ows.utils import create_spatialref
-
-class OGRDatasetCollectionAdapter(WMSAdapterBase):
-    def __init__(self, collection_name, storage_backend):
-        pass
-
-class OGRDatasetWMSAdapter(WMSAdapterBase):
-    """ A default implementation of the WMS adapter for an OGR dataset."""
-
-    def __init__(self, dataset, styles, time_property=None, elevation_property=None, version_property=None, requires_time=False, requires_version=False, requires_elevation=False, cache_route='default', simplify=False):
+from ga_ows.rendering import sld
+from ga_ows.rendering.sld import sld_digest
+from ga_ows.utils import meters_per_unit, ogr_pool
+
+#: Shapely 2's STRtree answers queries with indices; earlier versions answer with the geometries themselves.
+_STRTREE_INDICES = int(shapely.__version__.split('.')[0]) >= 2
+
+
+def spatial_reference(srs):
+    """An :py:class:`osgeo.osr.SpatialReference` for a request's srs: an SRID, or anything SetFromUserInput reads,
+    such as 'EPSG:4326', a PROJ.4 string or WKT.  Coordinates are taken in x, y order whatever the authority says."""
+    if isinstance(srs, (int, long)) or str(srs).isdigit():
+        srs = 'EPSG:{0}'.format(srs)
+    ret = osr.SpatialReference()
+    if ret.SetFromUserInput(str(srs)) != 0:
+        raise ValueError('unrecognised spatial reference {0!r}'.format(srs))
+    if hasattr(ret, 'SetAxisMappingStrategy'):
+        ret.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return ret
+
+
+def filter_sql(filter):
+    """An OGR SQL WHERE clause for a request's filter, a dict of field names and the values they must equal, or None
+    if there is no filter.  Django-style lookups such as name__startswith have no OGR equivalent and are rejected."""
+    if not filter:
+        return None
+    clauses = []
+    for name, value in sorted(filter.items()):
+        if '__' in name:
+            raise common.InvalidParameterValue.at('filter', 'OGR layers can only be filtered on equal field values, not {0}'.format(name))
+        field = u'"' + name.replace('"', '""') + u'"'
+        if value is None:
+            clauses.append(field + u' IS NULL')
+        elif isinstance(value, bool):
+            clauses.append(field + u' = ' + repr(int(value)))
+        elif isinstance(value, basestring):
+            clauses.append(field + u" = '" + value.replace("'", "''") + u"'")
+        else:
+            clauses.append(field + u' = ' + repr(value))
+    return u' AND '.join(clauses).encode('utf-8')
+
+
+class PreloadedLayer(object):
+    """An OGR layer read into memory once: the geometries as WKB, the attributes as one array per field, and an
+    STRtree of the features' envelopes.  Features are kept in the order the layer returned them, so renders draw them
+    in the same order as reading the layer would."""
+
+    def __init__(self, layer):
+        defn = layer.GetLayerDefn()
+        self.name = layer.GetName()
+        self.srs = layer.GetSpatialRef().Clone()
+        self.fields = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+        wkbs = []
+        envelopes = []
+        columns = dict((name, []) for name in self.fields)
+        layer.SetAttributeFilter(None)
+        layer.SetSpatialFilter(None)
+        layer.SetIgnoredFields([])
+        layer.ResetReading()
+        for f in layer:
+            geometry = f.GetGeometryRef()
+            if geometry is None:
+                continue
+            wkbs.append(bytes(geometry.ExportToWkb()))
+            xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+            envelopes.append(box(xmin, ymin, xmax, ymax))
+            for name in self.fields:
+                columns[name].append(f.GetField(name))
+        layer.ResetReading()
+
+        self.wkbs = wkbs
+        self.columns = dict((name, np.array(values)) for name, values in columns.items())
+        self.tree = STRtree(envelopes) if envelopes else None
+        if not _STRTREE_INDICES:
+            # the tree holds references to the envelopes, so their ids stay valid
+            self._positions = dict((id(envelope), k) for k, envelope in enumerate(envelopes))
+
+    def __len__(self):
+        return len(self.wkbs)
+
+    def query(self, minx, miny, maxx, maxy):
+        """The positions of the features whose envelopes intersect a bbox in the layer's SRS, in layer order"""
+        if self.tree is None:
+            return np.zeros(0, dtype=int)
+        hits = self.tree.query(box(minx, miny, maxx, maxy))
+        if not _STRTREE_INDICES:
+            hits = [self._positions[id(envelope)] for envelope in hits]
+        return np.sort(np.asarray(hits, dtype=int))
+
+    def select(self, positions, rules, pxsize):
+        """Narrow positions to the features at least one of the rules could draw.
+
+        :param positions: An array of feature positions, as :meth:`query` returns them.
+        :param rules: The active rules, or None to keep every feature.
+        :param pxsize: The pixel size in meters the rules' scale tests see.
+        """
+        if not rules or not len(positions):
+            return positions
+        required_fields = set()
+        for rule in rules:
+            if not rule.clauses:
+                return positions
+            required_fields |= rule.required_fields
+        if not required_fields <= set(self.columns):
+            return positions
+        data = dict((name, self.columns[name][positions]) for name in required_fields)
+        mask = np.zeros(len(positions), dtype=bool)
+        for rule in rules:
+            mask |= rule.compiled(vectorized=True)(data, pxsize)
+        return positions[mask]
+
+    def features(self, positions, fields, geometry_key, clip=None, transformation=None):
+        """The features at positions as dicts of their fields, with the geometry as a GEOS geometry under geometry_key.
+
+        :param clip: A GEOS polygon in the layer's SRS.  Features that don't intersect it are skipped.
+        :param transformation: A :class:`django.contrib.gis.gdal.CoordTransform` applied to each geometry, or None.
+        """
+        fields = [name for name in fields if name in self.columns]
+        prepared = clip.prepared if clip is not None else None
+        for k in positions:
+            geometry = GEOSGeometry(buffer(self.wkbs[k]))
+            if prepared is not None and not prepared.intersects(geometry):
+                continue
+            if transformation is not None:
+                geometry.transform(transformation)
+            datum = dict((name, self.columns[name][k]) for name in fields)
+            datum[geometry_key] = geometry
+            yield datum
+
+
+class OGRAdapterBase(WMSAdapterBase):
+    """What the OGR adapters share: the cache, feature info, transformations, and working out what a stylesheet needs."""
+
+    def __init__(self, name, styles, requires_time=False, requires_version=False, requires_elevation=False, cache_route='default'):
         """
-        :param dataset: An OGR dataset to expose.
+        :param name: The name the adapter's cache is kept under.
         :param styles: A map of style names to :class:`ga_ows.rendering.styler.Stylesheet`
-        :param time_property: The property name of "time" when that is handled specifically
-        :param elevation_property:  The property name that contains elevation when that is handled specifically
-        :param version_property: THe property name that contains the record version if that is handled specifically.
         :param cache_route: The MongoDB route name (in :const:`settings.MONGODB_ROUTES).  Defaults to 'default'
-        :param simplify: Simplify geometry based on the pixel size if true.  Only useful for polylines / polygons.  May break complicated geometries, so the default is False.  Set to true if renders are unacceptably slow.
-        :return:
         """
-        super(OGRDatasetWMSAdapter, self).__init__(
+        super(OGRAdapterBase, self).__init__(
             styles,
             requires_time=requires_time,
             requires_elevation=requires_elevation,
             requires_version=requires_version
         )
-
-        self.time_property = time_property
-        self.elevation_property = elevation_property
-        self.version_property = version_property
-        self.dataset = dataset
-        self.cache = WMSCache(cache_route, self.dataset.GetName() + "__wms_cache")
-        self.simplify = simplify
+        self.name = name
+        self.cache = WMSCache(cache_route, self.name + "__wms_cache")
+        self._local = threading.local()
 
     def cache_result(self, item, **kwargs):
-        locator = kwargs
-        if 'fresh' in locator:
-            del locator['fresh']
-        locator['model'] = self.dataset.GetName()
+        # saved under the same locator get_cache_record and get_cache_metadata look items up by
+        return self.cache.save(item, **self._locator(**kwargs))
 
-        self.cache.save(item, **kwargs)
+    def get_cache_record(self, **kwargs):
+        return self.cache.locate(**self._locator(**kwargs))
 
-    def get_cache_record(self, layers, srs, bbox, width, height, styles, format, bgcolor, transparent, time, elevation, v, filter, **kwargs):
-        locator = {
+    def _locator(self, layers, srs, bbox, width, height, styles, format, bgcolor, transparent, time, elevation, v, filter, **kwargs):
+        return {
             'layers' : layers,
             'srs' : srs,
             'bbox' : bbox,
@@ -60,43 +187,157 @@ class OGRDatasetWMSAdapter(WMSAdapterBase):
             'elevation' : elevation,
             'v' : v,
             'filter' : filter,
-            'model' : self.dataset.GetName()
+            'sld' : kwargs.get('sld'),
+            'sld_body' : sld_digest(kwargs['sld_body']) if kwargs.get('sld_body') else None,
+            'model' : self.name
         }
 
-        return self.cache.locate(**locator)
+    def get_cache_metadata(self, **kwargs):
+        return self.cache.metadata(**self._locator(**kwargs))
+
+    def cache_keys(self):
+        return { 'model' : self.name }
+
+    def _feature_info(self, ds, wherex, wherey, layers, feature_count, srs, filter, tolerance):
+        feature_count = feature_count or 1
+        where = filter_sql(filter)
+        info = {}
+        for layer in layers:
+            l = ds.GetLayerByName(layer)
+            crx = self._transformation(srs, l.GetSpatialRef())
+            corners = [(wherex + dx, wherey + dy) for dx in (-tolerance, tolerance) for dy in (-tolerance, tolerance)]
+            if crx is not None:
+                corners = [crx.TransformPoint(x, y, 0)[:2] for x, y in corners]
+            xs, ys = zip(*corners)
+            x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+            click = ogr.CreateGeometryFromWkt('POLYGON(({x0} {y0}, {x1} {y0}, {x1} {y1}, {x0} {y1}, {x0} {y0}))'.format(x0=x0, y0=y0, x1=x1, y1=y1))
+
+            # the spatial filter is the bbox prefilter; the exact test follows
+            l.SetSpatialFilterRect(x0, y0, x1, y1)
+            try:
+                l.SetAttributeFilter(where)
+                l.SetIgnoredFields([])
+                l.ResetReading()
+                info[layer] = []
+                for f in l:
+                    geometry = f.GetGeometryRef()
+                    if geometry is not None and geometry.Intersects(click):
+                        info[layer].append(f.items())
+                        if len(info[layer]) >= feature_count:
+                            break
+            finally:
+                l.SetSpatialFilter(None)
+                l.SetAttributeFilter(None)
+        return info
+
+    def _transformation(self, srs, t_srs):
+        """A cached transformation from a request SRS to a layer's SRS, or None if they're the same"""
+        transformations = getattr(self._local, 'transformations', None)
+        if transformations is None:
+            transformations = self._local.transformations = {}
+        key = (srs, t_srs.ExportToWkt())
+        if key not in transformations:
+            s_srs = spatial_reference(srs)
+            transformations[key] = None if s_srs.IsSame(t_srs) else osr.CoordinateTransformation(s_srs, t_srs)
+        return transformations[key]
+
+    def _style_selection(self, ss, t_srs, bbox, width):
+        """Work out what a stylesheet needs from a layer at a render's scale.
+
+        :return: None if no rule is active at this scale, so nothing would be drawn.  Otherwise (active_rules, pxsize,
+            required_fields, rules_sql), where rules_sql is an OGR SQL filter that selects every feature one of the
+            active rules could draw, or None.  active_rules and pxsize are None for stylesheets without rules.
+        """
+        # only the rules active at this scale can select features or need fields
+        minx, miny, maxx, maxy = bbox
+        rules_sql = None
+        active_rules = pxsize = None
+        required_fields = ss.required_fields if ss is not None else tuple()
+        if getattr(ss, 'rules', None):
+            pxsize = (maxx - minx) / width * meters_per_unit(t_srs)
+            active_rules = ss.rules.active(pxsize)
+            if not active_rules:
+                return None
+            if required_fields:
+                required_fields = tuple(set(required_fields) | ss.rules.required_fields(pxsize))
+            rules_sql = sld.rules_filter(active_rules, sld.to_ogr_sql)
+        return active_rules, pxsize, required_fields, rules_sql
 
-    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter):
-        if type(srs) is int:
-            kind='srid'
-        elif srs.upper().startswith('EPSG'):
-            kind=None
-        elif srs.startswith('-') or srs.startswith('+'):
-            kind='proj'
-        else:
-            kind='wkt'
+    def get_service_boundaries(self):
+        return self.nativebbox()
 
-        s_srs = create_spatialref(srs, srs_format=kind)
-        t_srs = self.dataset.GetSpatialRef()
-        crx = osr.CoordinateTransformation(s_srs, t_srs)
-        wherex, wherey, _0 = crx.TransformPoint(wherex, wherey, 0)
+    def get_valid_times(self, **kwargs):
+        raise NotImplementedError()
 
-        if not filter:
-            for layer in layers:
-                l = self.dataset.GetLayerByName(layer)
-                l.ResetReading()
-                l.SetSpatialFilterRect(wherex, wherey, wherex+0.0001, wherey+0.0001)
-                return [f for f in l]
+    def get_valid_versions(self, **kwargs):
+        raise NotImplementedError()
+
+    def get_valid_elevations(self, **kwargs):
+        raise NotImplementedError()
+
+
+class OGRDatasetWMSAdapter(OGRAdapterBase):
+    """ A default implementation of the WMS adapter for an OGR dataset."""
+
+    def __init__(self, dataset, styles, time_property=None, elevation_property=None, version_property=None, requires_time=False, requires_version=False, requires_elevation=False, cache_route='default', simplify=False, preload=False):
+        """
+        :param dataset: An OGR dataset to expose, or a connection string.  Datasets given by connection string are
+            borrowed from :const:`ga_ows.utils.ogr_pool` for each request, so each request has its own handle.
+        :param styles: A map of style names to :class:`ga_ows.rendering.styler.Stylesheet`
+        :param time_property: The property name of "time" when that is handled specifically
+        :param elevation_property:  The property name that contains elevation when that is handled specifically
+        :param version_property: THe property name that contains the record version if that is handled specifically.
+        :param cache_route: The MongoDB route name (in :const:`settings.MONGODB_ROUTES).  Defaults to 'default'
+        :param simplify: Simplify geometry based on the pixel size if true.  Only useful for polylines / polygons.  May break complicated geometries, so the default is False.  Set to true if renders are unacceptably slow.
+        :param preload: Read each layer into memory the first time it's rendered and render from there afterwards.
+            File-backed datasets are read again once their size or modification time changes.  Worth it for small,
+            heavily requested layers; every process holds its own copy.
+        :return:
+        """
+        if isinstance(dataset, basestring):
+            self.connection_string = dataset
+            self.dataset = None
+            name = dataset
         else:
-            for layer in layers:
-                l = self.dataset.GetLayerByName(layer)
-                l.ResetReading()
-                l.SetSpatialFilterRect(wherex, wherey, wherex+0.0001, wherey+0.0001)
-                return [f for f in l] # TODO apply filter.
+            self.connection_string = None
+            self.dataset = dataset
+            name = dataset.GetName()
+        super(OGRDatasetWMSAdapter, self).__init__(
+            name,
+            styles,
+            requires_time=requires_time,
+            requires_elevation=requires_elevation,
+            requires_version=requires_version,
+            cache_route=cache_route
+        )
+
+        self.time_property = time_property
+        self.elevation_property = elevation_property
+        self.version_property = version_property
+        self.simplify = simplify
+        self.preload = preload
+        self._preloaded = {}
+        self._preload_lock = threading.Lock()
+
+    @contextmanager
+    def _datasource(self):
+        if self.connection_string:
+            with ogr_pool.connection(self.connection_string) as ds:
+                yield ds
+        else:
+            yield self.dataset
+
+    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter, tolerance=0, **kwargs):
+        with self._datasource() as ds:
+            return self._feature_info(ds, wherex, wherey, layers, feature_count, srs, filter, tolerance)
 
     def get_2d_dataset(self, **kwargs):
+        with self._datasource() as ds:
+            return self._render(ds, **kwargs)
+
+    def _render(self, ds, **kwargs):
         # TODO apply filtering.  Should start supporting CQL soon.
         layers, srs, bbox, width, height, styles, bgcolor, transparent, time, elevation, v, filter = [kwargs[k] if k in kwargs else None for k in ['layers', 'srs', 'bbox', 'width', 'height', 'styles', 'bgcolor', 'transparent', 'time', 'elevation', 'v', 'filter']]
-        ds = self.dataset.Clone()
         minx,miny,maxx,maxy = bbox
         if filter is None:
             filter = {}
@@ -106,89 +347,138 @@ class OGRDatasetWMSAdapter(WMSAdapterBase):
         if self.requires_elevation and not elevation:
             raise Exception('this service requires an elevation')
 
-        ss = None
-        if type(self.styles) is dict:
-            if not styles and 'default' in self.styles:
-                ss = self.styles['default']
-            elif styles:
-                ss = self.styles[styles]
-        else:
-            ss = self.styles
+        ss = self.get_stylesheet(styles, kwargs.get('sld'), kwargs.get('sld_body'))
 
         ctx = RenderingContext(ss, minx, miny, maxx, maxy, width, height)
 
-        t_srs = osr.SpatialReference()
-        t_srs.ImportFromEPSG(int(srs))
-        l0 = self.dataset.GetLayer(0)
+        t_srs = spatial_reference(srs)
+        l0 = ds.GetLayer(0)
         s_srs = l0.GetSpatialRef()
 
+        selection = self._style_selection(ss, t_srs, bbox, width)
+        if selection is None:
+            return ctx.surface
+        active_rules, pxsize, required_fields, rules_sql = selection
+
         s_mins = Point(minx, miny, srid=t_srs.wkt)
         s_maxs = Point(maxx, maxy, srid=t_srs.wkt)
         s_mins.transform(s_srs.wkt)
         s_maxs.transform(s_srs.wkt)
 
+        if self.preload:
+            clip = Polygon.from_bbox((s_mins.x, s_mins.y, s_maxs.x, s_maxs.y))
+            for query_layer in layers:
+                preloaded = self._preloaded_layer(ds, query_layer)
+                positions = preloaded.query(s_mins.x, s_mins.y, s_maxs.x, s_maxs.y)
+                # the rules are tested in memory wherever they could have been pushed down to OGR
+                positions = preloaded.select(positions, active_rules if rules_sql else None, pxsize)
+                transformation = None
+                if not preloaded.srs.IsSame(t_srs):
+                    transformation = djgdal.CoordTransform(djgdal.SpatialReference(preloaded.srs.ExportToWkt()), djgdal.SpatialReference(t_srs.ExportToWkt()))
+                data = preloaded.features(positions, required_fields or preloaded.fields, query_layer, clip, transformation)
+                ctx.render(data, lambda k: k[query_layer])
+            return ctx.surface
+
         ls = {}
         crx = osr.CoordinateTransformation(s_srs, t_srs)
 
         def xform(f):
             f.SetGeometry(f.geometry().Transform(crx))
 
-        for query_layer in layers:
-            ls[query_layer] = ds.GetLayerByName(query_layer)
-            ls[query_layer].ResetReading()
-            ls[query_layer].SetSpatialFilterRect(s_mins.x, s_mins.y, s_maxs.x, s_maxs.y)
-
-        for query_layer in layers:
-            mysrs = self.nativesrs(query_layer)
-            if mysrs == srs:
-                ctx.render(ls[query_layer], lambda k: k[query_layer])
-            else:
-                ctx.render(ls[query_layer], lambda k: xform(k[query_layer]))
+        try:
+            for query_layer in layers:
+                ls[query_layer] = ds.GetLayerByName(query_layer)
+                ls[query_layer].SetAttributeFilter(rules_sql)
+                if required_fields:
+                    defn = ls[query_layer].GetLayerDefn()
+                    names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+                    ls[query_layer].SetIgnoredFields([name for name in names if name not in required_fields])
+                else:
+                    ls[query_layer].SetIgnoredFields([])
+                ls[query_layer].ResetReading()
+                ls[query_layer].SetSpatialFilterRect(s_mins.x, s_mins.y, s_maxs.x, s_maxs.y)
+
+            for query_layer in layers:
+                mysrs = ls[query_layer].GetSpatialRef()
+                if mysrs == srs:
+                    ctx.render(ls[query_layer], lambda k: k[query_layer])
+                else:
+                    ctx.render(ls[query_layer], lambda k: xform(k[query_layer]))
+        finally:
+            # the datasource is kept open between requests, so the next one mustn't inherit these
+            for layer in ls.values():
+                layer.SetAttributeFilter(None)
+                layer.SetIgnoredFields([])
+                layer.SetSpatialFilter(None)
 
         return ctx.surface
 
+    def _preloaded_layer(self, ds, name):
+        """The in-memory copy of a layer, read again if the datasource's checksum has changed since it was read"""
+        checksum = self.checksum()
+        entry = self._preloaded.get(name)
+        if entry is None or entry[0] != checksum:
+            with self._preload_lock:
+                entry = self._preloaded.get(name)
+                if entry is None or entry[0] != checksum:
+                    entry = self._preloaded[name] = (checksum, PreloadedLayer(ds.GetLayerByName(name)))
+        return entry[1]
+
     def layerlist(self):
-        return [self.dataset.GetLayer(k).GetName() for k in range(self.dataset.GetLayerCount())]
+        with self._datasource() as ds:
+            return [ds.GetLayer(k).GetName() for k in range(ds.GetLayerCount())]
 
     def nativesrs(self, layer):
-        return self.dataset.GetLayerByName(layer).GetSpatialRef()
+        with self._datasource() as ds:
+            return ds.GetLayerByName(layer).GetSpatialRef().Clone()
+
+    def checksum(self):
+        """Size and modification time of a file-backed datasource, or None if it isn't a file.  Cached capabilities
+        and valid values are keyed on it, so they're recomputed when the file changes."""
+        path = self.connection_string or self.name
+        if path and os.path.exists(path):
+            st = os.stat(path)
+            return '{mtime:x}-{size:x}'.format(mtime=int(st.st_mtime), size=st.st_size)
+        return None
+
+    def _layer_extent(self, layer, checksum):
+        """The extent of a layer as GetExtent returns it, read from :class:`ga_ows.models.wms.LayerExtent` while the
+        datasource is unchanged.  Datasources that aren't files are scanned every time."""
+        if checksum is None:
+            return layer.GetExtent()
+        return LayerExtent.of_ogr_layer(self.name, layer, checksum)
 
     def nativebbox(self):
         import sys
         minx, miny, maxx, maxy = sys.maxint, sys.maxint, -sys.maxint, -sys.maxint
-        for k in range(self.dataset.GetLayerCount()):
-            l = self.dataset.GetLayer(k)
-            xminx, xmaxx, xminy, xmaxy = l.GetExtent()
-            minx = min(xminx, minx)
-            miny = min(xminy, miny)
-            maxy = max(xmaxy, maxy)
-            maxx = max(xmaxx, maxx)
+        checksum = self.checksum()
+        with self._datasource() as ds:
+            for k in range(ds.GetLayerCount()):
+                l = ds.GetLayer(k)
+                xminx, xmaxx, xminy, xmaxy = self._layer_extent(l, checksum)
+                minx = min(xminx, minx)
+                miny = min(xminy, miny)
+                maxy = max(xmaxy, maxy)
+                maxx = max(xmaxx, maxx)
 
         return (minx, miny, maxx, maxy)
 
-    def get_valid_times(self, **kwargs):
-        raise NotImplementedError()
-
-    def get_valid_versions(self, **kwargs):
-        raise NotImplementedError()
-
-    def get_valid_elevations(self, **kwargs):
-        raise NotImplementedError()
-
-    def get_service_boundaries(self):
-        return self.nativebbox()
-
     def get_layer_descriptions(self):
+        with self._datasource() as ds:
+            return self._layer_descriptions(ds)
+
+    def _layer_descriptions(self, ds):
         ret = []
-        for k in range(self.dataset.GetLayerCount()):
-            l = self.dataset.GetLayer(k)
+        checksum = self.checksum()
+        for k in range(ds.GetLayerCount()):
+            l = ds.GetLayer(k)
             for field in l.schema:
                 layer = {}
                 layer['name'] = l.GetName()
                 layer['title'] = l.GetName()
                 layer['srs'] = l.GetSpatialRef().ExportToXML()
                 layer['queryable'] = True
-                layer['minx'], layer['maxx'], layer['miny'], layer['maxy'] = l.GetExtent()
+                layer['minx'], layer['maxx'], layer['miny'], layer['maxy'] = self._layer_extent(l, checksum)
                 if field.srid == 4326:
                     layer['ll_minx'] = layer['minx']
                     layer['ll_miny'] = layer['miny']
@@ -223,3 +513,176 @@ class OGRDatasetWMSAdapter(WMSAdapterBase):
             return ret
 
 
+def _layer_features(layer, fields, geometry_key, transformation=None):
+    """The features an OGR layer returns as dicts of their fields, with the geometry as a GEOS geometry under
+    geometry_key, transformed by a :class:`django.contrib.gis.gdal.CoordTransform` if one is given."""
+    for f in layer:
+        geometry = f.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = GEOSGeometry(buffer(geometry.ExportToWkb()))
+        if transformation is not None:
+            geometry.transform(transformation)
+        datum = dict((name, f.GetField(name)) for name in fields)
+        datum[geometry_key] = geometry
+        yield datum
+
+
+class OGRDatasetCollectionAdapter(OGRAdapterBase):
+    """A WMS adapter for a :class:`ga_ows.models.wms.OGRDatasetCollection`, such as a set of shapefiles that each cover
+    part of a region.  Each distinct :class:`ga_ows.models.wms.OGRLayer` name in the collection is one WMS layer, drawn
+    from every dataset that has a layer by that name.  A render only opens the datasets whose layer extents overlap
+    the requested bbox.  Datasets are borrowed from :const:`ga_ows.utils.ogr_pool`, which keeps a bounded number of
+    them open and closes the ones used least recently.
+    """
+
+    #: Adding, removing or changing a dataset or layer of the collection invalidates its cached responses.
+    models = [OGRDataset, OGRLayer]
+
+    def __init__(self, collection_name, styles, requires_time=False, requires_version=False, requires_elevation=False, cache_route='default', pool=ogr_pool):
+        """
+        :param collection_name: The name of the OGRDatasetCollection to expose
+        :param styles: A map of style names to :class:`ga_ows.rendering.styler.Stylesheet`
+        :param cache_route: The MongoDB route name (in :const:`settings.MONGODB_ROUTES).  Defaults to 'default'
+        :param pool: The :class:`ga_ows.utils.OGRDataSourcePool` datasets are opened through.
+        :return:
+        """
+        super(OGRDatasetCollectionAdapter, self).__init__(
+            collection_name,
+            styles,
+            requires_time=requires_time,
+            requires_elevation=requires_elevation,
+            requires_version=requires_version,
+            cache_route=cache_route
+        )
+        self.collection_name = collection_name
+        self.pool = pool
+        common.watch_adapter(self)
+
+    def _layers(self, names=None, box=None):
+        """The collection's OGRLayer rows, optionally only those with given names or whose extents overlap a
+        polygon in EPSG:4326, in the order the datasets were registered."""
+        qs = OGRLayer.objects.filter(dataset__collection__name=self.collection_name)
+        if names is not None:
+            qs = qs.filter(name__in=names)
+        if box is not None:
+            qs = qs.filter(extent__bboverlaps=box)
+        return qs.select_related('dataset').order_by('dataset__id', 'id')
+
+    def _lonlat_box(self, srs, minx, miny, maxx, maxy):
+        """The EPSG:4326 bounds of a box given in a request's srs, as a polygon to compare with layer extents"""
+        corners = [(x, y) for x in (minx, maxx) for y in (miny, maxy)]
+        crx = self._transformation(srs, spatial_reference(4326))
+        if crx is not None:
+            corners = [crx.TransformPoint(x, y, 0)[:2] for x, y in corners]
+        xs, ys = zip(*corners)
+        box = Polygon.from_bbox((min(xs), min(ys), max(xs), max(ys)))
+        box.srid = 4326
+        return box
+
+    def get_2d_dataset(self, **kwargs):
+        layers, srs, bbox, width, height, styles, time, elevation = [kwargs.get(k) for k in ['layers', 'srs', 'bbox', 'width', 'height', 'styles', 'time', 'elevation']]
+        minx, miny, maxx, maxy = bbox
+
+        if self.requires_time and not time:
+            raise Exception("this service requires a time parameter")
+        if self.requires_elevation and not elevation:
+            raise Exception('this service requires an elevation')
+
+        ss = self.get_stylesheet(styles, kwargs.get('sld'), kwargs.get('sld_body'))
+        ctx = RenderingContext(ss, minx, miny, maxx, maxy, width, height)
+
+        t_srs = spatial_reference(srs)
+        selection = self._style_selection(ss, t_srs, bbox, width)
+        if selection is None:
+            return ctx.surface
+        _0, _1, required_fields, rules_sql = selection
+
+        rows = defaultdict(list)
+        for row in self._layers(layers, self._lonlat_box(srs, minx, miny, maxx, maxy)):
+            rows[row.name].append(row)
+
+        for query_layer in layers:
+            for row in rows[query_layer]:
+                with self.pool.connection(row.dataset.location.encode('utf-8')) as ds:
+                    layer = ds.GetLayerByName(row.name.encode('utf-8'))
+                    s_srs = layer.GetSpatialRef()
+                    crx = self._transformation(srs, s_srs)
+                    corners = [(x, y) for x in (minx, maxx) for y in (miny, maxy)]
+                    if crx is not None:
+                        corners = [crx.TransformPoint(x, y, 0)[:2] for x, y in corners]
+                    xs, ys = zip(*corners)
+
+                    defn = layer.GetLayerDefn()
+                    names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+                    fields = [name for name in names if name in required_fields] if required_fields else names
+                    layer.SetAttributeFilter(rules_sql)
+                    layer.SetIgnoredFields([name for name in names if name not in fields])
+                    layer.SetSpatialFilterRect(min(xs), min(ys), max(xs), max(ys))
+                    layer.ResetReading()
+
+                    transformation = None
+                    if crx is not None:
+                        transformation = djgdal.CoordTransform(djgdal.SpatialReference(s_srs.ExportToWkt()), djgdal.SpatialReference(t_srs.ExportToWkt()))
+                    try:
+                        ctx.render(_layer_features(layer, fields, query_layer, transformation), lambda k: k[query_layer])
+                    finally:
+                        layer.SetAttributeFilter(None)
+                        layer.SetIgnoredFields([])
+                        layer.SetSpatialFilter(None)
+
+        return ctx.surface
+
+    def get_feature_info(self, wherex, wherey, layers, callback, format, feature_count, srs, filter, tolerance=0, **kwargs):
+        feature_count = feature_count or 1
+        box = self._lonlat_box(srs, wherex - tolerance, wherey - tolerance, wherex + tolerance, wherey + tolerance)
+        info = dict((layer, []) for layer in layers)
+        for row in self._layers(layers, box):
+            remaining = feature_count - len(info[row.name])
+            if remaining <= 0:
+                continue
+            with self.pool.connection(row.dataset.location.encode('utf-8')) as ds:
+                found = self._feature_info(ds, wherex, wherey, [row.name.encode('utf-8')], remaining, srs, filter, tolerance)
+            info[row.name].extend(found.values()[0])
+        return info
+
+    def layerlist(self):
+        return list(self._layers().order_by('name').values_list('name', flat=True).distinct())
+
+    def nativesrs(self, layer):
+        rows = list(self._layers([layer])[:1])
+        if not rows:
+            return None
+        with self.pool.connection(rows[0].dataset.location.encode('utf-8')) as ds:
+            return ds.GetLayerByName(layer.encode('utf-8')).GetSpatialRef().Clone()
+
+    def nativebbox(self):
+        """The extent of the whole collection, in EPSG:4326"""
+        return self._layers().extent(field_name='extent')
+
+    def get_layer_descriptions(self):
+        ret = []
+        for name in self.layerlist():
+            rows = self._layers([name])
+            minx, miny, maxx, maxy = rows.extent(field_name='extent')
+            human_name = rows.exclude(human_name=None).values_list('human_name', flat=True)[:1]
+            layer = {
+                'name' : name,
+                'title' : human_name[0] if human_name else name,
+                'srs' : 4326,
+                'queryable' : True,
+                'minx' : minx, 'miny' : miny, 'maxx' : maxx, 'maxy' : maxy,
+                'll_minx' : minx, 'll_miny' : miny, 'll_maxx' : maxx, 'll_maxy' : maxy,
+                'styles' : [],
+            }
+            if isinstance(self.styles, dict):
+                for style in self.styles.keys():
+                    layer['styles'].append({
+                        "name" : style,
+                        "title" : style,
+                        "legend_width" : 0,
+                        "legend_height" : 0,
+                        "legend_url" : getattr(self.styles[style], 'legend_url', "")
+                    })
+            ret.append(layer)
+        return ret
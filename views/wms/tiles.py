@@ -0,0 +1,169 @@
+"""
+Tiles on fixed grids.  GetMap takes arbitrary bboxes, so a cached image is only found again when a client sends
+exactly the same floats.  A tile grid fixes the bboxes instead: each zoom level halves the tile size, and a tile is
+addressed by its zoom level, column, and row.  :class:`TiledWMS` serves those tiles next to the ordinary WMS requests
+and caches them under their address::
+
+    urlpatterns = patterns('',
+        url(r'^wms/$', TiledWMS.as_view(adapter=adapter)),
+        url(r'^tiles/(?P<layers>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<format>\w+)$', TiledWMS.as_view(adapter=adapter)),
+    )
+
+An optional ``style`` group in the pattern selects a named style.  Rows count down from the top of the grid, as in
+WMTS and XYZ tile URLs; set ``tms = True`` on the view to count them up from the bottom, as in TMS.
+"""
+from django.http import HttpResponse, Http404
+
+from ga_ows.views import common
+from ga_ows.views.wms.base import WMS, VECTOR_TILE_MIMETYPE, cache_headers, not_modified
+
+
+class TileGrid(object):
+    """A tile matrix set: a square grid of tiles in one SRS that doubles in rows and columns at each zoom level."""
+
+    def __init__(self, name, srid, extent, tile_size=256, matrix_width=1, matrix_height=1, max_zoom=24):
+        """
+        :param name: The grid's name, which is part of every tile's cache key.
+        :param srid: The EPSG code of the grid's SRS
+        :param extent: The bounds of the grid as (minx, miny, maxx, maxy)
+        :param tile_size: The width and height of a tile in pixels.
+        :param matrix_width: The number of columns of tiles at zoom level 0.
+        :param matrix_height: The number of rows of tiles at zoom level 0.
+        :param max_zoom: The deepest zoom level served.
+        """
+        self.name = name
+        self.srid = srid
+        self.extent = extent
+        self.tile_size = tile_size
+        self.matrix_width = matrix_width
+        self.matrix_height = matrix_height
+        self.max_zoom = max_zoom
+
+    def tile_span(self, z):
+        """The width and height of a tile at a zoom level, in SRS units"""
+        minx, miny, maxx, maxy = self.extent
+        return (maxx - minx) / (self.matrix_width << z), (maxy - miny) / (self.matrix_height << z)
+
+    def resolution(self, z):
+        """The size of a pixel at a zoom level, in SRS units"""
+        return self.tile_span(z)[0] / self.tile_size
+
+    def contains(self, z, x, y):
+        """True if a tile address is on the grid"""
+        return 0 <= z <= self.max_zoom and 0 <= x < (self.matrix_width << z) and 0 <= y < (self.matrix_height << z)
+
+    def bbox(self, z, x, y, tms=False):
+        """The bounds of a tile.
+
+        :param z: The zoom level
+        :param x: The column, counted from the left.
+        :param y: The row, counted from the top, or from the bottom if tms is True.
+        :return: (minx, miny, maxx, maxy)
+        """
+        minx, miny, maxx, maxy = self.extent
+        dx, dy = self.tile_span(z)
+        if tms:
+            return (minx + x * dx, miny + y * dy, minx + (x + 1) * dx, miny + (y + 1) * dy)
+        else:
+            return (minx + x * dx, maxy - (y + 1) * dy, minx + (x + 1) * dx, maxy - y * dy)
+
+    def tile(self, z, px, py, tms=False):
+        """The address of the tile that contains a point at a zoom level, as (x, y)"""
+        minx, miny, maxx, maxy = self.extent
+        dx, dy = self.tile_span(z)
+        x = min(int((px - minx) / dx), (self.matrix_width << z) - 1)
+        if tms:
+            y = int((py - miny) / dy)
+        else:
+            y = int((maxy - py) / dy)
+        return x, min(y, (self.matrix_height << z) - 1)
+
+
+#: Spherical mercator, the grid of web maps and WMTS's GoogleMapsCompatible tile matrix set.
+WEB_MERCATOR = TileGrid('GoogleMapsCompatible', 3857, (-20037508.342789244, -20037508.342789244, 20037508.342789244, 20037508.342789244))
+
+#: Plate carree with two tiles at zoom level 0, WMTS's WorldCRS84Quad tile matrix set.
+WORLD_CRS84 = TileGrid('WorldCRS84Quad', 4326, (-180.0, -90.0, 180.0, 90.0), matrix_width=2)
+
+#: The formats tiles can be requested in by extension.  Vector tiles come from the adapter's get_vector_tile.
+TILE_FORMATS = {
+    'png' : 'image/png',
+    'jpg' : 'image/jpeg',
+    'jpeg' : 'image/jpeg',
+    'gif' : 'image/gif',
+    'mvt' : VECTOR_TILE_MIMETYPE,
+    'pbf' : VECTOR_TILE_MIMETYPE,
+}
+
+
+class TiledWMS(WMS):
+    """A WMS view that also answers tile requests.  Requests whose URL has z, x, and y groups are tile requests; any
+    other request is handled by WMS as usual.  Tiles are cached in the adapter's cache under their address and the
+    adapter's :meth:`cache_keys`, so a cached tile is served without parsing any request parameters and is retired
+    along with the adapter's maps.
+    """
+
+    #: The :class:`TileGrid` tiles are cut from.
+    tile_grid = WEB_MERCATOR
+
+    #: Count tile rows from the bottom of the grid, as TMS does, rather than from the top.
+    tms = False
+
+    def dispatch(self, request, *args, **kwargs):
+        if 'z' not in kwargs:
+            return super(TiledWMS, self).dispatch(request, *args, **kwargs)
+        try:
+            return self.GetTile(request, **kwargs)
+        except common.OWSException as ex:
+            return HttpResponse(ex.xml(extend=self.extended_exceptions), mimetype='text/xml')
+
+    def GetTile(self, request, layers, z, x, y, format='png', style=None):
+        mimetype = TILE_FORMATS.get(format)
+        if mimetype is None:
+            raise Http404('No such tile format')
+
+        cache = self.adapter.cache
+        # tiles carry the adapter's cache keys too, so whatever retires the adapter's maps retires its tiles
+        keys = dict(self.adapter.cache_keys(), tile='/'.join((self.tile_grid.name, layers, style or '', z, x, y)) + '.' + format)
+        max_age = self.max_age(layers.split(','))
+        if cache is not None and 'fresh' not in request.GET:
+            metadata = cache.metadata(**keys)
+            if not_modified(request, metadata):
+                return cache_headers(HttpResponse(status=304), metadata, max_age)
+            item = cache.locate(**keys)
+            if item:
+                return cache_headers(HttpResponse(item, mimetype=mimetype), metadata, max_age)
+
+        z, x, y = int(z), int(x), int(y)
+        if not self.tile_grid.contains(z, x, y):
+            raise Http404('No such tile')
+        if self.adapter.requires_time or self.adapter.requires_elevation:
+            raise common.NoApplicableCode.at('GetTile', 'Tiles can only be served from layers without a required time or elevation')
+
+        saved = []
+        save = (lambda item: saved.append(cache.save(item, **keys))) if cache is not None else (lambda item: None)
+        parms = {
+            'layers' : layers.split(','),
+            'srs' : self.tile_grid.srid,
+            'bbox' : self.tile_grid.bbox(z, x, y, tms=self.tms),
+            'width' : self.tile_grid.tile_size,
+            'height' : self.tile_grid.tile_size,
+            'styles' : [style] if style else [],
+            'format' : format,
+            'bgcolor' : None,
+            'transparent' : True,
+            'time' : None,
+            'elevation' : None,
+            'v' : None,
+            'filter' : None,
+            'sld' : None,
+            'sld_body' : None,
+        }
+
+        if mimetype == VECTOR_TILE_MIMETYPE:
+            del parms['width'], parms['height'], parms['format'], parms['bgcolor'], parms['transparent']
+            ret = self.adapter.get_vector_tile(extent=4096, buffer=self.vector_tile_buffer, **parms)
+            save(ret)
+        else:
+            ret, _0 = self.render_map(parms, {}, save)
+        return cache_headers(HttpResponse(ret, mimetype=mimetype), saved[0] if saved else None, max_age)